@@ -24,6 +24,10 @@ from threading import Thread, Semaphore
 from queue import Queue, Empty
 from importlib import import_module
 from sotp.clientworker import ClientWorker
+from sotp.core import Core
+from sotp.scheduler import getPollScheduler
+from utils.compression import Compressor
+from utils.cipher import getCipher
 from utils.messaging import Message, SignalType, MessageType
 from utils.logger import Log
 from time import sleep
@@ -60,8 +64,12 @@ class MisticaClient(object):
         # Arguments depended of wrapper used
         self.max_size = None
         self.poll_delay = None
+        self.poll_mode = None
+        self.max_poll_delay = None
         self.response_timeout = None
         self.max_retries = None
+        self.window = None
+        self.extensions = False
         # Logger parameters
         self.logger = Log('_client', verbose) if verbose > 0 else None
         self._LOGGING_ = False if self.logger is None else True
@@ -71,12 +79,22 @@ class MisticaClient(object):
         self.sem.acquire()
         self._LOGGING_ and self.logger.info(f"[Wrapper] Initializing...")
         self.wrapper = [x for x in ClientWrapper.__subclasses__() if x.NAME == self.wrappername][0](self.qsotp, self.wrapperargs, self.logger)
+        cipher = getCipher(self.wrapper.cipher)
+        if cipher is None:
+            print(f"Cipher {self.wrapper.cipher} is not available, it needs the cryptography package")
+            exit(1)
         self.wrapper.start()
         # setting sotp arguments depending on the wrapper to be used
         self.max_size = self.wrapper.max_size
         self.response_timeout = self.wrapper.response_timeout
         self.poll_delay = self.wrapper.poll_delay
+        self.poll_mode = self.wrapper.poll_mode
+        self.max_poll_delay = self.wrapper.max_poll_delay
         self.max_retries = self.wrapper.max_retries
+        self.window = self.wrapper.window
+        self.extensions = self.wrapper.extensions
+        self.compression = Compressor.toCode(self.wrapper.compression, self.wrapper.compression_level)
+        self.cipher = cipher.CODE
         self.sem.release()
 
 
@@ -94,17 +112,25 @@ class MisticaClient(object):
                         self.overlayname,
                         self.wrappername,
                         self.qdata,
-                        self.logger)
+                        self.logger,
+                        self.window,
+                        self.response_timeout,
+                        getPollScheduler(self.poll_mode)(self.poll_delay, self.max_poll_delay),
+                        self.compression,
+                        self.streaming,
+                        self.cipher,
+                        self.extensions)
             dataThread = Thread(target=s.dataEntry, args=(self.qsotp,))
             dataThread.start()
             while not s.exit:
                 answers = []
                 self._LOGGING_ and self.logger.debug(f"[{self.name}] Iteration nº{i} Status: {s.st} Seq: {s.seqnumber}/65535")
+                self._LOGGING_ and self.logger.debug_all(f"[{self.name}] Metrics: {s.metrics()}")
 
                 if s.wait_reply:
-                    timeout = self.response_timeout
+                    timeout = s.replyTimeout()
                 else:
-                    timeout = self.poll_delay
+                    timeout = s.pollTimeout()
                 try:
                     dataEntry = self.qsotp.get(True,timeout)
                     answers = s.Entrypoint(dataEntry)
@@ -114,15 +140,18 @@ class MisticaClient(object):
                     else:
                         answers = s.getPollRequest()
 
+                outgoing = []
                 for answer in answers:
                     self._LOGGING_ and self.logger.debug(f"[{self.name}] Header Sent: {answer.printHeader()}")
                     if answer.receiver == self.wrapper.name:
                         self._LOGGING_ and self.logger.debug_all(f"[{self.name}] Retries {s.retries}/{self.max_retries}")
-                        self.wrapper.inbox.put(answer)
+                        outgoing.append(answer)
                     elif answer.receiver == self.overlay.name:
                         self.overlay.inbox.put(answer)
                     else:
                         raise Exception(f"Invalid answer to {answer.receiver} in client loop")
+                for request in self.wrapper.groupBatches(outgoing, s.hold):
+                    self.wrapper.inbox.put(request)
 
                 if self.released == False and s.sotp_first_push:
                     self._LOGGING_ and self.logger.debug(f"[{self.name}] Initialized! Unblocked sem")
@@ -147,6 +176,7 @@ class MisticaClient(object):
         self.overlay.start()
         # setting sotp arguments depending on the overlay to be used
         self.tag = self.overlay.tag
+        self.streaming = self.overlay.STREAMING
         self.sem.release()
 
 
@@ -160,6 +190,9 @@ class MisticaClient(object):
             if self.overlay.exit:
                 break
             try:
+                # Stop reading while the SOTP buffer is congested
+                if not self.overlay.resumed.wait(1):
+                    continue
                 if system() == 'Windows':
                     # Ugly loop for windows
                     rawdata = stdin.buffer.raw.read(300000)
@@ -226,6 +259,7 @@ if __name__ == '__main__':
     parser.add_argument("-w", "--wrapper-args", action='store', required=False, default='', help="args for the selected overlay module")
     parser.add_argument("-o", "--overlay-args", action='store', required=False, default='', help="args for the selected wrapper module")
     parser.add_argument('-v', '--verbose', action='count', default=0, help="Level of verbosity in logger (no -v None, -v Low, -vv Medium, -vvv High)")
+    parser.add_argument("--spill", action='store', type=int, default=0, help="Memory in MB for the data waiting to be sent, the rest is spilled to a temporary file (default 0 keeps it all in memory)")
     args = parser.parse_args()
     moduleargs = {}
 
@@ -260,5 +294,6 @@ if __name__ == '__main__':
         parser.print_help()
         exit(0)
 
+    Core.SPILL_MEMORY = args.spill * 1024 * 1024
     c = MisticaClient(args.key,moduleargs,args.verbose)
     c.run()
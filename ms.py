@@ -27,7 +27,15 @@ from importlib import import_module
 from signal import signal, SIGINT
 from random import choice
 from utils.prompt import Prompt
-from sys import exit, stdin
+from utils.rc4 import keystreamCache
+from sotp.core import Core
+from sotp.aio import AsyncRuntime
+from sotp.pool import WorkerPool
+from sotp.cluster import Cluster
+from sys import exit, stdin, argv, executable
+from subprocess import Popen, DEVNULL
+from tempfile import mkdtemp
+from shutil import rmtree
 from platform import system
 if system() != "Windows":
     from select import poll, POLLIN
@@ -50,16 +58,24 @@ class ModuleType:
 
 class MisticaServer():
 
-    def __init__(self, mode, key, verbose, moduleargs):
+    def __init__(self, mode, key, verbose, moduleargs, runtime=None, workers=0, cluster=None):
         # Get args and set attributes
         self.args = moduleargs
-        # Logger params
-        self.logger = Log('_server', verbose) if verbose > 0 else None
+        # Logger params, each process of a cluster has its own logs
+        self.cluster = cluster
+        logname = '_server' if not cluster or not cluster.index else f'_server{cluster.index}'
+        self.logger = Log(logname, verbose) if verbose > 0 else None
         self._LOGGING_ = False if self.logger is None else True
         # init Router
         self.key = key
-        self.Router = Router(self.key, self.logger)
+        self.runtime = runtime
+        if self.runtime is not None:
+            self.runtime.start()
+        self.pool = WorkerPool(workers, self.logger, cluster.size if cluster else 1) if workers else None
+        self.Router = Router(self.key, self.logger, self.runtime, self.pool, self.cluster)
         self.Router.start()
+        if self.cluster is not None:
+            self.cluster.start(self.Router.inbox, self.logger)
         self.mode = mode
         self.procid = 0
         if self.mode == MisticaMode.SINGLE:
@@ -103,6 +119,9 @@ class MisticaServer():
             if system() != 'Windows':
                 polling = poll()
             try:
+                # Stop reading while the SOTP buffer is congested
+                if not overlay.resumed.wait(1):
+                    continue
                 if system() == 'Windows':
                     # Ugly loop for windows
                     rawdata = stdin.buffer.raw.read(50000)
@@ -137,25 +156,36 @@ class MisticaServer():
 
             # Launch wrap_module
             wmitem = self.getModuleInstance(ModuleType.WRAP_MODULE, self.wrappername, self.args["wrapper_args"])
-            wmitem.start()
-            self.Router.wrapModules.append(wmitem)
 
             # Check wrap_server dependency of wrap_module and launch it
             if not self.dependencyLaunched(wmitem):
                 self.procid += 1
-                wsitem = wmitem.SERVER_CLASS(self.procid, self.args["wrap_server_args"], self.logger)
+                wsargs = self.args["wrap_server_args"]
+                if self.cluster is not None:
+                    wsargs += " --reuse-port"
+                wsitem = wmitem.SERVER_CLASS(self.procid, wsargs, self.logger)
+                # A poll held longer than the wrap server waits would get its decoy answer instead
+                if wmitem.long_poll and wmitem.long_poll >= wsitem.timeout:
+                    self.Router.inbox.put(Message("Mistica", 0, "sotp", 0, MessageType.SIGNAL, SignalType.TERMINATE))
+                    print(f"Error: the wrapper --long-poll ({wmitem.long_poll}s) must be lower than the {wsitem.NAME} --timeout ({wsitem.timeout}s)")
+                    exit(1)
                 wsitem.start()
                 self.Router.wrapServers.append(wsitem)
             else:
                 wsitem = [elem for elem in self.Router.wrapServers if wsname == wmitem.SERVER_CLASS.NAME][0]               
 
-            # add wrap_module to wrap_server list
+            # Launch wrap_module and add it to wrap_server list
+            if self.runtime is None:
+                wmitem.start()
+            else:
+                self.runtime.launch(wmitem)
+            self.Router.addWrapModule(wmitem)
             wsitem.addWrapModule(wmitem)
 
             # Launch overlay module
             omitem = self.getModuleInstance(ModuleType.OVERLAY, self.overlayname, self.args["overlay_args"])
             omitem.start()
-            self.Router.overlayModules.append(omitem)
+            self.Router.addOverlayModule(omitem)
             targetoverlay = self.Router.overlayModules[0]
             if targetoverlay.hasInput:
                 self.captureInput(targetoverlay)
@@ -184,6 +214,13 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--overlay-args", action='store', required=False, default='', help="args for the selected wrapper module (Single-handler mode)")
     parser.add_argument("-s", "--wrap-server-args", action='store', required=False, default='', help="args for the selected wrap server (Single-handler mode)")
     parser.add_argument('-v', '--verbose', action='count', default=0, help="Level of verbosity in logger (no -v None, -v Low, -vv Medium, -vvv High)")
+    parser.add_argument("--keystream-cache", action='store', type=int, default=16, help="Memory in MB for the RC4 keystream shared by all sessions (default 16, 0 disables it)")
+    parser.add_argument("--spill", action='store', type=int, default=0, help="Memory in MB for the data waiting to be sent by each session, the rest is spilled to a temporary file (default 0 keeps it all in memory)")
+    parser.add_argument("--workers", action='store', type=int, default=0, help="Number of threads that run all the sessions, also with --asyncio (default 0, two threads for each session)")
+    parser.add_argument("--processes", action='store', type=int, default=1, help="Number of server processes listening on the same port, each one owns a slice of the sessions (Single-handler mode, HTTP and DNS wrap servers only)")
+    parser.add_argument("--cluster-index", action='store', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--cluster-dir", action='store', default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--asyncio", action='store_true', help="Run the router, the session workers and the wrap modules as coroutines on a single event loop instead of one thread each")
     
 
     args = parser.parse_args()
@@ -221,5 +258,26 @@ if __name__ == '__main__':
     else:
         mode = MisticaMode.MULTI
 
-    s = MisticaServer(mode, args.key, args.verbose, moduleargs)
+    # Process 0 starts the rest of the cluster, which only differ in their index
+    cluster = None
+    children = []
+    if args.processes > 1:
+        wsclass = [x for x in ServerWrapper.__subclasses__() if x.NAME == moduleargs.get("wrapper")]
+        if mode != MisticaMode.SINGLE or system() == 'Windows' or not any("--reuse-port" in arg for arg in wsclass[0].SERVER_CLASS.CONFIG["args"]):
+            print("Error: --processes needs Single-handler mode, a Unix system and a wrap server that supports --reuse-port")
+            exit(1)
+        if args.cluster_dir is None:
+            args.cluster_dir = mkdtemp(prefix="mistica-")
+            children = [Popen([executable] + argv + ["--cluster-index", str(index), "--cluster-dir", args.cluster_dir], stdin=DEVNULL)
+                        for index in range(1, args.processes)]
+        cluster = Cluster(args.cluster_index, args.processes, args.cluster_dir)
+
+    keystreamCache.maxsize = args.keystream_cache * 1024 * 1024
+    Core.SPILL_MEMORY = args.spill * 1024 * 1024
+    s = MisticaServer(mode, args.key, args.verbose, moduleargs, AsyncRuntime() if args.asyncio else None, args.workers, cluster)
     s.run()
+    for child in children:
+        child.terminate()
+        child.wait()
+    if children:
+        rmtree(args.cluster_dir, ignore_errors=True)
@@ -27,6 +27,7 @@ import select
 class tcpconnect(ClientOverlay):
 
     NAME = "tcpconnect"
+    STREAMING = True
     CONFIG = {
         "prog": NAME,
         "description": "Connects to TCP port. Reads from socket, sends through SOTP connection. Reads from SOTP connection, sends through socket.",
@@ -118,6 +119,9 @@ class tcpconnect(ClientOverlay):
                 self.lock.release()
             while not self.exit:
                 try:
+                    # Stop reading while the SOTP buffer is congested
+                    if not self.resumed.wait(self.timeout):
+                        continue
                     # Block on socket until Timeout
                     result = select.select([self.socket], [], [], self.timeout)
                     if result[0]:
@@ -27,6 +27,7 @@ import select
 class tcplisten(ClientOverlay):
 
     NAME = "tcplisten"
+    STREAMING = True
     CONFIG = {
         "prog": NAME,
         "description": "Binds to TCP port. Reads from socket, sends through SOTP connection. Reads from SOTP connection, sends through socket.",
@@ -114,6 +115,9 @@ class tcplisten(ClientOverlay):
             # socket loop
             while not self.exit:
                 try:
+                    # Stop reading while the SOTP buffer is congested
+                    if not self.resumed.wait(self.timeout):
+                        continue
                     # Block on socket until Timeout
                     result = select.select([self.conn], [], [], self.timeout)
                     if result[0]:
@@ -25,6 +25,7 @@ from sys import stdout
 class io(ServerOverlay):
     
     NAME = "io"
+    STREAMING = True
     CONFIG = {
         "prog": NAME,
         "description": "Reads from stdin, sends through SOTP connection. Reads from SOTP connection, prints to stdout",
@@ -28,6 +28,7 @@ import select
 class tcpconnect(ServerOverlay):
 
     NAME = "tcpconnect"
+    STREAMING = True
     CONFIG = {
         "prog": NAME,
         "description": "Connects to TCP port. Reads from socket, sends through SOTP connection. Reads from SOTP connection, sends through socket.",
@@ -117,6 +118,9 @@ class tcpconnect(ServerOverlay):
                 self.lock.release()
             while not self.exit:
                 try:
+                    # Stop reading while the SOTP buffer is congested
+                    if not self.resumed.wait(self.timeout):
+                        continue
                     # Block on socket
                     result = select.select([self.socket], [], [], self.timeout)
                     if result[0]:
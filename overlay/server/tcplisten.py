@@ -28,6 +28,7 @@ import select
 class tcplisten(ServerOverlay):
     
     NAME = "tcplisten"
+    STREAMING = True
     CONFIG = {
         "prog": NAME,
         "description": "Binds to TCP port. Reads from socket, sends through SOTP connection. Reads from SOTP connection, sends through socket.",
@@ -115,6 +116,9 @@ class tcplisten(ServerOverlay):
             # socket loop
             while not self.exit:
                 try:
+                    # Stop reading while the SOTP buffer is congested
+                    if not self.resumed.wait(self.timeout):
+                        continue
                     # Block on socket
                     result = select.select([self.conn], [], [], self.timeout)
                     if result[0]:
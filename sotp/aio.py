@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+from collections import deque
+from threading import Thread, get_ident
+from queue import Empty
+
+
+class AsyncInbox(object):
+    '''
+    Inbox of a module that runs as a coroutine. put() can be called from
+    any thread, as with a queue.Queue, so wrap servers and overlays still
+    deliver messages the same way. get() is awaited on the event loop and
+    raises queue.Empty on timeout.
+    '''
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.items = deque()
+        self.waiter = None
+
+    def put(self, item):
+        if self.runtime.inLoop():
+            self.append(item)
+        else:
+            self.runtime.loop.call_soon_threadsafe(self.append, item)
+
+    def append(self, item):
+        self.items.append(item)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self, timeout=None):
+        while not self.items:
+            self.waiter = self.runtime.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                raise Empty
+            finally:
+                self.waiter = None
+        return self.items.popleft()
+
+    def qsize(self):
+        return len(self.items)
+
+
+class AsyncRuntime(object):
+    '''
+    Event loop of the asyncio server mode. The Router, the session workers
+    and the wrap modules run on it as coroutines, each one with AsyncInbox
+    inboxes, instead of as one thread each. Wrap servers and overlays keep
+    their threads, as they block on sockets and stdin.
+    '''
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.started = False
+        # The loop only keeps weak references to its tasks
+        self.tasks = set()
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.thread.start()
+
+    def inLoop(self):
+        return self.started and get_ident() == self.thread.ident
+
+    def inbox(self):
+        return AsyncInbox(self)
+
+    # Schedules a coroutine from any thread. The returned future is an asyncio
+    # Task inside the loop and a concurrent.futures.Future outside of it.
+    def spawn(self, coroutine):
+        if self.inLoop():
+            task = self.loop.create_task(coroutine)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return task
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Executor interface of ServerWorker: inbox and data inbox
+    def workerInboxes(self, worker):
+        return self.inbox(), self.inbox()
+
+    def execute(self, worker):
+        return self.spawn(worker.runAsync())
+
+    # Runs a MisticaThread as a coroutine. Its override points (handleStream,
+    # handleSignal, wrap, unwrap...) are called just as from its run().
+    def launch(self, module):
+        module.inbox = self.inbox()
+        return self.spawn(module.runAsync())
@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+from struct import Struct
+from queue import Queue, Empty
+from time import monotonic
+
+# A batch carries several SOTP packets in one wrapper message:
+# mark (3) | length (2) | packet | length (2) | packet ...
+# The mark reads as session 0 with sequence number 0, which no SOTP
+# packet uses, so batches and single packets can share a carrier.
+BATCH_MARK = b'\x00\x00\x00'
+FRAME_FORMAT = Struct('!H')
+# Seconds the server waits for the replies of a batch before sending the ones it has.
+BATCH_TIMEOUT = 3
+
+
+def isBatch(data):
+    return data is not None and data[:len(BATCH_MARK)] == BATCH_MARK
+
+
+def packBatch(packets):
+    frames = [BATCH_MARK]
+    for packet in packets:
+        frames.append(FRAME_FORMAT.pack(len(packet)))
+        frames.append(packet)
+    return b''.join(frames)
+
+
+def unpackBatch(data):
+    packets = []
+    offset = len(BATCH_MARK)
+    while offset < len(data):
+        if offset + FRAME_FORMAT.size > len(data):
+            raise Exception("Truncated batch frame")
+        size, = FRAME_FORMAT.unpack_from(data, offset)
+        offset += FRAME_FORMAT.size
+        if offset + size > len(data):
+            raise Exception("Truncated batch frame")
+        packets.append(bytes(data[offset:offset+size]))
+        offset += size
+    return packets
+
+
+class PacketSlot(object):
+    '''
+    Stands for a wrap server queue that takes the raw SOTP reply, which
+    the wrap module passes on without wrapping it.
+    '''
+    # OVERRIDE ME
+    def put(self, content):
+        pass
+
+    # OVERRIDE ME: the packet was not tunnel traffic and gets no reply
+    def decline(self):
+        pass
+
+
+class BatchSlot(PacketSlot):
+    '''
+    Stands for the wrap server queue of one packet of a batch, so its
+    reply goes back to the collector instead of to the carrier.
+    '''
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+
+    def put(self, content):
+        self.queue.put((self.index, content))
+
+    def decline(self):
+        self.queue.put((self.index, None))
+
+
+class BatchCollector(object):
+    '''
+    Gathers the replies to the packets of a batch and returns them as a
+    batch, in the same order as the requests.
+    '''
+    def __init__(self, count):
+        self.replies = [None] * count
+        self.answered = [False] * count
+        self.queue = Queue()
+
+    def slot(self, index):
+        return BatchSlot(self.queue, index)
+
+    # Waits for every reply, or for 'timeout' seconds, and packs the ones received.
+    # Returns None if every packet of the batch was declined.
+    def collect(self, timeout):
+        deadline = monotonic() + timeout
+        missing = len(self.replies)
+        declined = 0
+        while missing:
+            try:
+                index, content = self.queue.get(True, max(0, deadline - monotonic()))
+            except Empty:
+                break
+            if not self.answered[index]:
+                self.answered[index] = True
+                missing -= 1
+                if content is None:
+                    declined += 1
+            if content is not None:
+                self.replies[index] = content
+        if declined == len(self.replies):
+            return None
+        return packBatch([reply for reply in self.replies if reply is not None])
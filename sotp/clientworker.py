@@ -18,16 +18,19 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 from sotp.core import Header,OptionalHeader,Sizes,Offsets,Status,Flags,Sync
-from sotp.core import Core
+from sotp.core import Core, BYTE
 from sotp.packet import Packet
-from utils.bitstring import BitArray
+from sotp.window import RetransmitQueue, ReorderBuffer, RetransmitTimer
+from sotp.scheduler import PollScheduler
 from utils.rc4 import RC4
 from utils.messaging import Message,SignalType,MessageType
+from time import monotonic
+from threading import Event
 
 
 class ClientWorker(Core):
 
-    def __init__(self, key, maxretries, maxsize, tag, overlayname, wrappername, qdata, logger=None):
+    def __init__(self, key, maxretries, maxsize, tag, overlayname, wrappername, qdata, logger=None, window=1, response_timeout=3, poller=None, compression=0, streaming=False, cipher=0, extensions=False):
         super().__init__(key, maxretries, maxsize)
         self.name = type(self).__name__
         self.wait_reply = False
@@ -43,17 +46,42 @@ class ClientWorker(Core):
         self.seqnumber = 1
         self.comms_broken = False
         self.exit = False
+        # Window mode: requested window, it is only used once the server grants it
+        self.maxwindow = window
+        # Session extensions asked for even without a window above 1
+        self.extensions = extensions
+        self.extended = False
+        # Long-poll: seconds the server may hold a polling request, granted in the handshake
+        self.hold = 0
+        # Compression requested in the handshake (Compressor code, 0 for none)
+        self.compression = compression
+        # Cipher requested in the handshake (Cipher CODE, 0 for RC4)
+        self.ciphercode = cipher
+        self.streaming = streaming
+        # Overlay data is only stored once it is known how it has to be compressed and encrypted
+        self.negotiated = Event()
+        if (not compression and not cipher) or window <= 0:
+            self.negotiated.set()
+        self.response_timeout = response_timeout
+        self.inflight = RetransmitQueue()
+        self.reorder = None
+        # Retransmission timeout, starts at response_timeout and then follows the measured RTT
+        self.rto = RetransmitTimer(response_timeout)
+        self.senttime = None
+        self.resent = False
+        # Decides how long to wait before polling when there is nothing to send
+        self.poller = PollScheduler(5, 5) if poller is None else poller
         # Logger parameters
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
 
     # Method for checking if a packet is an initialization response.
     def checkInitResponse(self,packet):
-        if any(packet.session_id) == False:
+        if not packet.session_id:
             return False
-        if any(packet.seq_number) == False:
+        if not packet.seq_number:
             return False
-        if any(packet.ack) == False:
+        if not packet.ack:
             return False
         if packet.isFlagActive(Flags.SYNC) == False:
             return False
@@ -63,46 +91,78 @@ class ClientWorker(Core):
 
     # Method to check if a packet is a correct response from the server.
     def checkWorkResponse(self,packet):
-        if any(packet.session_id) == False:
+        if not packet.session_id:
             return False
-        if any(packet.seq_number) == False:
+        if not packet.seq_number:
             return False
-        if any(packet.ack) == False:
+        if not packet.ack:
             return False
-        if not any(packet.data_len) and not any(packet.content):
+        if not packet.data_len and not packet.content:
             return True
-        if packet.data_len.uint != int(packet.content.length/8):
+        if packet.data_len != len(packet.content):
             return False
         return True
 
     # Method to check if session reinitialization is needed (because the seq_number is limited to n bytes)
+    # In window mode it is started from fillWindow once every request is answered.
     def checkReinitialization(self,packet):
+        if self.window > 1:
+            return False
         if self.lastPacketSent is None:
             raise Exception('Cannot get last sent packet')
         if self.lastPacketSent.seq_number != packet.ack:
             self._LOGGING_ and self.logger.error(f"[{self.name}] on checkReinitialization() ack: {packet.ack} != seq: {self.lastPacketSent.seq_number}")
             return False
-        if self.lastPacketSent.seq_number.uint != (Sizes.MAX_MESSAGES-1):
+        if self.lastPacketSent.seq_number != (Sizes.MAX_MESSAGES-1):
             return False
         self._LOGGING_ and self.logger.info(f"[{self.name}] Reinitialization is needed!")
         return True
 
+    # In window mode a response confirms whichever in-flight request it answers.
+    def checkConfirmation(self,packet):
+        if self.window > 1:
+            return packet.ack in self.inflight
+        return super().checkConfirmation(packet)
+
+    # In stop-and-wait mode only the reply to the last packet sent is expected. Others
+    # are duplicates of replies already handled, caused by a retransmission.
+    def isDuplicateResponse(self,packet):
+        return self.window == 1 and self.lastPacketSent is not None and packet.ack != self.lastPacketSent.seq_number
+
+    # In window mode the server answers requests it cannot accept yet with seq_number 0.
+    def isStaleResponse(self,packet):
+        return bool(packet.session_id) and not packet.seq_number and packet.ack in self.inflight
+
     # functionality will be implemented in the future
     def checkForStop(self,packet):
         return True
 
+    # The extension byte is only sent when something is asked of the server, so a
+    # client on default options keeps the handshake of servers without negotiation.
+    # 'extensions' asks for them on their own, e.g. the pending hints in stop-and-wait.
+    def requestsExtensions(self):
+        if self.maxwindow <= 0:
+            return False
+        return self.maxwindow > 1 or self.extensions or bool(self.compression) or bool(self.ciphercode)
+
     # Method for generating an initialization packet
     # The overlay tag to be used is added to the data field
     def generateInitPacket(self):
         p = Packet()
-        p.session_id = BitArray(bin='0'*Header.SESSION_ID)
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
-        p.ack = BitArray(bin='0'*Header.ACK)
-        p.data_len = BitArray(uint=len(self.tag),length=Header.DATA_LEN)
-        p.flags = BitArray(uint=Flags.SYNC,length=Header.FLAGS)
+        p.session_id = 0
+        p.seq_number = self.seqnumber
+        p.ack = 0
+        p.flags = Flags.SYNC
         p.optional_headers = True
-        p.sync_type = BitArray(uint=Sync.REQUEST_AUTH,length=OptionalHeader.SYNC_TYPE)
-        p.content = BitArray(bytes=BitArray(hex=self.tag).bytes, length=Sizes.TAG)
+        p.sync_type = Sync.REQUEST_AUTH
+        p.content = self.tagToBytes(self.tag)
+        if self.requestsExtensions():
+            p.content += bytes([min(self.maxwindow, Sizes.MAX_WINDOW)])
+            if self.compression or self.ciphercode:
+                p.content += bytes([self.compression])
+            if self.ciphercode:
+                p.content += bytes([self.ciphercode])
+        p.data_len = len(p.content)
         return p
 
     # Method for generating a polling request packet
@@ -110,13 +170,13 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(uint=Flags.SYNC,length=Header.FLAGS)
+        p.data_len = 0
+        p.flags = Flags.SYNC
         p.optional_headers = True
-        p.sync_type = BitArray(uint=Sync.POLLING_REQUEST,length=OptionalHeader.SYNC_TYPE)
-        p.content = BitArray()
+        p.sync_type = Sync.POLLING_REQUEST
+        p.content = b''
         return p
 
     # Method that generates a response packet to a session termination request
@@ -124,12 +184,11 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.sync_type = BitArray()
-        p.content = BitArray()
+        p.data_len = 0
+        p.flags = 0
+        p.content = b''
         return p
 
     # Method that generates a session reintialization packet
@@ -137,13 +196,13 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(uint=Flags.SYNC,length=Header.FLAGS)
+        p.data_len = 0
+        p.flags = Flags.SYNC
         p.optional_headers = True
-        p.sync_type = BitArray(uint=Sync.REINITIALIZING,length=OptionalHeader.SYNC_TYPE)
-        p.content = BitArray()
+        p.sync_type = Sync.REINITIALIZING
+        p.content = b''
         return p
 
     # Method to generate a session termination request packet
@@ -151,13 +210,13 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(uint=Flags.SYNC,length=Header.FLAGS)
+        p.data_len = 0
+        p.flags = Flags.SYNC
         p.optional_headers = True
-        p.sync_type = BitArray(uint=Sync.SESSION_TERMINATION,length=OptionalHeader.SYNC_TYPE)
-        p.content = BitArray()
+        p.sync_type = Sync.SESSION_TERMINATION
+        p.content = b''
         return p
 
     # Method to generate a transfer packet (with data from the overlay).
@@ -165,15 +224,14 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(uint=len(content),length=Header.DATA_LEN)
+        p.data_len = len(content)
         if push:
-            p.flags = BitArray(uint=Flags.PUSH,length=Header.FLAGS)
+            p.flags = Flags.PUSH
         else:
-            p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.sync_type = BitArray()
-        p.content = BitArray(bytes=content)
+            p.flags = 0
+        p.content = content
         return p
 
     # Method to generate a confirmation packet
@@ -181,12 +239,11 @@ class ClientWorker(Core):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.sync_type = BitArray()
-        p.content = BitArray()
+        p.data_len = 0
+        p.flags = 0
+        p.content = b''
         return p
 
     # Method that generates a polling packet based on the last packet received
@@ -196,12 +253,20 @@ class ClientWorker(Core):
             raise Exception("Any previous Packet Received in getPollRequest()")
         packettosend = self.generatePollPacket(self.lastPacketRecv)
         self.storePackets(None,packettosend)
+        # The poll scheduler may ask for a new poll right away, so wait for the reply
+        # of this one before sending another
+        self.wait_reply = True
+        if self.window > 1:
+            return [self.sendWindowPacket(packettosend)]
         return [Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes())]
 
     # Method that updates the reference to the last package sent and/or received.
     def storePackets(self,packetrecv,packetsent):
         if packetsent is not None:
             self._LOGGING_ and self.logger.debug(f"[{self.name}] Storing Sent Packet sq:{packetsent.seq_number} ack:{packetsent.ack}")
+            if packetsent is not self.lastPacketSent:
+                self.senttime = monotonic()
+                self.resent = False
             self.lastPacketSent = packetsent
         if packetrecv is not None:
             self._LOGGING_ and self.logger.debug(f"[{self.name}] Storing Recv Packet sq:{packetrecv.seq_number} ack:{packetrecv.ack}")
@@ -212,6 +277,27 @@ class ClientWorker(Core):
     def doInitialize(self,packet):
         if self.sid is None:
             self.sid = packet.session_id
+        if packet.content and self.requestsExtensions():
+            self.extended = True
+            self.window = max(1, min(packet.content[0], self.maxwindow))
+            self._LOGGING_ and self.logger.info(f"[{self.name}] Server granted a window of {self.window} packets")
+            if len(packet.content) > 1 and self.window > 1:
+                self.hold = packet.content[1]
+                self._LOGGING_ and self.logger.info(f"[{self.name}] Server holds polling requests up to {self.hold}s")
+            if len(packet.content) > 2 and packet.content[2] == self.compression:
+                self.setCompression(self.compression)
+                self._LOGGING_ and self.logger.info(f"[{self.name}] Server accepted compression {self.compression:#04x}")
+            if len(packet.content) > 3 and packet.content[3] == self.ciphercode:
+                self.setCipher(self.ciphercode)
+            elif self.ciphercode:
+                self._LOGGING_ and self.logger.error(f"[{self.name}] Server refused cipher {self.ciphercode}, using {self.cipher.NAME}")
+            self._LOGGING_ and self.logger.info(f"[{self.name}] Cipher {self.cipher.NAME}, {self.messageOverhead()} bytes of overhead per message")
+        self.negotiated.set()
+        if self.window > 1:
+            self.st = Status.WORKING
+            self.reorder = ReorderBuffer(packet.seq_number)
+            self.lastPacketRecv = packet
+            return self.fillWindow(1)
         packettosend = None
         if self.someOverlayData():
             self._LOGGING_ and self.logger.debug(f"[{self.name}] detected Overlay data in doInitialize()")
@@ -232,16 +318,15 @@ class ClientWorker(Core):
         response = []
         packettosend = None
         if packet.anyContentAvailable():
-            self.extractIncomingData(packet)
+            response.extend(self.deliverIncomingData(packet))
             if packet.isFlagActive(Flags.PUSH):
-                data_decrypt = self.decryptWrapperData()
-                response.append(Message("clientworker",0,self.overlayname,0,MessageType.STREAM,data_decrypt))
                 if self.someOverlayData():
                     packettosend = self.makeTransferPacket(packet)
                     response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes()))
-                else:
+                elif packet.pending or not self.extended:
                     packettosend = self.generatePollPacket(packet)
                     response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes()))
+                # else the server has nothing else queued, the poll scheduler decides when to ask again
             else:
                 if self.someOverlayData():
                     packettosend = self.makeTransferPacket(packet)
@@ -249,26 +334,96 @@ class ClientWorker(Core):
                 else:
                     packettosend = self.generateAckPacket(packet)
                     response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes()))
-            self.wait_reply = True
-            self.transceiving = True
+            self.wait_reply = packettosend is not None
+            self.transceiving = self.wait_reply
         else:
             if self.someOverlayData():
                 packettosend = self.makeTransferPacket(packet)
                 response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes()))
                 self.wait_reply = True
                 self.transceiving = True
+            elif packet.pending:
+                self._LOGGING_ and self.logger.debug(f"[{self.name}] server has {packet.pending} chunks pending, polling")
+                packettosend = self.generatePollPacket(packet)
+                response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes()))
+                self.wait_reply = True
+                self.transceiving = True
             else:
                 self.wait_reply = False
                 self.transceiving = False
+        self.updatePoller(packet)
         self.storePackets(packet,packettosend)
         return response
 
-    # Method that extracts data (if any) from a packet received from the server (by full-duplex).
-    def extractIncomingData(self,packet):
-        if any(packet.data_len) == False or any(packet.content) == False:
-            return
-        self.bufWrapper.addChunk(packet)
-        return
+    # Window mode version of doWork. The response is reordered by seq_number before
+    # its data is delivered, and the window is refilled with new requests.
+    def doWindowWork(self,packet):
+        response = []
+        rtt = self.inflight.confirm(packet.ack)
+        if rtt is not None:
+            self.rto.sample(rtt)
+        response.extend(self.selectiveRetransmit(packet.sack))
+        if not self.reorder.isDuplicate(packet.seq_number):
+            self.reorder.add(packet)
+        for inorder in self.reorder.drain():
+            self.lastPacketRecv = inorder
+            if inorder.anyContentAvailable():
+                response.extend(self.deliverIncomingData(inorder))
+        response.extend(self.fillWindow(packet.pending))
+        self.updatePoller(packet)
+        return response
+
+    # Method that sends as many transfer packets as the window allows. Then polling
+    # requests are added until 'pull' requests (the chunks the server has pending)
+    # are in flight. Reinitialization only starts once every request is answered.
+    def fillWindow(self,pull):
+        response = []
+        lastseq = Sizes.MAX_MESSAGES-1
+        while len(self.inflight) < self.window and self.someOverlayData() and self.seqnumber < lastseq:
+            packettosend = self.makeTransferPacket(self.lastPacketRecv)
+            response.append(self.sendWindowPacket(packettosend))
+        while len(self.inflight) < min(self.window, pull) and self.seqnumber < lastseq:
+            packettosend = self.generatePollPacket(self.lastPacketRecv)
+            self.storePackets(None,packettosend)
+            response.append(self.sendWindowPacket(packettosend))
+        if not self.inflight and self.seqnumber >= lastseq:
+            response.extend(self.doReintialization(self.lastPacketRecv))
+        self.wait_reply = len(self.inflight) > 0
+        self.transceiving = self.wait_reply
+        return response
+
+    # Method that tracks a request sent in window mode, adding a SACK block if some
+    # responses have been received out of order.
+    def sendWindowPacket(self,packettosend):
+        packettosend.sack = self.reorder.sack(Sizes.MAX_SACK_RANGES)
+        hold = self.hold if packettosend.isSyncType(Sync.POLLING_REQUEST) else 0
+        self.inflight.add(packettosend, hold)
+        return Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packettosend.toBytes())
+
+    # Method that resends right away the requests that a SACK block from the server
+    # reports as missing, instead of waiting for them to time out.
+    def selectiveRetransmit(self,sack):
+        if sack is None:
+            return []
+        response = []
+        for packt in self.inflight.lost(sack):
+            self._LOGGING_ and self.logger.debug(f"[{self.name}] request sq:{packt.seq_number} reported missing by SACK, re-sending...")
+            response.append(self.sendWindowPacket(packt))
+        return response
+
+    # Method that lets the poll scheduler know whether the session is busy or idle.
+    def updatePoller(self,packet):
+        if packet.anyContentAvailable() or packet.pending or self.someOverlayData():
+            self.poller.activity()
+        elif not self.wait_reply:
+            self.poller.idle()
+
+    # Method that returns the overlay messages for the content of an in-order packet.
+    def deliverIncomingData(self,packet):
+        data_decrypt = self.readWrapperData(packet)
+        if data_decrypt is None:
+            return []
+        return [Message("clientworker",0,self.overlayname,0,MessageType.STREAM,data_decrypt)]
 
     # Method of starting a data transfer
     def makeTransferPacket(self,packet):
@@ -276,9 +431,9 @@ class ClientWorker(Core):
         chunk, push = self.bufOverlay.getChunk()
         transpacket = self.generateTransferPacket(packet,chunk,push)
         response = transpacket
-        if push and not self.bufOverlay.anyIndex():
+        if push and not self.bufOverlay.anyMessage():
             self.sotp_first_push = True
-        self.lastPacketSent = transpacket
+        self.storePackets(None,transpacket)
         return response
 
     # Method that responds to a server termination request
@@ -297,6 +452,9 @@ class ClientWorker(Core):
         self.oldst = self.st
         self.st = Status.REINITIALIZING
         self.storePackets(packt,repackt)
+        if self.window > 1:
+            self.inflight.add(repackt)
+            self.wait_reply = True
         self.seqnumber=0
         return [Message("clientworker",0,self.wrappername,0,MessageType.STREAM,repackt.toBytes())]
 
@@ -311,6 +469,11 @@ class ClientWorker(Core):
     def resetSession(self,packet):
         response = []
         self.st = self.oldst
+        if self.window > 1:
+            self.inflight.clear()
+            self.reorder.reset(packet.seq_number)
+            self.lastPacketRecv = packet
+            return self.fillWindow(0)
         packettosend = None
         if self.someOverlayData():
             self._LOGGING_ and self.logger.debug(f"[{self.name}] Overlay data detected, making transfer packet...")
@@ -328,6 +491,8 @@ class ClientWorker(Core):
     # Method used to resend the previous package, if it has not exceeded the maximum number of retries,
     # otherwise, loss of communication is reported
     def lookForRetries(self):
+        if self.window > 1:
+            return self.lookForWindowRetries()
         if self.checkForRetries():
             self._LOGGING_ and self.logger.error(f"[{self.name}] exceeded the maximum number of retries")
             self.comms_broken = True
@@ -335,25 +500,90 @@ class ClientWorker(Core):
         else:
             packt = self.lostPacket()
             self.storePackets(packt,packt)
+            self.resent = True
+            self.rto.expired()
             return [Message("clientworker",0,self.wrappername,0,MessageType.STREAM,packt.toBytes())]
 
+    # Window mode version of lookForRetries: only requests that have been waiting
+    # for longer than the response timeout are sent again.
+    def lookForWindowRetries(self):
+        expired = self.inflight.expired(self.rto.timeout())
+        if not expired:
+            return []
+        self.rto.expired()
+        if self.checkForRetries():
+            self._LOGGING_ and self.logger.error(f"[{self.name}] exceeded the maximum number of retries")
+            self.comms_broken = True
+            return [Message("clientworker",0,self.overlayname,0,MessageType.SIGNAL,SignalType.COMMS_BROKEN)]
+        response = []
+        for packt in expired:
+            self._LOGGING_ and self.logger.debug(f"[{self.name}] re-sending request sq:{packt.seq_number}")
+            response.append(self.sendWindowPacket(packt))
+        return response
+
+    # Seconds the client loop may wait for a response before looking for retries.
+    def replyTimeout(self):
+        if self.window > 1:
+            return self.inflight.nextTimeout(self.rto.timeout())
+        return self.rto.timeout()
+
+    # Seconds the client loop waits, when no response is expected, before polling.
+    # With long-poll the server holds the request, so it is sent right away.
+    def pollTimeout(self):
+        if self.hold:
+            return 0
+        return self.poller.current()
+
+    # Current state of the session, for logging and monitoring
+    def metrics(self):
+        return {
+            "status": self.st,
+            "seq": self.seqnumber,
+            "window": self.window,
+            "inflight": len(self.inflight) if self.window > 1 else int(self.wait_reply),
+            "retries": self.retries,
+            "srtt": self.rto.srtt,
+            "rto": self.rto.timeout(),
+            "poll_interval": self.poller.current(),
+            "compression": (self.compressor.level << 4 | self.compressor.method) if self.compressor is not None else 0,
+            "cipher": self.cipher.NAME,
+            "overhead": self.messageOverhead()
+        }
+
+    # Method that takes a RTT sample from the response to the last packet sent,
+    # unless that packet was sent more than once (Karn's algorithm).
+    def measureRtt(self):
+        if self.senttime is None or self.resent:
+            return
+        self.rto.sample(monotonic() - self.senttime)
+        self.senttime = None
+        self._LOGGING_ and self.logger.debug_all(f"[{self.name}] srtt: {self.rto.srtt:.3f}s rttvar: {self.rto.rttvar:.3f}s rto: {self.rto.timeout():.3f}s")
+
     # Trigger method that performs the checks associated with each function and then invokes it
     # by returning a response.
     def initialChecks(self,data,checkerFunc,nextFunc):
         try:
-            p = self.transformToPacket(data.content)
+            p = data.getPacket()
             if self.st != Status.REINITIALIZING and self.checkReinitialization(p):
                 self._LOGGING_ and self.logger.debug(f"[{self.name}] Reinitialization Request Packet detected")
                 return self.doReintialization(p)
             if self.checkTermination(p):
                 self._LOGGING_ and self.logger.debug(f"[{self.name}] Termination Request Packet detected")
                 return self.doTermination(p)
+            if self.isDuplicateResponse(p):
+                self._LOGGING_ and self.logger.debug(f"[{self.name}] dropping duplicate response to {p.ack}, waiting for {self.lastPacketSent.seq_number}")
+                return []
+            if self.window > 1 and self.isStaleResponse(p):
+                self._LOGGING_ and self.logger.debug(f"[{self.name}] request {p.ack} not accepted by the server yet")
+                return self.selectiveRetransmit(p.sack) + self.lookForRetries()
             if checkerFunc(p) == False:
                 self._LOGGING_ and self.logger.error(f"[{self.name}] {str(checkerFunc)} has failed, re-sending...")
                 return self.lookForRetries()
             if self.checkConfirmation(p) == False:
                 self._LOGGING_ and self.logger.error(f"[{self.name}] checkConfirmation has failed, lpks: {self.lastPacketSent.seq_number} != ack: {p.ack}")
                 return self.lookForRetries()
+            if self.window == 1:
+                self.measureRtt()
             return nextFunc(p)
         except Exception as e:
             self._LOGGING_ and self.logger.exception(f"[{self.name}] initialChecks Exception: {e}")
@@ -365,7 +595,8 @@ class ClientWorker(Core):
         if self.st == Status.INITIALIZING:
             return self.initialChecks(data,self.checkInitResponse,self.doInitialize)
         elif self.st == Status.WORKING:
-            return self.initialChecks(data,self.checkWorkResponse,self.doWork)
+            nextFunc = self.doWindowWork if self.window > 1 else self.doWork
+            return self.initialChecks(data,self.checkWorkResponse,nextFunc)
         elif self.st == Status.TERMINATING:
             self.st = Status.NOT_INITIALIZING
             return [Message("clientworker",0,self.overlayname,0,MessageType.SIGNAL,SignalType.COMMS_FINISHED)]
@@ -382,6 +613,8 @@ class ClientWorker(Core):
     def overlayProcessing(self, data):
         self._LOGGING_ and self.logger.debug(f"[DataThread] {data.sender} sent {len(data.content)} bytes of data, storing...")
         self.storeOverlayContent(data.content)
+        if self.window > 1 and self.st == Status.WORKING and len(self.inflight) < self.window:
+            return Message("datathread",0,"clientworker",0,MessageType.SIGNAL,SignalType.BUFFER_READY)
         if self.sid and not self.wait_reply and not self.transceiving:
             return Message("datathread",0,"clientworker",0,MessageType.SIGNAL,SignalType.BUFFER_READY)
         return
@@ -393,9 +626,15 @@ class ClientWorker(Core):
             data = self.qdata.get()
             if data.isTerminateMessage() and data.sender == "clientworker":
                 break
+            while not self.negotiated.wait(1):
+                if self.exit:
+                    return
             msg = self.overlayProcessing(data)
             if msg is not None:
                 qsotp.put(msg)
+            if self.bufOverlay.congested():
+                self._LOGGING_ and self.logger.debug(f"[DataThread] Overlay buffer congested, pausing overlay")
+                qsotp.put(Message("datathread",0,"clientworker",0,MessageType.SIGNAL,SignalType.PAUSE))
 
     # Entry point for data messages received by the sotp of the wrapper
     def streamEntry(self, data):
@@ -424,7 +663,7 @@ class ClientWorker(Core):
             p = self.generateInitPacket()
             self.wait_reply = True
             response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,p.toBytes()))
-            self.lastPacketSent = p
+            self.storePackets(None,p)
             self.st = Status.INITIALIZING
         elif data.isStopMessage():
             self._LOGGING_ and self.logger.debug_all(f"[{self.name}] signalEntry() received a signal Stop")
@@ -432,10 +671,19 @@ class ClientWorker(Core):
         elif data.isCommunicationBrokenMessage():
             self._LOGGING_ and self.logger.debug_all(f"[{self.name}] signalEntry() received a signal CommunicationBrokenMessage")
             response = self.lookForRetries()
+        elif data.isPauseMessage():
+            self._LOGGING_ and self.logger.debug_all(f"[{self.name}] signalEntry() received a signal Pause")
+            response.append(Message("clientworker",0,self.overlayname,0,MessageType.SIGNAL,SignalType.PAUSE))
         elif data.isBufferReady() and self.lastPacketSent is not None:
             self._LOGGING_ and self.logger.debug_all(f"[{self.name}] signalEntry() received a signal Buffer Ready")
-            if not self.transceiving:
+            self.poller.activity()
+            if self.window > 1:
+                if self.st == Status.WORKING:
+                    response = self.fillWindow(0)
+            elif not self.transceiving and not self.wait_reply:
+                # With a request in flight the data goes out with the next one
                 self.transceiving = True
+                self.wait_reply = True
                 self._LOGGING_ and self.logger.debug_all(f"[{self.name}] signalEntry() not transceiving so generate a transfer packet")
                 dpacket = self.makeTransferPacket(self.lastPacketRecv)
                 response.append(Message("clientworker",0,self.wrappername,0,MessageType.STREAM,dpacket.toBytes()))
@@ -444,15 +692,23 @@ class ClientWorker(Core):
             raise Exception(f"Invalid signal on streamEntry {data}")
         return response
 
+    # Method that lets the overlay read again once the chunks sent have
+    # drained the overlay buffer
+    def resumeOverlay(self):
+        if not self.bufOverlay.drained():
+            return []
+        self._LOGGING_ and self.logger.debug(f"[{self.name}] Overlay buffer drained, resuming overlay")
+        return [Message("clientworker",0,self.overlayname,0,MessageType.SIGNAL,SignalType.RESUME)]
+
     # Main entry point, separated based on message type: data or signal
     def Entrypoint(self,data):
         try:
             if data.msgtype == MessageType.SIGNAL:
                 self._LOGGING_ and self.logger.debug_all(f"[{self.name}] passing a signal message to Entrypoint")
-                return self.signalEntry(data)
+                return self.signalEntry(data) + self.resumeOverlay()
             else:
                 self._LOGGING_ and self.logger.debug_all(f"[{self.name}] passing a stream message to Entrypoint")
-                return self.streamEntry(data)
+                return self.streamEntry(data) + self.resumeOverlay()
         except Exception as e:
             self._LOGGING_ and self.logger.exception(f"[{self.name}] Exception in Entrypoint: {e}")
             return self.lookForRetries()
@@ -0,0 +1,191 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import socket
+from os import path
+from struct import Struct
+from threading import Thread, Lock
+from collections import OrderedDict
+from random import choice
+from time import monotonic
+from utils.messaging import Message, MessageType, SignalType
+from sotp.batch import PacketSlot
+
+# Packets forwarded to the process that owns their session:
+# length (4) | request id (4) | wrapper id (2) | packet
+# and the replies to them: length (4) | request id (4) | packet, where an
+# empty packet means that the owner declined it.
+REQUEST_FORMAT = Struct('!IIH')
+REPLY_FORMAT = Struct('!II')
+# Seconds a forwarded packet waits for its reply before it is forgotten
+FORWARD_TIMEOUT = 60
+
+
+def recvExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise Exception("Cluster connection closed")
+        data.extend(part)
+    return bytes(data)
+
+
+class ForwardSlot(PacketSlot):
+    '''
+    Stands for the wrap server queue of a packet forwarded by another
+    process, so the reply goes back to it over the cluster connection.
+    '''
+    def __init__(self, peer, request):
+        self.peer = peer
+        self.request = request
+
+    def put(self, content):
+        self.peer.reply(self.request, content)
+
+    def decline(self):
+        self.peer.reply(self.request, b'')
+
+
+class ForwardedPeer(object):
+    '''
+    Connection accepted from another process, which sends the packets of
+    sessions owned by this one.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = Lock()
+
+    def reply(self, request, content):
+        with self.lock:
+            self.sock.sendall(REPLY_FORMAT.pack(len(content), request) + content)
+
+
+class OwnerPeer(object):
+    '''
+    Connection to the process that owns a slice of the session IDs. The
+    replies are matched with the wrap module and wrap server queue of each
+    forwarded packet by request id.
+    '''
+    def __init__(self, address, logger):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.lock = Lock()
+        self.pending = OrderedDict()
+        self.request = 0
+        # Logger parameters
+        self.logger = logger
+        self._LOGGING_ = False if logger is None else True
+        Thread(target=self.readReplies, daemon=True).start()
+
+    def forward(self, msg, wrapper):
+        with self.lock:
+            self.request = (self.request + 1) & 0xffffffff
+            self.pending[self.request] = (wrapper, msg.wrapServerQ, monotonic())
+            while self.pending:
+                oldest = next(iter(self.pending.values()))
+                if monotonic() - oldest[2] < FORWARD_TIMEOUT:
+                    break
+                self.pending.popitem(last=False)
+            self.sock.sendall(REQUEST_FORMAT.pack(len(msg.content), self.request, wrapper.id) + bytes(msg.content))
+
+    def readReplies(self):
+        try:
+            while True:
+                length, request = REPLY_FORMAT.unpack(recvExactly(self.sock, REPLY_FORMAT.size))
+                content = recvExactly(self.sock, length)
+                with self.lock:
+                    pending = self.pending.pop(request, None)
+                if pending is None:
+                    continue
+                wrapper, wrapServerQ, _ = pending
+                if not content:
+                    wrapper.inbox.put(Message("router", 0, wrapper.name, wrapper.id, MessageType.SIGNAL, SignalType.ERROR, wrapServerQ))
+                    continue
+                wrapper.inbox.put(Message("serverworker", 0, wrapper.name, wrapper.id, MessageType.STREAM, content, wrapServerQ))
+        except Exception as e:
+            self._LOGGING_ and self.logger.error(f"[Cluster] Owner connection lost: {e}")
+
+
+class Cluster(object):
+    '''
+    Server process 'index' of 'size' that listen on the same port. Each one
+    owns the session IDs equal to its index modulo 'size', and receives on
+    a Unix socket in 'directory' the packets of its sessions that reached
+    another process.
+    '''
+    def __init__(self, index, size, directory):
+        self.index = index
+        self.size = size
+        self.directory = directory
+        self.owners = {}
+        self.lock = Lock()
+        self.inbox = None
+        self.logger = None
+        self._LOGGING_ = False
+
+    def address(self, index):
+        return path.join(self.directory, f"mistica-{index}.sock")
+
+    def owner(self, sessionID):
+        return sessionID % self.size
+
+    def owns(self, sessionID):
+        return self.owner(sessionID) == self.index
+
+    def newSessionID(self, maximum):
+        return choice(range(self.index or self.size, maximum + 1, self.size))
+
+    # Starts listening for forwarded packets, which go to the router 'inbox'
+    def start(self, inbox, logger):
+        self.inbox = inbox
+        self.logger = logger
+        self._LOGGING_ = False if logger is None else True
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.address(self.index))
+        listener.listen()
+        Thread(target=self.acceptPeers, args=(listener,), daemon=True).start()
+
+    def acceptPeers(self, listener):
+        while True:
+            sock, _ = listener.accept()
+            Thread(target=self.readForwarded, args=(ForwardedPeer(sock),), daemon=True).start()
+
+    def readForwarded(self, peer):
+        try:
+            while True:
+                length, request, wrapperID = REQUEST_FORMAT.unpack(recvExactly(peer.sock, REQUEST_FORMAT.size))
+                content = recvExactly(peer.sock, length)
+                self.inbox.put(Message("cluster", wrapperID, "router", 0, MessageType.STREAM, content, ForwardSlot(peer, request)))
+        except Exception as e:
+            self._LOGGING_ and self.logger.debug(f"[Cluster] Forwarding connection closed: {e}")
+
+    # Sends a packet received by 'wrapper' to the process that owns its session
+    def forward(self, msg, sessionID, wrapper):
+        index = self.owner(sessionID)
+        try:
+            with self.lock:
+                if index not in self.owners:
+                    self.owners[index] = OwnerPeer(self.address(index), self.logger)
+                peer = self.owners[index]
+            peer.forward(msg, wrapper)
+        except Exception as e:
+            self._LOGGING_ and self.logger.error(f"[Cluster] Cannot forward session 0x{sessionID:02x} to process {index}: {e}")
+            with self.lock:
+                self.owners.pop(index, None)
@@ -17,10 +17,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
-from sotp.packet import Packet
-from utils.bitstring import BitArray
-from utils.rc4 import RC4
-from utils.buffer import Index, OverlayBuffer, WrapperBuffer
+from sotp.packet import Packet, PacketView, Flags
+from utils.cipher import RC4Cipher, getCipher
+from utils.compression import Compressor
+from utils.buffer import OverlayBuffer, SpillingOverlayBuffer, WrapperBuffer
 
 
 BYTE = 8
@@ -43,6 +43,13 @@ class Sizes(object):
     OPTIONAL_HEADER = OptionalHeader.SYNC_TYPE
     MAX_MESSAGES = (2**Header.SEQ_NUMBER)-1
     TAG = 2 * BYTE
+    WINDOW = 1 * BYTE
+    MAX_WINDOW = (2**WINDOW)-1
+    HOLD = 1 * BYTE
+    MAX_HOLD = (2**HOLD)-1
+    COMPRESSION = 1 * BYTE
+    CIPHER = 1 * BYTE
+    MAX_SACK_RANGES = 4
 
 
 class Offsets(object):
@@ -63,11 +70,6 @@ class Status(object):
     STOPING = 5
 
 
-class Flags(object):
-    SYNC = 1
-    PUSH = 2
-
-
 class Sync(object):
     REQUEST_AUTH = 0
     RESPONSE_AUTH = 1
@@ -77,65 +79,54 @@ class Sync(object):
 
 
 class Core(object):
+    # Bytes of outgoing overlay data kept in memory by each session before
+    # the rest is spilled to a temporary file. 0 keeps everything in memory.
+    SPILL_MEMORY = 0
 
     def __init__(self, key, maxretries, maxsize):
-        self.rc4 = RC4(bytes(key, encoding='utf8'), False)
+        self.key = bytes(key, encoding='utf8')
+        # RC4 unless the session negotiates another backend
+        self.cipher = RC4Cipher(self.key)
         self.st = Status.NOT_INITIALIZING
         self.maxretries = maxretries
         self.retries = 0
         self.lastPacketSent = None
         self.lastPacketRecv = None
-        self.bufOverlay = OverlayBuffer()
+        self.window = 1
         self.bufWrapper = WrapperBuffer()
+        # Negotiated in the handshake, None keeps overlay messages as they are
+        self.compressor = None
+        # Streaming mode: each in-order chunk is decrypted and delivered as it
+        # arrives, PUSH only marks where a message ends.
+        self.streaming = False
+        self.recvStream = None
         self.checkMaxSizeAvailable(maxsize)
 
     def checkMaxSizeAvailable(self, maxsize):
         if maxsize > 2**Header.DATA_LEN:
             raise Exception(f"MaxSize {maxsize} is exced {2**Header.DATA_LEN} which is max representation with {Header.DATA_LEN} bits of Data Length")
         self.maxsize = maxsize
+        if Core.SPILL_MEMORY:
+            self.bufOverlay = SpillingOverlayBuffer(maxsize, Core.SPILL_MEMORY)
+        else:
+            self.bufOverlay = OverlayBuffer(maxsize)
 
     @staticmethod
-    def fromBytesToBitArray(data):
-        return BitArray(bytes=data)
-
-    @staticmethod
-    def parseRawPacket(binarypacket):
-        if len(binarypacket) < Sizes.HEADER:
-            raise Exception(f"Raw Packet size {len(binarypacket)} is lower than the minimun Header size {Sizes.HEADER}")
-        return binarypacket[:Sizes.HEADER], binarypacket[Sizes.HEADER:]
-
-    @staticmethod
-    def buildPacket(header, body):
-        p = Packet()
-        p.session_id = header[0:Offsets.SESSION_ID]
-        p.seq_number = header[Offsets.SESSION_ID:Offsets.SEQ_NUMBER]
-        p.ack = header[Offsets.SEQ_NUMBER:Offsets.ACK]
-        p.data_len = header[Offsets.ACK:Offsets.DATA_LEN]
-        p.flags = header[Offsets.DATA_LEN:Offsets.FLAGS]
-        p.sync_type = None
-        p.content = None
-        if p.isFlagActive(Flags.SYNC):
-            p.sync_type = BitArray(bin=body.bin[0:Offsets.SYNC_TYPE])
-            p.content = BitArray(bin=body.bin[Offsets.SYNC_TYPE:])
-            p.optional_headers = True
-        else:
-            p.sync_type = BitArray()
-            p.content = BitArray(bin=body.bin)
-        return p
+    def tagToBytes(tag):
+        return int(tag, 16).to_bytes(Sizes.TAG // BYTE, 'big')
 
+    # Received packets are only read, so they are wrapped in a PacketView
+    # instead of being copied into a Packet.
     @staticmethod
     def transformToPacket(rawbytes):
-        bitarraydata = Core.fromBytesToBitArray(rawbytes)
-        header, body = Core.parseRawPacket(bitarraydata)
-        packt = Core.buildPacket(header, body)
-        return packt
+        return PacketView(rawbytes)
 
     def checkMainFields(self,packt):
-        if any(packt.session_id) == False:
+        if not packt.session_id:
             return False
-        if any(packt.seq_number) == False:
+        if not packt.seq_number:
             return False
-        if any(packt.ack) == False:
+        if not packt.ack:
             return False
         return True
 
@@ -153,24 +144,46 @@ class Core(object):
             return self.lastPacketSent
 
     def decryptWrapperData(self):
-        packets = self.bufWrapper.getChunks()
-        content = BitArray()
-        for packet in packets:
-            content.append('0b' + packet.content.bin)
-        bytescontent = content.tobytes()
-        decryptcontent = self.rc4.crypt(bytescontent)
+        decryptcontent = self.cipher.decrypt(self.bufWrapper.getData())
+        if self.compressor is not None:
+            decryptcontent = self.compressor.decompress(decryptcontent)
         return decryptcontent
 
+    # Method that takes the data of an in-order packet. It returns the whole message
+    # once its PUSH arrives or, in streaming mode, the data of each chunk right away.
+    def readWrapperData(self, packet):
+        if not self.streaming or not self.cipher.STREAMING:
+            self.bufWrapper.addChunk(packet.content)
+            return self.decryptWrapperData() if packet.isFlagActive(Flags.PUSH) else None
+        if self.recvStream is None:
+            decompressor = self.compressor.decompressor() if self.compressor is not None else None
+            self.recvStream = (self.cipher.stream(), decompressor)
+        cipher, decompressor = self.recvStream
+        data = cipher.crypt(bytes(packet.content))
+        if decompressor is not None:
+            data = decompressor.feed(data)
+        if packet.isFlagActive(Flags.PUSH):
+            self.recvStream = None
+        return data if data else None
+
     def storeOverlayContent(self, data):
-        data = self.rc4.crypt(data)
-        index = Index()
-        lendata = len(data)
-        for i in range(0, lendata, self.maxsize):
-            index.add(data[i:i + self.maxsize])
-        self.bufOverlay.addIndex(index)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        data = self.cipher.encrypt(data)
+        self.bufOverlay.addMessage(data)
+
+    def setCompression(self, code):
+        self.compressor = Compressor(code) if code else None
+
+    def setCipher(self, code):
+        self.cipher = getCipher(code)(self.key)
+
+    # Bytes that encryption and compression add to every overlay message
+    def messageOverhead(self):
+        return self.cipher.OVERHEAD + (1 if self.compressor is not None else 0)
 
     def someOverlayData(self):
-        return self.bufOverlay.anyIndex()
+        return self.bufOverlay.anyMessage()
 
     def checkConfirmation(self,packt):
         if self.lastPacketSent is None:
@@ -17,10 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
-from threading import Thread
+from threading import Thread, Event
 from queue import Queue
 from utils.messaging import Message, MessageType, SignalType
 from argparse import ArgumentParser
+from sotp.core import Sync
+from sotp.batch import isBatch, packBatch, unpackBatch, BatchCollector, PacketSlot, BATCH_TIMEOUT
 
 class MisticaMode:
     SINGLE = 0
@@ -84,14 +86,35 @@ class MisticaThread(Thread):
                 self._LOGGING_ and self.logger.exception(f"[{self.name}] MisticaThread Exception: {e}")
         self._LOGGING_ and self.logger.debug(f"[{self.name}] Terminated")
 
+    # Same loop as run() for the asyncio server mode (see sotp.aio), where
+    # the inbox is an AsyncInbox
+    async def runAsync(self):
+        while True:
+            try:
+                message = await self.inbox.get()
+                answer = self.handleMessage(message)  # Answer can be None
+                self.processAnswer(answer)
+                if self.exit:
+                    self._LOGGING_ and self.logger.debug(f"[{self.name}] MisticaThread detect Exit Flag.")
+                    break
+            except Exception as e:
+                self._LOGGING_ and self.logger.exception(f"[{self.name}] MisticaThread Exception: {e}")
+        self._LOGGING_ and self.logger.debug(f"[{self.name}] Terminated")
+
 
 class ClientOverlay(MisticaThread):
+    # Overlays that handle a byte stream get each part of a message as soon
+    # as it arrives, instead of whole messages.
+    STREAMING = False
 
     def __init__(self, name, qsotp, qdata, args, logger):
         MisticaThread.__init__(self, name, logger)
         self.qsotp = qsotp
         self.qdata = qdata
         self.hasInput = False
+        # Cleared while the SOTP overlay buffer is congested, input must not be read
+        self.resumed = Event()
+        self.resumed.set()
         # Generate argparse and parse args
         self.argparser = self.generateArgParser()
         self.args = self.argparser.parse_args(args.split())
@@ -116,6 +139,10 @@ class ClientOverlay(MisticaThread):
         if msg.isTerminateMessage() or msg.isCommunicationEndedMessage() or msg.isCommunicationBrokenMessage():
             self.exit = True
             self.qsotp.put(Message(self.name, 0, "clientworker", 0, MessageType.SIGNAL, SignalType.TERMINATE))
+        elif msg.isPauseMessage():
+            self.resumed.clear()
+        elif msg.isResumeMessage():
+            self.resumed.set()
         pass
 
     def handleStream(self, msg):
@@ -162,6 +189,10 @@ class ClientWrapper(MisticaThread):
         MisticaThread.__init__(self,name, logger)
         self.qsotp = qsotp
         self.exit = False
+        # Requests that may be in flight at the same time (SOTP window)
+        self.window = 1
+        # Maximum number of SOTP packets carried in one wrapper request
+        self.batch = 1
         # Logger parameters
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
@@ -174,15 +205,59 @@ class ClientWrapper(MisticaThread):
         pass
 
     def handleStream(self, msg):
+        if (msg.sender == self.name):
+            try:
+                content = self.unwrap(msg.content)
+                if isBatch(content):
+                    for packet in unpackBatch(content):
+                        self.qsotp.put(self.messageToSOTP(packet))
+                    return None
+                return content
+            except Exception as e:
+                self.commsBroken(e)
+        elif (msg.sender == "clientworker"):
+            # With a window, each request is carried on its own thread so
+            # several of them can be waiting for the server at once.
+            if self.window > 1:
+                Thread(target=self.safeWrap, args=(msg.content,)).start()
+            else:
+                self.safeWrap(msg.content)
+
+    # Method that joins the requests for the server in batches of up to 'batch' packets,
+    # each one sent in a single wrapper request. Polls that the server may hold (long-poll)
+    # travel on their own so they do not delay the rest.
+    def groupBatches(self, msgs, hold=0):
+        if self.batch < 2:
+            return msgs
+        grouped = []
+        packets = []
+        for msg in msgs:
+            if not msg.isStreamMessage() or (hold and msg.getPacket().isSyncType(Sync.POLLING_REQUEST)):
+                grouped.append(msg)
+                continue
+            packets.append(msg)
+            if len(packets) == self.batch:
+                grouped.append(self.batchMessage(packets))
+                packets = []
+        if packets:
+            grouped.append(self.batchMessage(packets))
+        return grouped
+
+    def batchMessage(self, msgs):
+        if len(msgs) == 1:
+            return msgs[0]
+        return Message("clientworker", 0, self.name, 0, MessageType.STREAM, packBatch([msg.content for msg in msgs]))
+
+    def safeWrap(self, content):
         try:
-            if (msg.sender == self.name):
-                return self.unwrap(msg.content)
-            elif (msg.sender == "clientworker"):
-                self.wrap(msg.content)
+            self.wrap(content)
         except Exception as e:
-            m = Message(self.name,0,"clientworker",0,MessageType.SIGNAL,SignalType.COMMS_BROKEN)
-            self._LOGGING_ and self.logger.exception(f"[{self.name}] Exception at handleStream: {e}")
-            self.qsotp.put(m)
+            self.commsBroken(e)
+
+    def commsBroken(self, e):
+        m = Message(self.name,0,"clientworker",0,MessageType.SIGNAL,SignalType.COMMS_BROKEN)
+        self._LOGGING_ and self.logger.exception(f"[{self.name}] Exception at handleStream: {e}")
+        self.qsotp.put(m)
 
     # Route answer to sotp queue.
     def processAnswer(self, answer):
@@ -206,6 +281,9 @@ class ClientWrapper(MisticaThread):
 
 
 class ServerOverlay(MisticaThread):
+    # Overlays that handle a byte stream get each part of a message as soon
+    # as it arrives, instead of whole messages.
+    STREAMING = False
 
     def __init__(self, name, id, qsotp, mode, args, logger):
         MisticaThread.__init__(self, name, logger)
@@ -213,6 +291,9 @@ class ServerOverlay(MisticaThread):
         self.id = id
         self.qsotp = qsotp
         self.mode = mode
+        # Cleared while the SOTP overlay buffer is congested, input must not be read
+        self.resumed = Event()
+        self.resumed.set()
         # Generate argparse and parse args
         self.argparser = self.generateArgParser()
         self.args = self.argparser.parse_args(args.split())
@@ -259,6 +340,10 @@ class ServerOverlay(MisticaThread):
                                  MessageType.SIGNAL, SignalType.TERMINATE)
             else:
                 self.removeWorker(msg.sender_id)  # crashed worker
+        elif msg.isPauseMessage():
+            self.resumed.clear()
+        elif msg.isResumeMessage():
+            self.resumed.set()
         return answer
 
     def handleStream(self, msg):
@@ -338,6 +423,8 @@ class ServerWrapper(MisticaThread):
         self.id = id
         self.servername = servername
         self.qsotp = qsotp
+        # Seconds a polling request may be held, only for wrappers that support it
+        self.long_poll = 0
         # Logger parameters
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
@@ -356,6 +443,8 @@ class ServerWrapper(MisticaThread):
     def handleSOTPSignal(self, msg):
         if msg.isTerminateMessage():
             self.exit = True
+        elif msg.isErrorMessage():
+            return self.declineToWrapServer(msg.wrapServerQ)
         return None
 
     def handleServerSignal(self, msg):
@@ -365,11 +454,47 @@ class ServerWrapper(MisticaThread):
     def handleStream(self, msg):
         answer = None
         if (msg.sender == self.servername):
-            answer = self.messageToRouter(self.unwrap(msg.content), msg.wrapServerQ)
+            try:
+                content = self.unwrap(msg.content)
+            except Exception as e:
+                self._LOGGING_ and self.logger.error(f"[{self.name}] Cannot unwrap request: {e}")
+                content = None
+            if content is None:
+                return self.declineToWrapServer(msg.wrapServerQ)
+            if isBatch(content):
+                return self.dispatchBatch(content, msg.wrapServerQ)
+            answer = self.messageToRouter(content, msg.wrapServerQ)
         elif (msg.sender == "serverworker" or msg.sender == "router"):
+            if isinstance(msg.wrapServerQ, PacketSlot):
+                msg.wrapServerQ.put(msg.content)
+                return None
             answer = self.messageToWrapServer(self.wrap(msg.content), msg.wrapServerQ)
         return answer
 
+    # Method that passes each packet of a batch to the router, in order, and
+    # answers the wrap server with the batch of replies once they are collected.
+    def dispatchBatch(self, content, wrapServerQ):
+        try:
+            packets = unpackBatch(content)
+        except Exception as e:
+            self._LOGGING_ and self.logger.error(f"[{self.name}] Invalid batch: {e}")
+            return self.declineToWrapServer(wrapServerQ)
+        collector = BatchCollector(len(packets))
+        for index, packet in enumerate(packets):
+            self.qsotp.put(self.messageToRouter(packet, collector.slot(index)))
+        Thread(target=self.replyBatch, args=(collector, wrapServerQ)).start()
+        return None
+
+    def replyBatch(self, collector, wrapServerQ):
+        try:
+            content = collector.collect(BATCH_TIMEOUT)
+            if content is None:
+                self.processAnswer(self.declineToWrapServer(wrapServerQ))
+                return
+            self.processAnswer(self.messageToWrapServer(self.wrap(content), wrapServerQ))
+        except Exception as e:
+            self._LOGGING_ and self.logger.exception(f"[{self.name}] Exception replying to a batch: {e}")
+
     # OVERRIDE ME
     def wrap(self, content):
         pass
@@ -378,6 +503,12 @@ class ServerWrapper(MisticaThread):
     def unwrap(self, content):
         pass
 
+    # OVERRIDE ME: (kind, value) keys that tell the wrap server which requests
+    # this module can unwrap without parsing them, so they are sent to it only.
+    # Modules without keys get every request that no other module matches.
+    def matchKeys(self):
+        return []
+
     def processAnswer(self, answer):
         if answer is None:
             return
@@ -392,6 +523,17 @@ class ServerWrapper(MisticaThread):
         else:
             return Message(self.name, self.id, "router", 0, MessageType.STREAM, content, wrapServerQ)
 
+    # Method that lets the wrap server answer a request that is not tunnel
+    # traffic at once, instead of waiting for its timeout. Packets of a batch
+    # or forwarded by another process decline through their slot.
+    def declineToWrapServer(self, wrapServerQ):
+        if wrapServerQ is None:
+            return None
+        if isinstance(wrapServerQ, PacketSlot):
+            wrapServerQ.decline()
+            return None
+        return Message(self.name, self.id, self.servername, 0, MessageType.SIGNAL, SignalType.DECLINE, wrapServerQ)
+
     def messageToWrapServer(self, content, wrapServerQ):
         if content is None:
             return None
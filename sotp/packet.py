@@ -17,40 +17,204 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
-from utils.bitstring import BitArray
+from struct import Struct
 
 BYTE = 8
 
+# Precompiled formats for the fixed SOTP header:
+# session_id (1) | seq_number (2) | ack (2) | data_len (2) | flags (1)
+# and for the optional SYNC_TYPE byte, present only on SYNC packets.
+HEADER_FORMAT = Struct('!BHHHB')
+SYNC_TYPE_FORMAT = Struct('!B')
+# Optional SACK block, present when the SACK flag bit is set:
+# cumulative ack (2) | number of ranges (1) | ranges of first (2) - last (2)
+SACK_FORMAT = Struct('!HB')
+SACK_RANGE_FORMAT = Struct('!HH')
+# Optional number of chunks still queued by the sender, present when the
+# MORE flag bit is set. It comes after the SACK block.
+PENDING_FORMAT = Struct('!B')
+MAX_PENDING = 255
+
+
+class MalformedPacket(Exception):
+    '''
+    Raised for a raw SOTP packet whose optional headers, announced by its
+    flags, are missing or truncated. The packet must be dropped or answered
+    as lost, never routed.
+    '''
+    pass
+
+
+class Flags(object):
+    SYNC = 1
+    PUSH = 2
+    # Not a packet type: this bit only signals that a SACK block follows
+    # the optional headers, and it is masked out of the flags field.
+    SACK = 128
+    # Same as SACK: signals that the pending chunks counter is present.
+    MORE = 64
+
+
+# Method for transforming a SACK block, (cumack, [(first, last), ...]), into raw bytes
+def sackToBytes(sack):
+    cumack, ranges = sack
+    data = SACK_FORMAT.pack(cumack, len(ranges))
+    for first, last in ranges:
+        data += SACK_RANGE_FORMAT.pack(first, last)
+    return data
+
+
+# Method that reads a SACK block from raw bytes, returning it and its size
+def sackFromBytes(rawbytes, offset):
+    if len(rawbytes) < offset + SACK_FORMAT.size:
+        raise MalformedPacket("Raw Packet has SACK flag active but no SACK block")
+    cumack, count = SACK_FORMAT.unpack_from(rawbytes, offset)
+    size = SACK_FORMAT.size + count * SACK_RANGE_FORMAT.size
+    if len(rawbytes) < offset + size:
+        raise MalformedPacket(f"Raw Packet SACK block is truncated, {count} ranges expected")
+    ranges = [SACK_RANGE_FORMAT.unpack_from(rawbytes, offset + SACK_FORMAT.size + i * SACK_RANGE_FORMAT.size)
+              for i in range(count)]
+    return (cumack, ranges), size
+
+
 class Packet(object):
     def __init__(self):
-        self.session_id = None
-        self.seq_number = None
-        self.ack = None
-        self.data_len = None
-        self.flags = None
-        self.sync_type = None
-        self.content = None
+        self.session_id = 0
+        self.seq_number = 0
+        self.ack = 0
+        self.data_len = 0
+        self.flags = 0
+        self.sync_type = 0
+        self.content = b''
         self.optional_headers = False
+        self.sack = None
+        self.pending = 0
 
-    # Method for transforming a sotp packet into BitArray
+    # Method for transforming a sotp packet into raw bytes
     def toBytes(self):
-        data = BitArray()
-        data.append('0b'+self.session_id.bin)
-        data.append('0b'+self.seq_number.bin)
-        data.append('0b'+self.ack.bin)
-        data.append('0b'+self.data_len.bin)
-        data.append('0b'+self.flags.bin)
+        flags = self.flags
+        if self.sack:
+            flags |= Flags.SACK
+        if self.pending:
+            flags |= Flags.MORE
+        data = HEADER_FORMAT.pack(self.session_id, self.seq_number, self.ack,
+                                  self.data_len, flags)
         if self.optional_headers:
-            data.append('0b'+self.sync_type.bin)
-        if any(self.content):
-            data.append('0b'+self.content.bin)
-        return data.tobytes()
+            data += SYNC_TYPE_FORMAT.pack(self.sync_type)
+        if self.sack:
+            data += sackToBytes(self.sack)
+        if self.pending:
+            data += PENDING_FORMAT.pack(min(self.pending, MAX_PENDING))
+        if self.content:
+            data += self.content
+        return data
+
+    def isFlagActive(self,checkflag):
+        return True if self.flags == checkflag else False
+
+    def isSyncType(self,checktype):
+        return True if self.optional_headers and self.sync_type == checktype else False
+
+    def anyContentAvailable(self):
+        return True if self.data_len and self.content else False
+
+
+class PacketView(object):
+    '''
+    Read-only view over a raw SOTP packet received from a wrapper.
+    Header fields are decoded on first access and content is a
+    memoryview slice over the original buffer, so nothing is copied.
+    '''
+    __slots__ = ('_raw', '_header', '_offset', '_sack', '_pending')
+
+    def __init__(self, rawbytes):
+        if len(rawbytes) < HEADER_FORMAT.size:
+            raise Exception(f"Raw Packet size {len(rawbytes)} is lower than the minimun Header size {HEADER_FORMAT.size}")
+        self._raw = memoryview(rawbytes)
+        self._header = None
+        self._offset = HEADER_FORMAT.size
+        self._sack = None
+        self._pending = 0
+
+    def _decode(self):
+        if self._header is None:
+            session_id, seq_number, ack, data_len, flags = HEADER_FORMAT.unpack_from(self._raw)
+            sackflag = flags & Flags.SACK
+            moreflag = flags & Flags.MORE
+            flags &= ~(Flags.SACK | Flags.MORE)
+            if flags == Flags.SYNC:
+                if len(self._raw) < HEADER_FORMAT.size + SYNC_TYPE_FORMAT.size:
+                    raise MalformedPacket("Raw Packet has SYNC flag active but no SYNC_TYPE field")
+                self._offset = HEADER_FORMAT.size + SYNC_TYPE_FORMAT.size
+            if sackflag:
+                self._sack, size = sackFromBytes(self._raw, self._offset)
+                self._offset += size
+            if moreflag:
+                if len(self._raw) < self._offset + PENDING_FORMAT.size:
+                    raise MalformedPacket("Raw Packet has MORE flag active but no pending counter")
+                self._pending = self._raw[self._offset]
+                self._offset += PENDING_FORMAT.size
+            self._header = (session_id, seq_number, ack, data_len, flags)
+        return self._header
+
+    # Decodes the whole header now, raising MalformedPacket if it is not valid
+    def validate(self):
+        self._decode()
+        return self
+
+    @property
+    def session_id(self):
+        return self._raw[0]
+
+    @property
+    def seq_number(self):
+        return self._decode()[1]
+
+    @property
+    def ack(self):
+        return self._decode()[2]
+
+    @property
+    def data_len(self):
+        return self._decode()[3]
+
+    @property
+    def flags(self):
+        return self._decode()[4]
+
+    @property
+    def optional_headers(self):
+        return self.flags == Flags.SYNC
+
+    @property
+    def sync_type(self):
+        if not self.optional_headers:
+            return 0
+        return self._raw[HEADER_FORMAT.size]
+
+    @property
+    def sack(self):
+        self._decode()
+        return self._sack
+
+    @property
+    def pending(self):
+        self._decode()
+        return self._pending
+
+    @property
+    def content(self):
+        self._decode()
+        return self._raw[self._offset:]
+
+    def toBytes(self):
+        return self._raw.tobytes()
 
     def isFlagActive(self,checkflag):
-        return True if self.flags.uint == checkflag else False
+        return True if self.flags == checkflag else False
 
     def isSyncType(self,checktype):
-        return True if self.optional_headers and self.sync_type.uint == checktype else False
+        return True if self.optional_headers and self.sync_type == checktype else False
 
     def anyContentAvailable(self):
-        return True if any(self.data_len) and any(self.content) else False
+        return True if self.data_len and len(self.content) else False
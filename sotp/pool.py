@@ -0,0 +1,122 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+from threading import Thread
+from queue import Queue, Empty
+from heapq import heappush, heappop
+from time import monotonic
+
+
+class ShardInbox(object):
+    '''
+    Inbox of a worker run by a Shard. Messages are queued on the shard,
+    together with the worker method that handles them.
+    '''
+    def __init__(self, shard, worker, handler):
+        self.shard = shard
+        self.worker = worker
+        self.handler = handler
+
+    def put(self, msg):
+        self.shard.queue.put((self.worker, self.handler, msg))
+
+
+class Shard(Thread):
+    '''
+    Thread that runs every session assigned to it, one message at a time,
+    so the messages of a session keep their order. It also answers the
+    polls parked by its sessions when their hold time expires.
+    '''
+    def __init__(self, index, logger):
+        Thread.__init__(self, daemon=True)
+        self.name = f"Shard {index}"
+        self.queue = Queue()
+        # Parked polls as (deadline, worker id, worker), and the deadline
+        # scheduled for each worker to avoid duplicates.
+        self.deadlines = []
+        self.scheduled = {}
+        # Logger parameters
+        self.logger = logger
+        self._LOGGING_ = False if logger is None else True
+
+    def timeout(self):
+        if not self.deadlines:
+            return None
+        return max(0, self.deadlines[0][0] - monotonic())
+
+    def schedule(self, worker):
+        if worker.parked is None or worker.exit:
+            self.scheduled.pop(worker.id, None)
+            return
+        deadline = worker.parked[2]
+        if self.scheduled.get(worker.id) != deadline:
+            self.scheduled[worker.id] = deadline
+            heappush(self.deadlines, (deadline, worker.id, worker))
+
+    def answerParkedPolls(self):
+        now = monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, worker = heappop(self.deadlines)
+            if self.scheduled.get(worker.id) != deadline:
+                continue
+            del self.scheduled[worker.id]
+            if worker.parked is not None and worker.parked[2] == deadline and not worker.exit:
+                worker.outbox.put(worker.answerParkedPoll())
+
+    def run(self):
+        while True:
+            try:
+                worker, handler, msg = self.queue.get(True, self.timeout())
+            except Empty:
+                self.answerParkedPolls()
+                continue
+            try:
+                handler(msg)
+                self.schedule(worker)
+            except Exception as e:
+                self._LOGGING_ and self.logger.exception(f"[{self.name}] Exception on {worker.name}: {e}")
+            self.answerParkedPolls()
+
+
+class WorkerPool(object):
+    '''
+    Fixed number of threads that run the server sessions. Each session
+    belongs to the shard of its session ID, which handles both its inbox
+    and its data inbox, so a server uses 'size' threads for its sessions
+    however many clients it has. The session IDs of a process of a
+    cluster of 'stride' processes are all congruent modulo 'stride', so
+    they are divided by it before picking the shard.
+    '''
+    def __init__(self, size, logger, stride=1):
+        self.stride = stride
+        self.shards = [Shard(index, logger) for index in range(size)]
+        for shard in self.shards:
+            shard.start()
+
+    def shard(self, worker):
+        return self.shards[(worker.sid // self.stride) % len(self.shards)]
+
+    # Executor interface of ServerWorker: inbox and data inbox
+    def workerInboxes(self, worker):
+        shard = self.shard(worker)
+        return ShardInbox(shard, worker, worker.handleMessage), ShardInbox(shard, worker, worker.handleData)
+
+    # Messages are handled as soon as they are queued, nothing else to start
+    def execute(self, worker):
+        worker._LOGGING_ and worker.logger.info(f"[{worker.name}] associated with {worker.overlay.name} runs on {self.shard(worker).name}")
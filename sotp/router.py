@@ -21,26 +21,39 @@ from threading import Thread
 from queue import Queue
 from random import randint
 from utils.messaging import Message, MessageType, SignalType
-from utils.bitstring import BitArray
 from sotp.packet import Packet
 from sotp.serverworker import ServerWorker
 from sotp.core import Header, OptionalHeader, Sizes, Offsets, Status, Flags, Sync
-from sotp.core import Core
+from sotp.core import Core, BYTE
 from sotp.route import Route
+from utils.compression import Compressor
+from utils.cipher import getCipher
 from sys import stderr
 
 
 class Router(Thread):
 
-    def __init__(self, key, logger):
+    def __init__(self, key, logger, runtime=None, pool=None, cluster=None):
         Thread.__init__(self)
-        self.inbox = Queue()
+        # asyncio server mode: the router and its workers run on the runtime
+        # loop (see sotp.aio), this thread only waits for the router coroutine.
+        self.runtime = runtime
+        # Sessions run by a fixed set of threads (see sotp.pool) or, when
+        # there is neither a pool nor a runtime, on threads of their own.
+        self.executor = pool if pool is not None else runtime
+        # Multi-process server: sessions owned by other processes are forwarded (see sotp.cluster)
+        self.cluster = cluster
+        self.inbox = Queue() if runtime is None else runtime.inbox()
         self.wrapModules = []
         self.wrapServers = []
         self.overlayModules = []
         self.workers = []
-        self.routes = []
-        self.pendingInit = []
+        # Lookup tables used on every packet: routes and pending sessions by
+        # session ID, wrap modules by ID and overlays by their tag bytes.
+        self.routes = {}
+        self.pendingInit = {}
+        self.wrappers = {}
+        self.overlayTags = {}
         self.workerID = 1
         self.rc4 = key
         self.id = 0
@@ -50,38 +63,73 @@ class Router(Thread):
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
 
-    def errorMessage(self, destination, destination_id):
+    # Error reply for a packet the router drops, which the wrapper turns into an
+    # immediate answer to the wrap server request in 'wrapServerQ'.
+    def errorMessage(self, destination, destination_id, wrapServerQ=None):
         return Message(self.name, self.id, destination, destination_id,
-                       MessageType.SIGNAL, SignalType.ERROR)
+                       MessageType.SIGNAL, SignalType.ERROR, wrapServerQ)
+
+    def addWrapModule(self, wrap_module):
+        self.wrapModules.append(wrap_module)
+        self.wrappers[wrap_module.id] = wrap_module
+
+    def addOverlayModule(self, overlay):
+        self.overlayModules.append(overlay)
+        self.overlayTags[Core.tagToBytes(overlay.tag)] = overlay
 
     def addRoute(self, session_id, worker, wrap_module, overlay):
-        self.routes.append(Route(session_id, worker, wrap_module, overlay))
+        self.routes[session_id] = Route(session_id, worker, wrap_module, overlay)
+
+    # Drops the route of a finished session and stops its worker, which
+    # also takes it off its pool shard
+    def removeRoute(self, session_id):
+        route = self.routes.pop(session_id, None)
+        if route is None:
+            return None
+        if route.worker in self.workers:
+            self.workers.remove(route.worker)
+        route.worker.inbox.put(self.craftTerminateMessage(route.worker.name, route.worker.id))
+        return route
+
+    # Session of the worker that has answered the termination of its client
+    def endSession(self, workerID):
+        for session_id, route in self.routes.items():
+            if route.worker.id == workerID:
+                self._LOGGING_ and self.logger.info(f"[Router] Session 0x{session_id:02x} terminated, removing route")
+                self.removeRoute(session_id)
+                return
 
     def routeMessage(self, msg, sessionID):
+        route = self.routes.get(sessionID)
         if (msg.sender == "serverworker"):  # Outgoing
-            for route in self.routes:
-                if (route.session_id == sessionID):
-                    route.wrap_module.inbox.put(msg)
-                    break
+            if route is not None:
+                route.wrap_module.inbox.put(msg)
 
         else:  # incoming from wrapper
-            for route in self.routes:
-                if (route.session_id == sessionID):
-                    route.worker.inbox.put(msg)
-                    break
+            if route is not None:
+                route.worker.inbox.put(msg)
             else:  # worker not found
                 # Place error reply to unlock the server.
-                for route in self.routes:
-                    if (route.wrap_module.id == msg.sender_id):
-                        route.wrap_module.inbox.put(self.errorMessage(route.wrap_module.name,
-                                                                  route.wrap_module.id))
-                        break
+                wrapper = self.wrappers.get(msg.sender_id)
+                if wrapper is not None:
+                    wrapper.inbox.put(self.errorMessage(wrapper.name, wrapper.id, msg.wrapServerQ))
+
+    def forwardMessage(self, msg, sessionID):
+        wrapper = self.wrappers.get(msg.sender_id)
+        if wrapper is None:
+            self._LOGGING_ and self.logger.error(f"[Router] Error: Wrapper does not exist")
+            return
+        self._LOGGING_ and self.logger.debug(f"[Router] Forwarding session 0x{sessionID:02x} to process {self.cluster.owner(sessionID)}")
+        self.cluster.forward(msg, sessionID, wrapper)
 
     def craftTerminateMessage(self, receiver, receiver_id):
         return Message(self.name, self.id, receiver, receiver_id,
                        MessageType.SIGNAL, SignalType.TERMINATE)
 
     def handleSignal(self, msg):
+        if msg.isCommunicationEndedMessage() and msg.sender == "serverworker":
+            self.endSession(msg.sender_id)
+            return
         self._LOGGING_ and self.logger.debug("[Router] Terminating all threads")
         if msg.isTerminateMessage():
             # shutdown everything
@@ -95,60 +143,101 @@ class Router(Thread):
                 wm.inbox.put(self.craftTerminateMessage(wm.name, wm.id))
             self.exit = True
 
+    # Pending sessions count too, their IDs are already handed out
     def sessionAlreadyExists(self, sessionID):
-        for route in self.routes:
-            if (route.session_id == sessionID):
-                return True
-        return False
+        return sessionID in self.routes or sessionID in self.pendingInit
 
     def newSessionID(self):
         while True:
-            sessionID = BitArray(uint=randint(1, ((2**Header.SESSION_ID)-1)), length=Header.SESSION_ID)
+            if self.cluster is None:
+                sessionID = randint(1, ((2**Header.SESSION_ID)-1))
+            else:
+                sessionID = self.cluster.newSessionID((2**Header.SESSION_ID)-1)
             if not self.sessionAlreadyExists(sessionID):
                 break
         return sessionID
 
-    def generateAuthResponsePacket(self, req, sessionID):
+    # Granted window is only sent back to clients that asked for one,
+    # so peers speaking the original handshake get the usual response.
+    # The long-poll hold time, the accepted compression and cipher follow the window,
+    # trailing zeros (their defaults) are left out.
+    def generateAuthResponsePacket(self, req, sessionID, window=None, hold=0, compression=0, cipher=0):
         p = Packet()
         p.session_id = sessionID
-        p.seq_number = BitArray(uint=1, length=Header.SEQ_NUMBER)
+        p.seq_number = 1
         p.ack = req.seq_number
-        p.data_len = BitArray(bin='0' * Header.DATA_LEN)
-        p.flags = BitArray(uint=Flags.SYNC, length=Header.FLAGS)
+        p.flags = Flags.SYNC
         p.optional_headers = True
-        p.sync_type = BitArray(uint=Sync.RESPONSE_AUTH, length=OptionalHeader.SYNC_TYPE)
-        p.content = BitArray()
+        p.sync_type = Sync.RESPONSE_AUTH
+        if window is None:
+            p.data_len = 0
+            p.content = b''
+        else:
+            fields = [window, hold, compression, cipher]
+            while fields[-1] == 0 and len(fields) > 1:
+                fields.pop()
+            p.content = bytes(fields)
+            p.data_len = len(p.content)
         return p
 
+    # The client may append the window size it wants after the overlay tag.
+    # That byte also means it understands the session extensions (SACK blocks
+    # and pending chunk hints), None is returned for clients without it.
+    def negotiateWindow(self, req, wrapper):
+        content = req.content
+        if len(content) <= Sizes.TAG // BYTE:
+            return None
+        requested = content[Sizes.TAG // BYTE]
+        return max(1, min(requested, wrapper.max_window))
+
+    # Polls are only held in window mode, where the client can keep sending
+    # while one of its polls is waiting on the server.
+    def negotiateHold(self, window, wrapper):
+        if window is None or window < 2:
+            return 0
+        return min(wrapper.long_poll, Sizes.MAX_HOLD)
+
+    # Clients that negotiate a window may ask for compression in the byte after it.
+    # Unknown methods are refused with 0 and the session goes uncompressed.
+    def negotiateCompression(self, req, window):
+        offset = Sizes.TAG // BYTE + Sizes.WINDOW // BYTE
+        if window is None or len(req.content) <= offset:
+            return 0
+        code = req.content[offset]
+        return code if Compressor.validCode(code) else 0
+
+    # The cipher comes after the compression byte. Backends that are not
+    # available here are refused with 0, which keeps RC4.
+    def negotiateCipher(self, req, window):
+        offset = (Sizes.TAG + Sizes.WINDOW + Sizes.COMPRESSION) // BYTE
+        if window is None or len(req.content) <= offset:
+            return 0
+        code = req.content[offset]
+        return code if getCipher(code) is not None else 0
+
     def validOverlayTag(self, tag):
-        for overlay in self.overlayModules:
-            if overlay.tag == tag:
-                return True
-        return False
+        return tag in self.overlayTags
 
     def initializeSOTPSession(self, msg):
         # Get sender:
-        sender = None
-        for wrapper in self.wrapModules:
-            if wrapper.id == msg.sender_id:
-                sender = wrapper
-                self._LOGGING_ and self.logger.debug(f"[Router] Found {msg.sender} with id {msg.sender_id} in the WrapModule list")
-                break
-        else:  # not a valid wrapper?
+        sender = self.wrappers.get(msg.sender_id)
+        if sender is None:  # not a valid wrapper?
             self._LOGGING_ and self.logger.error(f"[Router] Error: Wrapper does not exist")
             return
+        self._LOGGING_ and self.logger.debug(f"[Router] Found {msg.sender} with id {msg.sender_id} in the WrapModule list")
 
         # Check if valid packet
         try:
-            pkt = Core.transformToPacket(msg.content)
+            pkt = msg.getPacket()
         except Exception as e:
-            sender.inbox.put(self.errorMessage(sender.name, sender.id))
+            sender.inbox.put(self.errorMessage(sender.name, sender.id, msg.wrapServerQ))
             self._LOGGING_ and self.logger.exception(f"[Router] Exception on transformToPacket()  {e}")
             return
 
         # Check if valid overlay tag
-        if not self.validOverlayTag(pkt.content):
-            sender.inbox.put(self.errorMessage(sender.name, sender.id))
+        tag = bytes(pkt.content[:Sizes.TAG // BYTE])
+        if not self.validOverlayTag(tag):
+            sender.inbox.put(self.errorMessage(sender.name, sender.id, msg.wrapServerQ))
             self._LOGGING_ and self.logger.error(f"[Router] Error: Not a valid Overlay tag")
             return
 
@@ -157,90 +246,108 @@ class Router(Thread):
             sessionID = self.newSessionID()
         except Exception as e:
             self._LOGGING_ and self.logger.exception(f"[Router] Exception on newSessionID()  {e}")
-            sender.inbox.put(self.errorMessage(sender.name, sender.id))
+            sender.inbox.put(self.errorMessage(sender.name, sender.id, msg.wrapServerQ))
             return
 
         # Add Session ID and overlay tag to pending and send response to wrapper
-        authpkt = self.generateAuthResponsePacket(pkt, sessionID)
-        self.pendingInit.append({
+        window = self.negotiateWindow(pkt, sender)
+        hold = self.negotiateHold(window, sender)
+        compression = self.negotiateCompression(pkt, window)
+        cipher = self.negotiateCipher(pkt, window)
+        authpkt = self.generateAuthResponsePacket(pkt, sessionID, window, hold, compression, cipher)
+        self.pendingInit[sessionID] = {
             "sessionID": sessionID,
-            "tag": pkt.content,
-            "lastpkt": authpkt
-        })
+            "tag": tag,
+            "lastpkt": authpkt,
+            "window": window,
+            "hold": hold,
+            "compression": compression,
+            "cipher": cipher
+        }
 
         # Avoid DoS by rejecting old pendings:
         if len(self.pendingInit) > (Header.SESSION_ID / 2):
-            self.pendingInit.pop(0)
+            del self.pendingInit[next(iter(self.pendingInit))]
         self._LOGGING_ and self.logger.debug(f"[Router] Passing Session Response back to {msg.sender}")
         sender.inbox.put(Message(self.name, self.id,
                                  sender.name, sender.id, MessageType.STREAM,
                                  authpkt.toBytes(),msg.wrapServerQ))
 
-    def spawnRoute(self, msg, sessionID, tag, lastpkt):
-        overlay = None
-        wrapper = None
+    def spawnRoute(self, msg, sessionID, tag, lastpkt, window, hold, compression, cipher):
         # Get overlay MisticaThread
-        for available in self.overlayModules:
-            if available.tag == tag:
-                overlay = available
-                break
-        else:
+        overlay = self.overlayTags.get(tag)
+        if overlay is None:
             self._LOGGING_ and self.logger.error(f"[Router] Error: Overlay module no longer available")
             return
 
         # Get wrapper MisticaThread
-        for available in self.wrapModules:
-            if available.id == msg.sender_id:
-                wrapper = available
-                break
-        else:
+        wrapper = self.wrappers.get(msg.sender_id)
+        if wrapper is None:
             self._LOGGING_ and self.logger.error(f"[Router] Error: Wrapper module no longer available")
             return
 
-        self._LOGGING_ and self.logger.debug(f"[Router] Creating route for session 0x{sessionID.hex} from {wrapper.name} to {overlay.name}. Spawning worker...")
+        self._LOGGING_ and self.logger.debug(f"[Router] Creating route for session 0x{sessionID:02x} from {wrapper.name} to {overlay.name}. Spawning worker...")
         worker = ServerWorker(overlay, self.workerID, self.inbox, wrapper.max_retries,
-                            wrapper.max_size, self.logger, self.rc4, sessionID, lastpkt)
+                            wrapper.max_size, self.logger, self.rc4, sessionID, lastpkt, window, hold, compression, cipher, self.executor)
         self.workers.append(worker)
         self.workerID += 1
-        self.routes.append(Route(sessionID, worker, wrapper, overlay))
-        self.pendingInit.remove({
-            "sessionID": sessionID,
-            "tag": tag,
-            "lastpkt": lastpkt
-        })
-        worker.start()
+        self.addRoute(sessionID, worker, wrapper, overlay)
+        del self.pendingInit[sessionID]
+        if self.executor is None:
+            worker.start()
+        else:
+            self.executor.execute(worker)
+
+    # ONLY reads the session_id byte, the rest of the header is decoded by the
+    # worker from the same packet view
+    # Packets are validated here, where a malformed one can be declined,
+    # instead of failing later inside its session worker.
+    def getSessionID(self, msg):
+        return msg.getPacket().validate().session_id
+
+    def handleMessage(self, msg):
+        # inbox contains signal?
+        if msg.isSignalMessage():
+            self._LOGGING_ and self.logger.debug(f"[Router] Signal received from {msg.sender} with content {msg.content}")
+            self.handleSignal(msg)
+            return
+        # This inbox contains a sotp packet from a worker or a wrapper
+        try:
+            sessionID = self.getSessionID(msg)
+        except Exception as e:
+            self._LOGGING_ and self.logger.error(f"[Router] Error: Not a valid SOTP packet from {msg.sender}: {e}")
+            wrapper = self.wrappers.get(msg.sender_id) if msg.sender != "serverworker" else None
+            if wrapper is not None:
+                wrapper.inbox.put(self.errorMessage(wrapper.name, wrapper.id, msg.wrapServerQ))
+            return
+        # New session? create pending init
+        if (sessionID == 0):
+            self._LOGGING_ and self.logger.info(f"[Router] New Session Request. Initializing...")
+            self.initializeSOTPSession(msg)
+            return
+        # Session of another server process?
+        if self.cluster is not None and msg.sender != "serverworker" and not self.cluster.owns(sessionID):
+            self.forwardMessage(msg, sessionID)
+            return
+        # Session init confirmed?
+        elem = self.pendingInit.get(sessionID)
+        if elem is not None:
+            self.spawnRoute(msg, sessionID, elem['tag'], elem['lastpkt'], elem['window'], elem['hold'], elem['compression'], elem['cipher'])
 
-    # ONLY gets the first N bytes where N is the size of the session_id field
-    def getSessionID(self, binarypacket):
-        return Core.fromBytesToBitArray(binarypacket)[0:Offsets.SESSION_ID]
+        # Established session! Route message
+        self.routeMessage(msg, sessionID)
 
     def run(self):
+        if self.runtime is not None:
+            self.runtime.spawn(self.runAsync()).result()
+            return
         self._LOGGING_ and self.logger.info(f"[Router] Staring up and waiting for messages...")
+        while (not self.exit):
+            self.handleMessage(self.inbox.get())
+        self._LOGGING_ and self.logger.debug("[Router] Terminated")
 
+    async def runAsync(self):
+        self._LOGGING_ and self.logger.info(f"[Router] Staring up and waiting for messages (asyncio)...")
         while (not self.exit):
-            msg = self.inbox.get()
-            # inbox contains signal?
-            if msg.isSignalMessage():
-                self._LOGGING_ and self.logger.debug(f"[Router] Signal received from {msg.sender} with content {msg.content}")
-                self.handleSignal(msg)
-                continue
-            # This inbox contains a sotp packet from a worker or a wrapper
-            try:
-                sessionID = self.getSessionID(msg.content)
-            except Exception as e:
-                print(e)
-                continue
-            # New session? create pending init
-            if (sessionID.hex == '00'):
-                self._LOGGING_ and self.logger.info(f"[Router] New Session Request. Initializing...")
-                self.initializeSOTPSession(msg)
-                continue
-            # Session init confirmed?
-            for elem in self.pendingInit:
-                if sessionID == elem['sessionID']:
-                    self.spawnRoute(msg, sessionID, elem['tag'], elem['lastpkt'])
-                    break
-
-            # Established session! Route message
-            self.routeMessage(msg, sessionID)
+            self.handleMessage(await self.inbox.get())
         self._LOGGING_ and self.logger.debug("[Router] Terminated")
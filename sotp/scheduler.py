@@ -0,0 +1,70 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class PollScheduler(object):
+    '''
+    Decides how long the client waits before sending a polling request
+    when there is nothing else to send. This one always waits the same
+    poll delay. Subclasses are selected by NAME.
+    '''
+    NAME = "fixed"
+
+    def __init__(self, polldelay, maxpolldelay):
+        self.interval = polldelay
+
+    # Data has been sent or received
+    def activity(self):
+        pass
+
+    # A request has been answered without data and nothing else is pending
+    def idle(self):
+        pass
+
+    def current(self):
+        return self.interval
+
+
+class AdaptivePollScheduler(PollScheduler):
+    '''
+    Polls right away while data is flowing and backs off geometrically,
+    up to 'maxpolldelay', while the session is idle.
+    '''
+    NAME = "adaptive"
+    MIN_DELAY = 0.1
+    FACTOR = 2
+
+    def __init__(self, polldelay, maxpolldelay):
+        self.maxdelay = maxpolldelay
+        self.interval = min(self.MIN_DELAY, maxpolldelay)
+
+    def activity(self):
+        self.interval = 0
+
+    def idle(self):
+        self.interval = min(max(self.interval * self.FACTOR, self.MIN_DELAY), self.maxdelay)
+
+
+# Method that returns the scheduler class for a --poll-mode value
+def getPollScheduler(name):
+    for scheduler in [PollScheduler] + PollScheduler.__subclasses__():
+        if scheduler.NAME == name:
+            return scheduler
+    raise Exception(f"Invalid poll mode {name}")
@@ -19,33 +19,57 @@
 #
 from sotp.core import Header, OptionalHeader, Sizes, Offsets, Status, Flags, Sync
 from sotp.core import Core, BYTE
-from sotp.packet import Packet
+from sotp.packet import Packet, MalformedPacket
+from sotp.window import ReorderBuffer, ReplyCache
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
+from time import monotonic
 from utils.messaging import Message, MessageType, SignalType
-from utils.bitstring import BitArray
 
 
-class ServerWorker(Core, Thread):
-
-    def __init__(self, overlay, id, SotpServerInbox, retries, maxsize, logger, key, sid, lastpkt):
+class ServerWorker(Core):
+    '''
+    State of one session. By default it runs on two threads of its own, see
+    start(). An executor (sotp.aio.AsyncRuntime or sotp.pool.WorkerPool)
+    provides its inboxes and runs it instead.
+    '''
+    def __init__(self, overlay, id, SotpServerInbox, retries, maxsize, logger, key, sid, lastpkt, window=None, hold=0, compression=0, cipher=0, executor=None):
         Core.__init__(self, key, retries, maxsize)
-        Thread.__init__(self)
         self.overlay = overlay
         self.st = Status.WORKING  # Server establishes session before a route is created
-        self.inbox = Queue()
-        self.datainbox = Queue()
         self.id = id
         self.sid = sid
+        self.name = f"ServerWorker {id}"
+        self.executor = executor
+        if executor is None:
+            self.inbox = Queue()
+            self.datainbox = Queue()
+        else:
+            self.inbox, self.datainbox = executor.workerInboxes(self)
         self.outbox = SotpServerInbox
         self.lastPacketSent = lastpkt
         self.lastPacketRecv = None
-        self.seqnumber = lastpkt.seq_number.uint
-        self.overlay.addWorker(self)
+        self.seqnumber = lastpkt.seq_number
+        # Window mode state (window > 1): client requests are reordered by
+        # seq_number and every reply is kept until the client confirms it.
+        self.window = window or 1
+        # The client negotiated the session extensions, so it understands pending chunk hints
+        self.extended = window is not None
+        # Long-poll: a polling request without data to answer is parked, as
+        # (packet, wrapServerQ, deadline), for up to 'hold' seconds.
+        self.hold = hold
+        self.parked = None
+        self.setCompression(compression)
+        self.setCipher(cipher)
+        self.streaming = overlay.STREAMING
+        self.reorder = ReorderBuffer(lastpkt.ack)
+        self.replies = ReplyCache()
         self.exit = False
         # Logger parameters
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
+        # The overlay may hand over buffered data right away
+        self.overlay.addWorker(self)
 
     # Method that checks if a packet is a Polling request
     def seemsPollingRequest(self,packet):
@@ -53,17 +77,17 @@ class ServerWorker(Core, Thread):
             return False
         if packet.isSyncType(Sync.POLLING_REQUEST) == False:
             return False
-        if any(packet.data_len) or any(packet.content):
+        if packet.data_len or packet.content:
             return False
         return True
 
     # Method that checks if a packet is a Data Transfer Packet
     def seemsPollingChunk(self,packet):
-        if any(packet.flags):
+        if packet.flags:
             return False
-        if any(packet.data_len) == False:
+        if not packet.data_len:
             return False
-        if packet.data_len.uint != int(packet.content.length/BYTE):
+        if packet.data_len != len(packet.content):
             return False
         return True
 
@@ -73,17 +97,17 @@ class ServerWorker(Core, Thread):
             return False
         if packet.optional_headers:
             return False
-        if any(packet.data_len) == False:
+        if not packet.data_len:
             return False
-        if packet.data_len.uint != int(packet.content.length/BYTE):
+        if packet.data_len != len(packet.content):
             return False
         return True
 
     # Method that checks if a packet is a confirmation.
     def seemsConfirmation(self,packet):
-        if any(packet.flags):
+        if packet.flags:
             return False
-        if any(packet.data_len) or any(packet.content):
+        if packet.data_len or packet.content:
             return False
         return True
 
@@ -93,7 +117,7 @@ class ServerWorker(Core, Thread):
             return False
         if not packet.isSyncType(Sync.REINITIALIZING):
             return False
-        if any(packet.data_len) or any(packet.content):
+        if packet.data_len or packet.content:
             return False
         return True
 
@@ -113,6 +137,13 @@ class ServerWorker(Core, Thread):
             return True
         return False
 
+    # In window mode the ACK is cumulative, so it is not required to match
+    # the last packet sent.
+    def checkConfirmation(self, packet):
+        if self.window > 1:
+            return True
+        return super().checkConfirmation(packet)
+
     # Method to check if the packet is valid reinitialization request
     def checkReinitialization(self, packet):
         if self.seemsReinitRequest(packet):
@@ -124,11 +155,11 @@ class ServerWorker(Core, Thread):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packet.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.content = BitArray()
+        p.data_len = 0
+        p.flags = 0
+        p.content = b''
         return p
 
     # Method for generating a session reinitialization response
@@ -136,11 +167,24 @@ class ServerWorker(Core, Thread):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
+        p.ack = packet.seq_number
+        p.data_len = 0
+        p.flags = 0
+        p.content = b''
+        return p
+
+    # Method for answering a request that is a duplicate or out of the window
+    # without consuming a sequence number. Its seq_number is 0, so the client
+    # does not take it as a confirmation and sends the request again later.
+    def generateStaleResponse(self,packet):
+        p = Packet()
+        p.session_id = self.sid
+        p.seq_number = 0
         p.ack = packet.seq_number
-        p.data_len = BitArray(bin='0'*Header.DATA_LEN)
-        p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.content = BitArray()
+        p.data_len = 0
+        p.flags = 0
+        p.content = b''
         return p
 
     # Method to generate a transfer packet (with data from the overlay)
@@ -148,15 +192,14 @@ class ServerWorker(Core, Thread):
         p = Packet()
         p.session_id = self.sid
         self.seqnumber+=1
-        p.seq_number = BitArray(uint=self.seqnumber,length=Header.SEQ_NUMBER)
+        p.seq_number = self.seqnumber
         p.ack = packt.seq_number
-        p.data_len = BitArray(uint=len(content),length=Header.DATA_LEN)
+        p.data_len = len(content)
         if push:
-            p.flags = BitArray(uint=Flags.PUSH,length=Header.FLAGS)
+            p.flags = Flags.PUSH
         else:
-            p.flags = BitArray(bin='0'*Header.FLAGS)
-        p.sync_type = BitArray()
-        p.content = BitArray(bytes=content)
+            p.flags = 0
+        p.content = content
         return p
 
     # Method that updates the reference to the last packet sent and/or received
@@ -172,29 +215,25 @@ class ServerWorker(Core, Thread):
     def makeTransferPacket(self,packet):
         response = None
         chunk, push = self.bufOverlay.getChunk()
+        if self.bufOverlay.drained():
+            self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] Overlay buffer drained, resuming overlay")
+            self.overlay.inbox.put(Message("serverworker",self.id,'overlay',self.overlay.id,MessageType.SIGNAL,SignalType.RESUME))
         transpacket = self.generateTransferPacket(packet,chunk,push)
+        if self.extended:
+            transpacket.pending = self.bufOverlay.pendingChunks()
         response = transpacket
-        if push and not self.bufOverlay.anyIndex():
+        if push and not self.bufOverlay.anyMessage():
             self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] makeTransferPacket with PUSH")
         return response
 
-    # Method that extracts data (if any) from a packet received from the client (by full-duplex).
-    def extractIncomingData(self,packet):
-        if any(packet.data_len) == False or any(packet.content) == False:
-            return
-        self.bufWrapper.addChunk(packet)
-        return
-
     # Method that manages Polling Requests, Confirmations and Data Transfer packets
     # Data transfers can be full duplex
     def doWork(self,packet,wsrvinbox):
         response = None
         packettosend = None
         if packet.anyContentAvailable():
-            self.extractIncomingData(packet)
+            self.deliverIncomingData(packet)
             if packet.isFlagActive(Flags.PUSH):
-                data_decrypt = self.decryptWrapperData()
-                self.overlay.inbox.put(Message("serverworker",self.id,'overlay',0,MessageType.STREAM,data_decrypt))
                 if self.someOverlayData():
                     packettosend = self.makeTransferPacket(packet)
                     response = Message("serverworker",self.id,"router",0,MessageType.STREAM,packettosend.toBytes(),wsrvinbox)
@@ -219,6 +258,78 @@ class ServerWorker(Core, Thread):
         self._LOGGING_ and self.logger.debug(f"[{self.name}] Header Sent: {response.printHeader()}")
         return response
 
+    # Method that passes the content of an in-order packet to the overlay.
+    def deliverIncomingData(self,packet):
+        if not packet.anyContentAvailable():
+            return
+        data_decrypt = self.readWrapperData(packet)
+        if data_decrypt is not None:
+            self.overlay.inbox.put(Message("serverworker",self.id,'overlay',0,MessageType.STREAM,data_decrypt))
+
+    # Window mode version of doWork. Requests may arrive out of order or twice:
+    # new ones are reordered before their data is delivered and get a fresh reply,
+    # repeated ones get the same reply they got the first time.
+    # Every reply carries a SACK block while requests are missing, so the client
+    # only resends those.
+    def doWindowWork(self,packet,wsrvinbox):
+        seq = packet.seq_number
+        self.replies.prune(packet.ack, packet.sack)
+        if self.parked is not None and self.parked[0].seq_number == seq:
+            self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] parked poll {seq} sent again, answering the new one")
+            self.parked = (self.parked[0], wsrvinbox, self.parked[2])
+            return None
+        if self.reorder.isDuplicate(seq) or not self.reorder.inWindow(seq, self.window):
+            packettosend = self.replies.get(seq)
+            if packettosend is None:
+                packettosend = self.generateStaleResponse(packet)
+            packettosend.sack = self.reorder.sack(Sizes.MAX_SACK_RANGES)
+            packettosend.pending = self.bufOverlay.pendingChunks()
+            self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] repeated request {seq}, answering with {packettosend.seq_number}")
+            return Message("serverworker",self.id,"router",0,MessageType.STREAM,packettosend.toBytes(),wsrvinbox)
+        self.reorder.add(packet)
+        for inorder in self.reorder.drain():
+            self.deliverIncomingData(inorder)
+        if self.hold and self.seemsPollingRequest(packet) and not self.someOverlayData():
+            return self.parkPoll(packet,wsrvinbox)
+        return self.generateWindowReply(packet,wsrvinbox)
+
+    # Method that answers a request in window mode and keeps the reply in case it is lost.
+    def generateWindowReply(self,packet,wsrvinbox):
+        if self.someOverlayData():
+            packettosend = self.makeTransferPacket(packet)
+        else:
+            packettosend = self.generatePollResponse(packet)
+        packettosend.sack = self.reorder.sack(Sizes.MAX_SACK_RANGES)
+        self.replies.add(packet.seq_number, packettosend)
+        self.storePackets(packet,packettosend)
+        response = Message("serverworker",self.id,"router",0,MessageType.STREAM,packettosend.toBytes(),wsrvinbox)
+        self._LOGGING_ and self.logger.debug(f"[{self.name}] Header Sent: {response.printHeader()}")
+        return response
+
+    # Method that holds a polling request until there is overlay data or the hold time
+    # expires. Only one is held at a time, a previous one is answered right away.
+    def parkPoll(self,packet,wsrvinbox):
+        if self.parked is not None:
+            self.outbox.put(self.answerParkedPoll())
+        self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] holding poll {packet.seq_number} for {self.hold}s")
+        self.parked = (packet, wsrvinbox, monotonic() + self.hold)
+        # Data stored since doWindowWork looked for it saw no parked poll and sent no BUFFER_READY
+        if self.someOverlayData():
+            return self.answerParkedPoll()
+        return None
+
+    # Method that answers the parked polling request
+    def answerParkedPoll(self):
+        packet, wsrvinbox, _ = self.parked
+        self.parked = None
+        return self.generateWindowReply(packet,wsrvinbox)
+
+    # Seconds to wait for new messages before the parked poll has to be answered
+    def parkedTimeout(self):
+        if self.parked is None:
+            return None
+        return max(0, self.parked[2] - monotonic())
+
     # Method that responds to a client termination request
     def doTermination(self,packet,wsrvinbox):
         self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] initializing Termination process")
@@ -231,6 +342,9 @@ class ServerWorker(Core, Thread):
     # Method that performs the session reinitialization process
     def doReinitialization(self, packet):
         reinitpacket = self.generateReinitResponse(packet)
+        self.reorder.reset(0)
+        self.replies.clear()
+        self.parked = None
         self.storePackets(packet, reinitpacket)
         return reinitpacket.toBytes()
 
@@ -238,9 +352,10 @@ class ServerWorker(Core, Thread):
     # by returning a response.
     def initialChecks(self, msg, checkerFunc, nextFunc):
         self._LOGGING_ and self.logger.debug(f"[{self.name}] Header Recv: {msg.printHeader()}")
-        p = self.transformToPacket(msg.content)
-        if p is None:
-            self._LOGGING_ and self.logger.error(f"[ServerWorker {self.id}] cannot convert data to sotp packet, re-sending...")
+        try:
+            p = msg.getPacket().validate()
+        except MalformedPacket as e:
+            self._LOGGING_ and self.logger.error(f"[ServerWorker {self.id}] cannot convert data to sotp packet ({e}), re-sending...")
             return Message("serverworker",self.id,"router",0,MessageType.STREAM,self.lostPacket().toBytes(),msg.wrapServerQ)
         if self.checkReinitialization(p):
             return Message("serverworker",self.id,"router",0,MessageType.STREAM,self.doReinitialization(p),msg.wrapServerQ)
@@ -267,13 +382,43 @@ class ServerWorker(Core, Thread):
             data = self.datainbox.get()
             if data.isTerminateMessage():
                 break
-            self.overlayProcessing(data)
+            self.storeData(data)
+        self._LOGGING_ and self.logger.debug(f"[DataThread] Terminated")
+
+    # Handler for the data inbox when an executor runs the worker
+    def handleData(self, data):
+        if not data.isTerminateMessage():
+            self.storeData(data)
+
+    # Same loop as dataEntry() for the asyncio server mode
+    async def dataEntryAsync(self):
+        while True:
+            data = await self.datainbox.get()
+            if data.isTerminateMessage():
+                break
+            self.storeData(data)
         self._LOGGING_ and self.logger.debug(f"[DataThread] Terminated")
 
+    # Method that stores a message from the overlay and tells the overlay and
+    # a parked poll about it when needed.
+    def storeData(self, data):
+        self.overlayProcessing(data)
+        if self.bufOverlay.congested():
+            self._LOGGING_ and self.logger.debug(f"[DataThread] Overlay buffer congested, pausing overlay")
+            self.overlay.inbox.put(Message("serverworker",self.id,'overlay',self.overlay.id,MessageType.SIGNAL,SignalType.PAUSE))
+        if self.parked is not None:
+            self.inbox.put(Message("datathread",self.id,"serverworker",self.id,MessageType.SIGNAL,SignalType.BUFFER_READY))
+
     # Handler for STREAM (data) type messages
     def handleStream(self, msg):
         if self.st == Status.WORKING:
-            self.outbox.put(self.initialChecks(msg, self.checkWorkRequest, self.doWork))
+            nextFunc = self.doWindowWork if self.window > 1 else self.doWork
+            response = self.initialChecks(msg, self.checkWorkRequest, nextFunc)
+            if response is not None:
+                self.outbox.put(response)
+            if self.st == Status.TERMINATING:
+                # After the last reply, so the router still routes it
+                self.outbox.put(Message("serverworker",self.id,"router",0,MessageType.SIGNAL,SignalType.COMMS_FINISHED))
         elif self.st == Status.TERMINATING:
             self.overlay.inbox.put(Message("serverworker",self.id,'overlay', self.overlay.id, MessageType.SIGNAL,SignalType.COMMS_FINISHED))
 
@@ -282,6 +427,11 @@ class ServerWorker(Core, Thread):
         if msg.isTerminateMessage():
             self.datainbox.put(Message("serverworker", self.id, "datathread", 0, MessageType.SIGNAL, SignalType.TERMINATE))
             self.exit = True
+        elif msg.isBufferReady() and self.parked is not None and self.st == Status.WORKING:
+            self.outbox.put(self.answerParkedPoll())
+
+    def start(self):
+        Thread(target=self.run).start()
 
     # Entry point of the associated Worker when creating a new session with a client.
     def run(self):
@@ -289,9 +439,35 @@ class ServerWorker(Core, Thread):
         dataThread = Thread(target=self.dataEntry)
         dataThread.start()
         while (not self.exit):
-            msg = self.inbox.get()
-            if (msg.isSignalMessage()):
-                self.handleSignal(msg)
+            try:
+                msg = self.inbox.get(True, self.parkedTimeout())
+            except Empty:
+                self.outbox.put(self.answerParkedPoll())
                 continue
-            self.handleStream(msg)
+            try:
+                self.handleMessage(msg)
+            except Exception as e:
+                self._LOGGING_ and self.logger.exception(f"[ServerWorker {self.id}] Exception handling message: {e}")
+        self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] Terminated")
+
+    # Coroutine version of run() for the asyncio server mode
+    async def runAsync(self):
+        self._LOGGING_ and self.logger.info(f"[ServerWorker {self.id}] associated with {self.overlay.name} started!")
+        self.executor.spawn(self.dataEntryAsync())
+        while (not self.exit):
+            try:
+                msg = await self.inbox.get(self.parkedTimeout())
+            except Empty:
+                self.outbox.put(self.answerParkedPoll())
+                continue
+            try:
+                self.handleMessage(msg)
+            except Exception as e:
+                self._LOGGING_ and self.logger.exception(f"[ServerWorker {self.id}] Exception handling message: {e}")
         self._LOGGING_ and self.logger.debug(f"[ServerWorker {self.id}] Terminated")
+
+    def handleMessage(self, msg):
+        if (msg.isSignalMessage()):
+            self.handleSignal(msg)
+        else:
+            self.handleStream(msg)
@@ -0,0 +1,203 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import OrderedDict
+from time import monotonic
+
+
+# Number of sequence numbers acknowledged by SACK above a missing one
+# before it is considered lost rather than delayed.
+SACK_THRESHOLD = 3
+
+
+class RetransmitQueue(object):
+    '''
+    Packets sent and not yet confirmed by the other end, ordered by the
+    time they were (re)sent, so the oldest one is always the first.
+    '''
+    def __init__(self):
+        self.packets = OrderedDict()
+        self.fastretransmitted = set()
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __contains__(self, seq):
+        return seq in self.packets
+
+    # 'hold' is how long the other end may keep the request before answering
+    # it (long-poll). Its timeout starts after that and it is not used as an
+    # RTT sample.
+    def add(self, packet, hold=0):
+        resent = packet.seq_number in self.packets or hold > 0
+        self.packets[packet.seq_number] = (packet, monotonic() + hold, resent)
+        self.packets.move_to_end(packet.seq_number)
+
+    # Removes a confirmed packet and returns its round trip time, or None
+    # if it was sent more than once (Karn's algorithm) or was not in flight.
+    def confirm(self, seq):
+        self.fastretransmitted.discard(seq)
+        entry = self.packets.pop(seq, None)
+        if entry is None or entry[2]:
+            return None
+        return monotonic() - entry[1]
+
+    # Returns the packets that a SACK block reports as missing, with at least
+    # 'threshold' sequence numbers received above them. Each one is only
+    # returned once, later losses are left to the retransmission timeout.
+    def lost(self, sack, threshold=SACK_THRESHOLD):
+        cumack, ranges = sack
+        lost = []
+        for seq, (packet, _, _) in self.packets.items():
+            if seq <= cumack or seq in self.fastretransmitted:
+                continue
+            if any(first <= seq <= last for first, last in ranges):
+                continue
+            above = sum(last - max(first, seq + 1) + 1 for first, last in ranges if last > seq)
+            if above >= threshold:
+                self.fastretransmitted.add(seq)
+                lost.append(packet)
+        return lost
+
+    def expired(self, timeout):
+        now = monotonic()
+        return [packet for packet, senttime, _ in self.packets.values() if now - senttime >= timeout]
+
+    def nextTimeout(self, timeout):
+        if not self.packets:
+            return timeout
+        senttime = min(senttime for _, senttime, _ in self.packets.values())
+        return max(0, senttime + timeout - monotonic())
+
+    def clear(self):
+        self.packets.clear()
+        self.fastretransmitted.clear()
+
+
+class ReorderBuffer(object):
+    '''
+    Keeps packets received out of order until the gap before them is
+    filled. 'last' is the highest sequence number received in order,
+    which is what the cumulative ACK reports to the other end.
+    '''
+    def __init__(self, last):
+        self.last = last
+        self.pending = {}
+
+    def isDuplicate(self, seq):
+        return seq <= self.last or seq in self.pending
+
+    def inWindow(self, seq, window):
+        return self.last < seq <= self.last + window
+
+    def add(self, packet):
+        self.pending[packet.seq_number] = packet
+
+    # Yields the packets that are now in order, advancing 'last'.
+    def drain(self):
+        while self.last + 1 in self.pending:
+            self.last += 1
+            yield self.pending.pop(self.last)
+
+    # Returns the SACK block describing what has been received: the cumulative
+    # ack and up to 'maxranges' ranges received above it. None if there is no gap.
+    def sack(self, maxranges):
+        if not self.pending:
+            return None
+        ranges = []
+        for seq in sorted(self.pending):
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1][1] = seq
+            elif len(ranges) < maxranges:
+                ranges.append([seq, seq])
+            else:
+                break
+        return (self.last, [tuple(r) for r in ranges])
+
+    def reset(self, last):
+        self.last = last
+        self.pending = {}
+
+
+class ReplyCache(object):
+    '''
+    Replies sent by the server, indexed by the sequence number of the
+    request they answer, so a retransmitted request gets the very same
+    reply. Entries are dropped once the cumulative ACK covers them.
+    '''
+    def __init__(self):
+        self.replies = {}
+
+    def add(self, reqseq, packet):
+        self.replies[reqseq] = packet
+
+    def get(self, reqseq):
+        return self.replies.get(reqseq)
+
+    # Drops the replies covered by the cumulative ack or by any SACK range.
+    def prune(self, ack, sack=None):
+        ranges = sack[1] if sack else []
+        for reqseq in [k for k, v in self.replies.items()
+                       if v.seq_number <= ack or any(first <= v.seq_number <= last for first, last in ranges)]:
+            del self.replies[reqseq]
+
+    def clear(self):
+        self.replies = {}
+
+
+class RetransmitTimer(object):
+    '''
+    Retransmission timeout derived from the measured round trip time as
+    described by Jacobson and Karels (RFC 6298): a smoothed RTT and its
+    variance are updated with every sample, and the timeout is doubled
+    on every consecutive loss until a new sample is taken. Instead of
+    the 1 second floor of the RFC, the timeout never goes below twice
+    the smoothed RTT nor below MIN_TIMEOUT, so fast links still recover
+    quickly while a steady link with no variance keeps some margin.
+    '''
+    ALPHA = 1/8
+    BETA = 1/4
+    K = 4
+    GRANULARITY = 0.01
+    MIN_TIMEOUT = 0.2
+    MAX_TIMEOUT = 60
+
+    def __init__(self, initial):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + max(self.GRANULARITY, self.K * self.rttvar)
+        self.rto = min(max(rto, 2 * self.srtt, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+        self.backoff = 1
+
+    def expired(self):
+        if self.timeout() < self.MAX_TIMEOUT:
+            self.backoff *= 2
+
+    def timeout(self):
+        return min(self.rto * self.backoff, self.MAX_TIMEOUT)
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import asyncio
+from queue import Empty
+from threading import Thread
+from time import monotonic
+from sotp.aio import AsyncRuntime
+
+
+class AsyncRuntimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime = AsyncRuntime()
+        self.runtime.start()
+
+    def tearDown(self):
+        self.runtime.loop.call_soon_threadsafe(self.runtime.loop.stop)
+
+    def testInboxTakesMessagesFromThreads(self):
+        inbox = self.runtime.inbox()
+
+        async def receive():
+            return [await inbox.get(2) for _ in range(100)]
+        result = self.runtime.spawn(receive())
+        threads = [Thread(target=lambda n=n: [inbox.put((n, i)) for i in range(25)]) for n in range(4)]
+        for t in threads:
+            t.start()
+        received = result.result(5)
+        self.assertEqual(sorted(received), [(n, i) for n in range(4) for i in range(25)])
+        # Each thread's messages keep their order
+        for n in range(4):
+            self.assertEqual([i for m, i in received if m == n], list(range(25)))
+
+    def testInboxTimeout(self):
+        inbox = self.runtime.inbox()
+
+        async def receive():
+            start = monotonic()
+            try:
+                await inbox.get(0.1)
+            except Empty:
+                return monotonic() - start
+        self.assertLess(self.runtime.spawn(receive()).result(2), 1)
+
+    def testSpawnInsideLoop(self):
+        async def child():
+            return self.runtime.inLoop()
+
+        async def parent():
+            task = self.runtime.spawn(child())
+            self.assertIsInstance(task, asyncio.Task)
+            return await task
+        self.assertFalse(self.runtime.inLoop())
+        self.assertTrue(self.runtime.spawn(parent()).result(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
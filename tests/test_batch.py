@@ -0,0 +1,75 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from threading import Thread
+from time import sleep, monotonic
+from sotp.batch import isBatch, packBatch, unpackBatch, BatchCollector, BATCH_MARK
+
+
+class BatchFormatTest(unittest.TestCase):
+
+    PACKETS = [b"\x05\x00\x02\x00\x01\x00\x00\x00", b"", b"\x05" * 300]
+
+    def testRoundTrip(self):
+        data = packBatch(self.PACKETS)
+        self.assertTrue(isBatch(data))
+        self.assertEqual(unpackBatch(data), self.PACKETS)
+        self.assertEqual(unpackBatch(memoryview(data)), self.PACKETS)
+        self.assertEqual(unpackBatch(packBatch([])), [])
+
+    def testSinglePacketIsNotBatch(self):
+        self.assertFalse(isBatch(self.PACKETS[0]))
+        self.assertFalse(isBatch(None))
+
+    def testTruncated(self):
+        data = packBatch(self.PACKETS)
+        for end in (len(BATCH_MARK) + 1, len(data) - 1):
+            self.assertRaises(Exception, unpackBatch, data[:end])
+
+
+class BatchCollectorTest(unittest.TestCase):
+
+    def testRepliesKeepRequestOrder(self):
+        collector = BatchCollector(3)
+        for index in (2, 0, 1):
+            collector.slot(index).put(bytes([index]))
+        self.assertEqual(unpackBatch(collector.collect(1)), [b"\x00", b"\x01", b"\x02"])
+
+    def testTimeoutSendsTheRepliesReceived(self):
+        collector = BatchCollector(2)
+        collector.slot(1).put(b"late")
+        start = monotonic()
+        self.assertEqual(unpackBatch(collector.collect(0.2)), [b"late"])
+        self.assertLess(monotonic() - start, 1)
+
+    def testDeclined(self):
+        collector = BatchCollector(2)
+        Thread(target=lambda: (sleep(0.05), collector.slot(0).decline(), collector.slot(1).decline())).start()
+        start = monotonic()
+        self.assertIsNone(collector.collect(3))
+        self.assertLess(monotonic() - start, 1)
+        partial = BatchCollector(2)
+        partial.slot(0).decline()
+        partial.slot(1).put(b"reply")
+        self.assertEqual(unpackBatch(partial.collect(3)), [b"reply"])
+
+
+if __name__ == '__main__':
+    unittest.main()
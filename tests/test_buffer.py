@@ -0,0 +1,118 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from utils.buffer import SpillFile, SpillingOverlayBuffer, OverlayBuffer, WrapperBuffer
+
+
+class OverlayBufferTest(unittest.TestCase):
+
+    def testChunksCutOnDemand(self):
+        buf = OverlayBuffer(100)
+        first = os.urandom(250)
+        second = os.urandom(100)
+        buf.addMessage(first)
+        buf.addMessage(b"")
+        buf.addMessage(second)
+        self.assertEqual(buf.pendingChunks(), 4)
+        chunks = [buf.getChunk() for _ in range(4)]
+        self.assertEqual([(bytes(c), push) for c, push in chunks],
+                         [(first[:100], False), (first[100:200], False), (first[200:], True), (second, True)])
+        self.assertFalse(buf.anyMessage())
+        self.assertEqual(buf.pendingChunks(), 0)
+        self.assertRaises(Exception, buf.getChunk)
+
+    def testMessageIsNotCopied(self):
+        buf = OverlayBuffer(100)
+        message = bytearray(150)
+        buf.addMessage(message)
+        message[0] = 1
+        chunk, _ = buf.getChunk()
+        self.assertEqual(chunk[0], 1)
+
+
+class BackpressureTest(unittest.TestCase):
+
+    class SmallBuffer(OverlayBuffer):
+        HIGH_WATERMARK = 1000
+        LOW_WATERMARK = 300
+
+    def testCongestedOnceUntilDrained(self):
+        buf = self.SmallBuffer(100)
+        buf.addMessage(bytes(1000))
+        self.assertFalse(buf.congested())
+        buf.addMessage(bytes(200))
+        self.assertTrue(buf.congested())
+        self.assertFalse(buf.congested())
+        while buf.size > 300:
+            self.assertFalse(buf.drained())
+            buf.getChunk()
+        self.assertTrue(buf.drained())
+        self.assertFalse(buf.drained())
+
+
+class SmallSpillFile(SpillFile):
+    MAP_WINDOW = 65536
+
+
+class SpillFileTest(unittest.TestCase):
+
+    def testSteadyStreamKeepsFileSmall(self):
+        # Two messages waiting at any time, never all of them taken
+        spill = SmallSpillFile()
+        size = 10000
+        waiting = [(spill.write(data), data) for data in (os.urandom(size), os.urandom(size))]
+        for _ in range(200):
+            data = os.urandom(size)
+            waiting.append((spill.write(data), data))
+            message, expected = waiting.pop(0)
+            self.assertEqual(message[0:len(message)], expected)
+            spill.release(len(message))
+            self.assertLessEqual(os.fstat(spill.file.fileno()).st_size, 2 * spill.MAP_WINDOW + 3 * size)
+        for message, expected in waiting:
+            self.assertEqual(message[0:len(message)], expected)
+
+
+class SpillingOverlayBufferTest(unittest.TestCase):
+
+    def testWatermarksFollowMemory(self):
+        memory = 64 * 1024 * 1024
+        buffer = SpillingOverlayBuffer(100, memory)
+        self.assertEqual(buffer.HIGH_WATERMARK, SpillingOverlayBuffer.DISK_RATIO * memory)
+        self.assertEqual(buffer.LOW_WATERMARK, memory)
+        small = SpillingOverlayBuffer(100, 1024)
+        self.assertEqual(small.HIGH_WATERMARK, OverlayBuffer.HIGH_WATERMARK)
+
+
+class WrapperBufferTest(unittest.TestCase):
+
+    def testMessagesAreReassembled(self):
+        buf = WrapperBuffer()
+        first = [os.urandom(100) for _ in range(5)]
+        for chunk in first:
+            buf.addChunk(memoryview(chunk))
+        self.assertEqual(bytes(buf.getData()), b"".join(first))
+        buf.addChunk(b"next")
+        self.assertEqual(bytes(buf.getData()), b"next")
+        self.assertRaises(Exception, buf.getData)
+
+
+if __name__ == '__main__':
+    unittest.main()
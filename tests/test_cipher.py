@@ -0,0 +1,69 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from utils.cipher import getCipher, RC4Cipher, ChaCha20Cipher, AESGCMCipher, CIPHERS
+from sotp.core import Core
+from sotp.packet import Packet
+from sotp.router import Router
+
+
+class CipherTest(unittest.TestCase):
+
+    KEY = b"secret"
+
+    def testRoundTrip(self):
+        data = os.urandom(1000)
+        for cipher in CIPHERS:
+            if not cipher.available():
+                continue
+            with self.subTest(cipher=cipher.NAME):
+                encrypted = cipher(self.KEY).encrypt(data)
+                self.assertEqual(len(encrypted), len(data) + cipher.OVERHEAD)
+                self.assertEqual(bytes(cipher(self.KEY).decrypt(encrypted)), data)
+
+    @unittest.skipUnless(ChaCha20Cipher.available(), "needs the cryptography package")
+    def testTamperedMessageIsRejected(self):
+        for cipher in (ChaCha20Cipher, AESGCMCipher):
+            encrypted = bytearray(cipher(self.KEY).encrypt(b"message"))
+            encrypted[-1] ^= 1
+            self.assertRaises(Exception, cipher(self.KEY).decrypt, bytes(encrypted))
+            self.assertRaises(Exception, cipher(b"other").decrypt, cipher(self.KEY).encrypt(b"message"))
+
+    def testSelection(self):
+        self.assertIs(getCipher("rc4"), RC4Cipher)
+        self.assertIs(getCipher(0), RC4Cipher)
+        self.assertIsNone(getCipher("des"))
+        self.assertIsNone(getCipher(9))
+        self.assertIs(getCipher(ChaCha20Cipher.CODE), ChaCha20Cipher if ChaCha20Cipher.available() else None)
+
+    def testNegotiation(self):
+        router = Router("secret", None)
+        req = Packet()
+        req.content = Core.tagToBytes("0x1010") + bytes([4, 0, ChaCha20Cipher.CODE])
+        granted = ChaCha20Cipher.CODE if ChaCha20Cipher.available() else 0
+        self.assertEqual(router.negotiateCipher(req, 4), granted)
+        req.content = Core.tagToBytes("0x1010") + bytes([4, 0, 9])
+        self.assertEqual(router.negotiateCipher(req, 4), 0)
+        self.assertEqual(router.negotiateCipher(req, None), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from queue import Queue, Empty
+from threading import Thread
+from time import sleep, monotonic
+from sotp.router import Router
+from sotp.aio import AsyncRuntime
+from sotp.pool import WorkerPool
+from sotp.clientworker import ClientWorker
+from sotp.serverworker import ServerWorker
+from sotp.core import Core, Sync, Status
+from sotp.packet import Packet, PacketView, Flags
+from sotp.scheduler import PollScheduler, getPollScheduler
+from utils.messaging import Message, MessageType, SignalType
+
+
+class EchoWrapper(Thread):
+    '''
+    Server wrap module that passes packets through as they are.
+    '''
+    name = "http"
+    id = 1
+    max_size = 200
+    max_retries = 50
+    max_window = 16
+    long_poll = 0
+
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
+        self.inbox = Queue()
+
+    def run(self):
+        while True:
+            msg = self.inbox.get()
+            if msg.isStreamMessage():
+                msg.wrapServerQ.put(msg)
+
+
+class SinkOverlay(object):
+    name = "io"
+    tag = "0x1010"
+    STREAMING = False
+
+    def __init__(self):
+        self.id = 2
+        self.inbox = Queue()
+        self.received = bytearray()
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            msg = self.inbox.get()
+            if msg.isStreamMessage():
+                self.received.extend(msg.content)
+
+    def addWorker(self, worker):
+        pass
+
+
+class StopAndWaitTest(unittest.TestCase):
+
+    KEY = "secret"
+    LIMIT = 20
+    EXTENSIONS = False
+
+    def setUp(self):
+        self.router = self.makeRouter()
+        self.wrapper = EchoWrapper()
+        self.wrapper.start()
+        self.overlay = SinkOverlay()
+        self.router.addWrapModule(self.wrapper)
+        self.router.addOverlayModule(self.overlay)
+        self.router.start()
+        self.qsotp = Queue()
+        self.qdata = Queue()
+        self.client = ClientWorker(self.KEY, 50, 200, self.overlay.tag, "io", "http", self.qdata, None, 1, 0.5, self.poller(), 0, False, 0, self.EXTENSIONS)
+        Thread(target=self.client.dataEntry, args=(self.qsotp,), daemon=True).start()
+        self.requests = 0
+
+    def makeRouter(self):
+        return Router(self.KEY, None)
+
+    def poller(self):
+        return PollScheduler(0.05, 0.05)
+
+    def tearDown(self):
+        self.router.inbox.put(Message("test", 0, "router", 0, MessageType.SIGNAL, SignalType.TERMINATE))
+
+    # Carries a client request to the router, delaying the reply by delay(n) seconds
+    def carry(self, request, delay):
+        self.requests += 1
+        q = Queue()
+        self.router.inbox.put(Message("http", 1, "router", 0, MessageType.STREAM, request, q))
+        try:
+            reply = q.get(True, 5)
+        except Empty:
+            return
+        sleep(delay(self.requests))
+        self.qsotp.put(Message("http", 0, "clientworker", 0, MessageType.STREAM, reply.content))
+
+    # Runs the client loop as mc.py does, until done() or LIMIT seconds
+    def loop(self, done, delay):
+        start = monotonic()
+        while not done() and monotonic() - start < self.LIMIT:
+            if self.client.wait_reply:
+                timeout = self.client.replyTimeout()
+            else:
+                timeout = self.client.pollTimeout()
+            try:
+                answers = self.client.Entrypoint(self.qsotp.get(True, timeout))
+            except Empty:
+                if self.client.wait_reply:
+                    answers = self.client.lookForRetries()
+                else:
+                    answers = self.client.getPollRequest()
+            for answer in answers:
+                if answer.receiver == "http" and answer.isStreamMessage():
+                    Thread(target=self.carry, args=(answer.content, delay), daemon=True).start()
+
+    # Runs the client loop until 'up' reaches the server overlay, returns the number of requests.
+    # With 'idle' seconds, the overlay data comes only after the session has been idle that long.
+    def upload(self, up, delay, idle=0):
+        self.qsotp.put(Message("io", 0, "clientworker", 0, MessageType.SIGNAL, SignalType.START))
+        if idle:
+            start = monotonic()
+            self.loop(lambda: monotonic() - start > idle, delay)
+        self.qdata.put(Message("io", 0, "clientworker", 0, MessageType.STREAM, up))
+        self.loop(lambda: bytes(self.overlay.received) == up, delay)
+        self.assertEqual(bytes(self.overlay.received), up)
+        return self.requests
+
+    def testDelayedReplyIsNotEchoed(self):
+        # The third reply comes after the retransmission timeout, so its request is
+        # sent again and the server answers it twice. The duplicate reply must be
+        # dropped: otherwise each later request would be sent twice too.
+        up = os.urandom(10000)
+        requests = self.upload(up, lambda n: 1.5 if n == 3 else 0.02)
+        # One request per sequence number, plus the single retransmission
+        self.assertLessEqual(requests, self.client.seqnumber + 1)
+
+    def testStopRemovesRoute(self):
+        self.upload(b"x" * 1000, lambda n: 0.02)
+        worker = self.router.workers[0]
+        self.qsotp.put(Message("io", 0, "clientworker", 0, MessageType.SIGNAL, SignalType.STOP))
+        self.loop(lambda: self.client.st == Status.NOT_INITIALIZING, lambda n: 0.02)
+        self.assertEqual(self.client.st, Status.NOT_INITIALIZING)
+        start = monotonic()
+        while not worker.exit and monotonic() - start < 2:
+            sleep(0.01)
+        self.assertEqual(self.router.routes, {})
+        self.assertEqual(self.router.workers, [])
+        self.assertTrue(worker.exit)
+
+
+class ExtendedStopAndWaitTest(StopAndWaitTest):
+
+    EXTENSIONS = True
+
+    def testExtensionsWithoutWindow(self):
+        self.upload(os.urandom(1000), lambda n: 0.02)
+        self.assertTrue(self.client.extended)
+        self.assertEqual(self.client.window, 1)
+        self.assertTrue(self.router.workers[0].extended)
+
+
+class AsyncStopAndWaitTest(StopAndWaitTest):
+
+    def makeRouter(self):
+        runtime = AsyncRuntime()
+        runtime.start()
+        return Router(self.KEY, None, runtime)
+
+
+class PoolStopAndWaitTest(StopAndWaitTest):
+
+    def makeRouter(self):
+        return Router(self.KEY, None, None, WorkerPool(2, None))
+
+
+class AdaptivePollTest(StopAndWaitTest):
+
+    LIMIT = 10
+
+    def poller(self):
+        return getPollScheduler("adaptive")(0.5, 0.4)
+
+    def testOneRequestInFlight(self):
+        # The adaptive scheduler asks for a poll right away after any activity:
+        # the client must still wait for each reply before sending again
+        up = os.urandom(10000)
+        requests = self.upload(up, lambda n: 0.02, 0.5)
+        self.assertLessEqual(requests, self.client.seqnumber)
+
+    def testIdleBackOff(self):
+        self.upload(b"x", lambda n: 0.02)
+        before = self.requests
+        start = monotonic()
+        self.loop(lambda: monotonic() - start > 1.5, lambda n: 0.02)
+        # 0.1 + 0.2 + 0.4 + 0.4 ... seconds between polls once idle
+        self.assertLessEqual(self.requests - before, 6)
+
+
+class HandshakeTest(unittest.TestCase):
+
+    TAG = "0x1010"
+
+    def client(self, window=1, compression=0, cipher=0, extensions=False):
+        return ClientWorker("secret", 5, 200, self.TAG, "io", "http", Queue(), None, window, 3, None, compression, False, cipher, extensions)
+
+    # Init packet of a client without session negotiation: just the overlay tag
+    def baselineInitPacket(self):
+        p = Packet()
+        p.seq_number = 1
+        p.flags = Flags.SYNC
+        p.optional_headers = True
+        p.sync_type = Sync.REQUEST_AUTH
+        p.content = Core.tagToBytes(self.TAG)
+        p.data_len = len(p.content)
+        return p.toBytes()
+
+    def testDefaultClientKeepsBaselineHandshake(self):
+        self.assertEqual(self.client().generateInitPacket().toBytes(), self.baselineInitPacket())
+        self.assertEqual(self.client(window=0).generateInitPacket().toBytes(), self.baselineInitPacket())
+
+    def testExtensionsOnlyWhenRequested(self):
+        tag = len(Core.tagToBytes(self.TAG))
+        self.assertEqual(len(self.client(window=8).generateInitPacket().content), tag + 1)
+        self.assertEqual(len(self.client(compression=1).generateInitPacket().content), tag + 2)
+        self.assertEqual(len(self.client(window=0, compression=1).generateInitPacket().content), tag)
+        self.assertEqual(self.client(extensions=True).generateInitPacket().content[tag:], bytes([1]))
+        self.assertEqual(len(self.client(window=0, extensions=True).generateInitPacket().content), tag)
+
+    def testPollsWhileServerHasChunksQueued(self):
+        client = self.client(extensions=True)
+        client.sid = 5
+        client.st = Status.WORKING
+        client.extended = True
+        for pending, requests in ((3, 1), (0, 0)):
+            reply = Packet()
+            reply.session_id = 5
+            reply.seq_number = 2
+            reply.ack = 1
+            reply.pending = pending
+            self.assertEqual(len(client.doWork(PacketView(reply.toBytes()))), requests)
+            self.assertEqual(client.wait_reply, bool(requests))
+
+    def testServerReportsQueuedChunks(self):
+        last = Packet()
+        last.session_id = 5
+        last.seq_number = 1
+        last.ack = 1
+        # Only sessions negotiated with the extension byte get the hint
+        for window, pending in ((None, [0, 0, 0, 0]), (1, [3, 2, 1, 0])):
+            worker = ServerWorker(SinkOverlay(), 1, Queue(), 5, 100, None, "secret", 5, last, window)
+            worker.storeOverlayContent(b"x" * 350)
+            self.assertEqual([worker.makeTransferPacket(last).pending for _ in range(4)], pending)
+
+    def testMetricsReportNegotiatedCompression(self):
+        client = self.client(window=8, compression=0x61)
+        self.assertEqual(client.metrics()["compression"], 0)
+        client.setCompression(0x61)
+        self.assertEqual(client.metrics()["compression"], 0x61)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import tempfile
+from queue import Queue
+from sotp.cluster import Cluster
+from utils.messaging import Message, MessageType
+
+
+class FakeWrapper(object):
+    name = "http"
+    id = 3
+
+    def __init__(self):
+        self.inbox = Queue()
+
+
+class ClusterTest(unittest.TestCase):
+
+    def testSessionIDsOwnedByIndex(self):
+        clusters = [Cluster(index, 3, "/tmp") for index in range(3)]
+        for cluster in clusters:
+            for _ in range(100):
+                sid = cluster.newSessionID(255)
+                self.assertTrue(0 < sid <= 255)
+                self.assertTrue(cluster.owns(sid))
+                self.assertEqual(sum(other.owns(sid) for other in clusters), 1)
+
+    def testForwardAndReply(self):
+        with tempfile.TemporaryDirectory() as directory:
+            owner = Cluster(1, 2, directory)
+            inbox = Queue()
+            owner.start(inbox, None)
+            forwarder = Cluster(0, 2, directory)
+            wrapper = FakeWrapper()
+            wrapServerQ = Queue()
+            forwarder.forward(Message("http", 3, "router", 0, MessageType.STREAM, b"\x05request", wrapServerQ), 5, wrapper)
+            forwarded = inbox.get(True, 2)
+            self.assertEqual(forwarded.content, b"\x05request")
+            self.assertEqual(forwarded.sender_id, wrapper.id)
+            forwarded.wrapServerQ.put(b"\x05reply")
+            reply = wrapper.inbox.get(True, 2)
+            self.assertEqual(reply.content, b"\x05reply")
+            self.assertIs(reply.wrapServerQ, wrapServerQ)
+            # A packet the owner declines comes back as an error for the wrap module
+            forwarder.forward(Message("http", 3, "router", 0, MessageType.STREAM, b"\x05noise", wrapServerQ), 5, wrapper)
+            inbox.get(True, 2).wrapServerQ.decline()
+            reply = wrapper.inbox.get(True, 2)
+            self.assertTrue(reply.isErrorMessage())
+            self.assertIs(reply.wrapServerQ, wrapServerQ)
+
+
+if __name__ == '__main__':
+    unittest.main()
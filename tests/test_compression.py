@@ -0,0 +1,78 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from utils.compression import Compressor
+from sotp.core import Core
+from sotp.packet import Packet
+from sotp.router import Router
+
+
+class CompressorTest(unittest.TestCase):
+
+    TEXT = b"GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n" * 50
+
+    def testRoundTrip(self):
+        for name in ("zlib", "lzma"):
+            compressor = Compressor(Compressor.toCode(name, 6))
+            packed = compressor.compress(self.TEXT)
+            self.assertEqual(packed[0], Compressor.METHODS[name])
+            self.assertLess(len(packed), len(self.TEXT) // 4)
+            self.assertEqual(compressor.decompress(packed), self.TEXT)
+
+    def testSmallMessagesSentRaw(self):
+        compressor = Compressor(Compressor.toCode("zlib", 6))
+        self.assertEqual(compressor.compress(b"ls\n"), b"\x00ls\n")
+
+    def testIncompressibleDataBacksOff(self):
+        compressor = Compressor(Compressor.toCode("zlib", 6))
+        noise = os.urandom(1000)
+        self.assertEqual(compressor.compress(noise), b"\x00" + noise)
+        self.assertEqual(compressor.skip, 1)
+        # Skipped even if it would compress, then tried again
+        self.assertEqual(compressor.compress(self.TEXT)[0], Compressor.NONE)
+        self.assertEqual(compressor.compress(self.TEXT)[0], Compressor.ZLIB)
+        for _ in range(10):
+            compressor.compress(noise)
+            while compressor.skip:
+                compressor.compress(noise)
+        self.assertEqual(compressor.backoff, Compressor.MAX_SKIP)
+
+    def testCodes(self):
+        self.assertEqual(Compressor.toCode("none", 6), 0)
+        self.assertEqual(Compressor.toCode("lzma", 9), 0x92)
+        self.assertTrue(Compressor.validCode(0x61))
+        self.assertFalse(Compressor.validCode(0x63))
+        self.assertFalse(Compressor.validCode(0xa1))
+        self.assertRaises(Exception, Compressor, 0x05)
+
+
+    def testNegotiation(self):
+        router = Router("secret", None)
+        tag = Core.tagToBytes("0x1010")
+        for requested, granted in ((b"", 0), (b"\x61", 0x61), (b"\x0f", 0)):
+            req = Packet()
+            req.content = tag + b"\x04" + requested
+            self.assertEqual(router.negotiateCompression(req, 4), granted)
+        self.assertEqual(router.negotiateCompression(req, None), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from sotp.core import Core
+from sotp.packet import Packet, PacketView, Flags
+from utils.compression import Compressor
+
+
+class ChunkedMessageTest(unittest.TestCase):
+
+    KEY = "secret"
+
+    def session(self, compression=0):
+        core = Core(self.KEY, 5, 100)
+        core.setCompression(compression)
+        return core
+
+    # Sends 'message' from 'sender' in chunks, returns what 'receiver' delivers for each one
+    def transfer(self, sender, receiver, message):
+        sender.storeOverlayContent(message)
+        delivered = []
+        push = False
+        while not push:
+            chunk, push = sender.bufOverlay.getChunk()
+            p = Packet()
+            p.session_id = 1
+            p.seq_number = len(delivered) + 2
+            p.content = bytes(chunk)
+            p.data_len = len(p.content)
+            p.flags = Flags.PUSH if push else 0
+            delivered.append(receiver.readWrapperData(PacketView(p.toBytes())))
+        return delivered
+
+    def testWholeMessageOnPush(self):
+        message = os.urandom(450)
+        delivered = self.transfer(self.session(), self.session(), message)
+        self.assertEqual(delivered[:-1], [None] * (len(delivered) - 1))
+        self.assertEqual(bytes(delivered[-1]), message)
+
+    def testStreamingDeliversEachChunk(self):
+        for compression in (0, Compressor.toCode("zlib", 6)):
+            message = os.urandom(200) + b"text " * 200
+            receiver = self.session(compression)
+            receiver.streaming = True
+            for _ in range(2):
+                delivered = self.transfer(self.session(compression), receiver, message)
+                self.assertGreater(len([data for data in delivered if data]), 1)
+                self.assertEqual(b"".join(bytes(data) for data in delivered if data), message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from queue import Queue, Empty
+from threading import Thread
+from time import sleep, monotonic
+from wrapper.server.wrap_server.dispatch import WrapperIndex, waitForReply
+
+
+class Reply(object):
+
+    def __init__(self, declined):
+        self.declined = declined
+
+    def isDeclineMessage(self):
+        return self.declined
+
+
+class WaitForReplyTest(unittest.TestCase):
+
+    def testFirstReplyWins(self):
+        q = Queue()
+        q.put(Reply(True))
+        reply = Reply(False)
+        q.put(reply)
+        self.assertIs(waitForReply(q, 3, 1), reply)
+
+    def testAllDeclined(self):
+        q = Queue()
+        Thread(target=lambda: (sleep(0.05), q.put(Reply(True)), q.put(Reply(True)))).start()
+        start = monotonic()
+        self.assertIsNone(waitForReply(q, 2, 3))
+        self.assertLess(monotonic() - start, 1)
+
+    def testTimeout(self):
+        q = Queue()
+        q.put(Reply(True))
+        self.assertRaises(Empty, waitForReply, q, 2, 0.1)
+
+
+class FakeWrapper(object):
+
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = keys
+
+    def matchKeys(self):
+        return self.keys
+
+
+class WrapperIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = WrapperIndex()
+        self.short = FakeWrapper("short", [("domain", "example.com")])
+        self.long = FakeWrapper("long", [("domain", "t.example.com"), ("uri", "/t")])
+        self.any = FakeWrapper("any", [])
+        for wrapper in (self.short, self.long, self.any):
+            self.index.add(wrapper)
+
+    def testExactKeys(self):
+        self.assertIs(self.index.find("uri", "/t"), self.long)
+        self.assertIsNone(self.index.find("uri", "/other"))
+        self.assertIsNone(self.index.find("header", "/t"))
+
+    def testLongestPrefixWins(self):
+        self.assertIs(self.index.findPrefix("domain", "t.example.com.abc"), self.long)
+        self.assertIs(self.index.findPrefix("domain", "example.com.abc"), self.short)
+        self.assertIsNone(self.index.findPrefix("domain", "other.org"))
+
+    def testUnmatchedGoToWrappersWithoutKeys(self):
+        self.assertEqual(self.index.receivers(self.long), [self.long])
+        self.assertEqual(self.index.receivers(None), [self.any])
+
+    def testRemove(self):
+        self.index.remove(self.long)
+        self.index.remove(self.any)
+        self.assertIsNone(self.index.find("uri", "/t"))
+        self.assertIsNone(self.index.findPrefix("domain", "t.example.com.abc"))
+        self.assertIs(self.index.findPrefix("domain", "example.com.abc"), self.short)
+        self.assertEqual(self.index.receivers(None), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from queue import Queue
+from struct import pack
+from sotp.packet import Packet, PacketView, MalformedPacket, Flags, MAX_PENDING
+from sotp.serverworker import ServerWorker
+from utils.messaging import Message, MessageType, SignalType
+
+
+class FakeOverlay(object):
+    name = "io"
+    id = 2
+    STREAMING = False
+
+    def __init__(self):
+        self.inbox = Queue()
+
+    def addWorker(self, worker):
+        pass
+
+
+class CodecTest(unittest.TestCase):
+
+    def packet(self, **fields):
+        p = Packet()
+        for name, value in fields.items():
+            setattr(p, name, value)
+        return p
+
+    def testHeaderLayout(self):
+        p = self.packet(session_id=5, seq_number=2, ack=1, data_len=3, flags=Flags.PUSH, content=b"abc")
+        self.assertEqual(p.toBytes(), b"\x05\x00\x02\x00\x01\x00\x03\x02abc")
+        sync = self.packet(seq_number=1, flags=Flags.SYNC, optional_headers=True, sync_type=3)
+        self.assertEqual(sync.toBytes(), b"\x00\x00\x01\x00\x00\x00\x00\x01\x03")
+
+    def testRoundTrip(self):
+        packets = [
+            self.packet(session_id=200, seq_number=65535, ack=65534, data_len=4, content=b"data"),
+            self.packet(session_id=1, seq_number=7, flags=Flags.SYNC, optional_headers=True, sync_type=2),
+            self.packet(session_id=9, seq_number=3, ack=2, flags=Flags.PUSH, sack=(2, [(4, 5), (8, 8)]), pending=300),
+        ]
+        for p in packets:
+            view = PacketView(p.toBytes())
+            for field in ("session_id", "seq_number", "ack", "data_len", "flags", "optional_headers", "sync_type"):
+                self.assertEqual(getattr(view, field), getattr(p, field), field)
+            self.assertEqual(bytes(view.content), p.content)
+        self.assertEqual(view.sack, (2, [(4, 5), (8, 8)]))
+        self.assertEqual(view.pending, MAX_PENDING)
+
+
+class PacketViewTest(unittest.TestCase):
+
+    def raw(self):
+        p = Packet()
+        p.session_id = 3
+        p.seq_number = 10
+        p.ack = 9
+        p.content = b"payload"
+        p.data_len = len(p.content)
+        return bytearray(p.toBytes())
+
+    def testContentSharesBuffer(self):
+        raw = self.raw()
+        view = PacketView(raw)
+        content = view.content
+        self.assertIsInstance(content, memoryview)
+        raw[-1:] = b"D"
+        self.assertEqual(bytes(content), b"payloaD")
+
+    def testHeaderDecodedOnAccess(self):
+        # Only the session ID is read until another field is needed
+        view = PacketView(pack('!BHHHB', 7, 2, 1, 0, 0x80))
+        self.assertEqual(view.session_id, 7)
+        with self.assertRaises(MalformedPacket):
+            view.seq_number
+
+    def testTooShort(self):
+        self.assertRaises(Exception, PacketView, b"\x01\x00")
+
+
+class MessagePacketTest(unittest.TestCase):
+
+    def testParsedOnce(self):
+        p = Packet()
+        p.session_id = 4
+        p.seq_number = 2
+        msg = Message("http", 1, "router", 0, MessageType.STREAM, p.toBytes())
+        view = msg.getPacket()
+        self.assertIsInstance(view, PacketView)
+        self.assertIs(msg.getPacket(), view)
+        self.assertEqual(view.seq_number, 2)
+
+
+class MalformedPacketTest(unittest.TestCase):
+
+    SID = 5
+    # Header only: SACK without its block, SYNC without SYNC_TYPE, MORE without its counter
+    TRUNCATED = {
+        "sack": pack('!BHHHB', SID, 2, 1, 0, 0x80),
+        "sync": pack('!BHHHB', SID, 2, 1, 0, 0x01),
+        "more": pack('!BHHHB', SID, 2, 1, 0, 0x40),
+    }
+
+    def setUp(self):
+        self.lastpkt = Packet()
+        self.lastpkt.session_id = self.SID
+        self.lastpkt.seq_number = 1
+        self.lastpkt.ack = 1
+        self.outbox = Queue()
+        self.worker = ServerWorker(FakeOverlay(), 1, self.outbox, 5, 100, None, "secret", self.SID, self.lastpkt)
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.inbox.put(Message("router", 0, "serverworker", 1, MessageType.SIGNAL, SignalType.TERMINATE))
+
+    def testDecodeRaises(self):
+        for raw in self.TRUNCATED.values():
+            with self.assertRaises(MalformedPacket):
+                PacketView(raw).validate()
+
+    def testWorkerAnswersAsLost(self):
+        # Every packet gets the last reply again, so the worker is still running after each one
+        for name, raw in self.TRUNCATED.items():
+            with self.subTest(packet=name):
+                wrapServerQ = Queue()
+                self.worker.inbox.put(Message("router", 1, "serverworker", 1, MessageType.STREAM, raw, wrapServerQ))
+                reply = self.outbox.get(True, 2)
+                self.assertEqual(reply.content, self.lastpkt.toBytes())
+                self.assertIs(reply.wrapServerQ, wrapServerQ)
+
+
+if __name__ == '__main__':
+    unittest.main()
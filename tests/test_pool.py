@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from queue import Queue, Empty
+from time import monotonic, sleep
+from sotp.pool import WorkerPool
+from sotp.cluster import Cluster
+
+
+class FakeWorker(object):
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.id = sid
+        self.exit = False
+        self.parked = None
+        self.handled = []
+        self.outbox = Queue()
+
+    def handleMessage(self, msg):
+        self.handled.append(("inbox", msg))
+
+    def handleData(self, data):
+        self.handled.append(("data", data))
+
+    def answerParkedPoll(self):
+        self.parked = None
+        return "reply"
+
+
+class ShardTest(unittest.TestCase):
+
+    def testMessagesHandledInOrder(self):
+        pool = WorkerPool(2, None)
+        worker = FakeWorker(3)
+        inbox, datainbox = pool.workerInboxes(worker)
+        for n in range(50):
+            (inbox if n % 3 else datainbox).put(n)
+        start = monotonic()
+        while len(worker.handled) < 50 and monotonic() - start < 2:
+            sleep(0.01)
+        self.assertEqual([msg for _, msg in worker.handled], list(range(50)))
+        self.assertEqual([box for box, _ in worker.handled[:4]], ["data", "inbox", "inbox", "data"])
+
+    def testParkedPollAnsweredAtDeadline(self):
+        pool = WorkerPool(1, None)
+        worker = FakeWorker(1)
+        inbox, _ = pool.workerInboxes(worker)
+        worker.parked = (None, None, monotonic() + 0.2)
+        start = monotonic()
+        inbox.put("poll")
+        self.assertEqual(worker.outbox.get(True, 2), "reply")
+        self.assertGreaterEqual(monotonic() - start, 0.15)
+        # A worker that stops is not answered
+        worker.parked = (None, None, monotonic() + 0.1)
+        worker.exit = True
+        inbox.put("terminate")
+        self.assertRaises(Empty, worker.outbox.get, True, 0.4)
+
+    def testSessionsSpreadOverShards(self):
+        pool = WorkerPool(4, None)
+        used = {pool.shard(FakeWorker(sid)) for sid in range(1, 100)}
+        self.assertEqual(len(used), 4)
+
+    def testClusterProcessUsesEveryShard(self):
+        # Process 1 of 2 only gets odd session IDs
+        cluster = Cluster(1, 2, "/tmp")
+        pool = WorkerPool(4, None, cluster.size)
+        used = {pool.shard(FakeWorker(cluster.newSessionID(65535))) for _ in range(200)}
+        self.assertEqual(len(used), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
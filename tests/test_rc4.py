@@ -0,0 +1,128 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+from threading import Thread
+from unittest.mock import patch
+from utils.rc4 import RC4, KeystreamCache, keystreamCache
+
+
+# Plain RC4 keystream, byte by byte
+def reference(key, length):
+    S = RC4(key).S.copy()
+    out = bytearray()
+    x = y = 0
+    for _ in range(length):
+        x = (x + 1) & 0xff
+        y = (S[x] + y) & 0xff
+        S[x], S[y] = S[y], S[x]
+        out.append(S[(S[x] + S[y]) & 0xff])
+    return bytes(out)
+
+
+def xor(data, keystream):
+    return bytes(a ^ b for a, b in zip(data, keystream))
+
+
+class RC4Test(unittest.TestCase):
+
+    KEY = b"secret"
+
+    def testNonStreamingRestartsKeystream(self):
+        data = os.urandom(5000)
+        cipher = RC4(self.KEY, False)
+        expected = xor(data, reference(self.KEY, len(data)))
+        self.assertEqual(cipher.crypt(data), expected)
+        self.assertEqual(cipher.crypt(data), expected)
+        self.assertEqual(RC4(self.KEY, False).crypt(expected), data)
+
+    def testStreamingContinuesKeystream(self):
+        # Pieces of every size, past the part of the stream kept in the shared cache
+        data = os.urandom(20000)
+        sizes = [1, 10, 4095, 4097, 3000, 7000, 1797]
+        saved = keystreamCache.maxsize
+        keystreamCache.maxsize = 6000
+        try:
+            cipher = RC4(self.KEY)
+            out = b""
+            offset = 0
+            for size in sizes:
+                out += cipher.crypt(data[offset:offset+size])
+                offset += size
+        finally:
+            keystreamCache.maxsize = saved
+        self.assertEqual(out, xor(data, reference(self.KEY, len(data))))
+
+    def testIntegerXor(self):
+        data = os.urandom(1000)
+        keystream = os.urandom(1500)
+        with patch("utils.rc4.numpy", None):
+            self.assertEqual(RC4.xor(data, keystream), xor(data, keystream))
+        self.assertEqual(RC4.xor(data, keystream), xor(data, keystream))
+        self.assertEqual(RC4.xor(b"", keystream), b"")
+
+
+class KeystreamCacheTest(unittest.TestCase):
+
+    def testPrefixesMatchRC4(self):
+        cache = KeystreamCache(1 << 20)
+        key = b"secret"
+        S = RC4(key).S
+        expected = reference(key, 10000)
+        for length in (10, 5000, 100, 10000):
+            self.assertEqual(bytes(cache.get(key, S, length)[:length]), expected[:length])
+
+    def testLongMessageKeepsCachedKeys(self):
+        cache = KeystreamCache(3 * RC4.BLOCK)
+        keys = [b"one", b"two"]
+        for key in keys:
+            cache.get(key, RC4(key).S, 100)
+        big = b"big"
+        self.assertEqual(bytes(cache.get(big, RC4(big).S, 5 * RC4.BLOCK)[:50]), reference(big, 50))
+        self.assertEqual(list(cache.entries), keys)
+        self.assertEqual(cache.size, 2 * RC4.BLOCK)
+
+    def testLeastRecentlyUsedIsDropped(self):
+        cache = KeystreamCache(2 * RC4.BLOCK)
+        for key in (b"a", b"b", b"a", b"c"):
+            cache.get(key, RC4(key).S, 10)
+        self.assertEqual(list(cache.entries), [b"a", b"c"])
+
+    def testConcurrentGrowth(self):
+        cache = KeystreamCache(1 << 20)
+        key = os.urandom(16)
+        S = RC4(key).S
+        expected = reference(key, 20000)
+        results = []
+
+        def grow(lengths):
+            for length in lengths:
+                results.append(bytes(cache.get(key, S, length)[:length]) == expected[:length])
+        threads = [Thread(target=grow, args=(range(1000 * n, 20000, 3000),)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(results))
+        self.assertEqual(cache.size, len(cache.entries[key][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from queue import Queue
+from sotp.router import Router
+from sotp.packet import Packet
+from utils.messaging import Message, MessageType
+
+
+class FakeModule(object):
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+        self.inbox = Queue()
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = Router("secret", None)
+        self.wrapper = FakeModule("http", 1)
+        self.worker = FakeModule("ServerWorker 1", 1)
+        self.router.addWrapModule(self.wrapper)
+        self.router.workers.append(self.worker)
+        self.router.addRoute(7, self.worker, self.wrapper, None)
+
+    def packet(self, sid):
+        p = Packet()
+        p.session_id = sid
+        p.seq_number = 2
+        p.ack = 1
+        return p.toBytes()
+
+    def testMessagesFollowTheirRoute(self):
+        self.router.handleMessage(Message("http", 1, "router", 0, MessageType.STREAM, self.packet(7)))
+        self.assertEqual(self.worker.inbox.get_nowait().content, self.packet(7))
+        self.router.handleMessage(Message("serverworker", 1, "router", 0, MessageType.STREAM, self.packet(7)))
+        self.assertEqual(self.wrapper.inbox.get_nowait().content, self.packet(7))
+
+    def testUnknownSessionGetsError(self):
+        wrapServerQ = Queue()
+        self.router.handleMessage(Message("http", 1, "router", 0, MessageType.STREAM, self.packet(8), wrapServerQ))
+        reply = self.wrapper.inbox.get_nowait()
+        self.assertTrue(reply.isErrorMessage())
+        self.assertIs(reply.wrapServerQ, wrapServerQ)
+        self.assertTrue(self.worker.inbox.empty())
+
+    def testSessionIDsInUse(self):
+        self.router.pendingInit[9] = {}
+        self.assertTrue(self.router.sessionAlreadyExists(7))
+        self.assertTrue(self.router.sessionAlreadyExists(9))
+        self.assertFalse(self.router.sessionAlreadyExists(10))
+        self.assertEqual(self.router.removeRoute(7).worker, self.worker)
+        self.assertFalse(self.router.sessionAlreadyExists(7))
+        self.assertEqual(self.router.workers, [])
+        self.assertTrue(self.worker.inbox.get_nowait().isTerminateMessage())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from sotp.scheduler import PollScheduler, AdaptivePollScheduler, getPollScheduler
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def testFixedIgnoresActivity(self):
+        poller = getPollScheduler("fixed")(5, 30)
+        poller.activity()
+        self.assertEqual(poller.current(), 5)
+        poller.idle()
+        self.assertEqual(poller.current(), 5)
+
+    def testAdaptiveBacksOffWhileIdle(self):
+        poller = getPollScheduler("adaptive")(5, 1)
+        self.assertEqual(poller.current(), AdaptivePollScheduler.MIN_DELAY)
+        poller.activity()
+        self.assertEqual(poller.current(), 0)
+        delays = []
+        for _ in range(6):
+            poller.idle()
+            delays.append(poller.current())
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1, 1])
+
+    def testUnknownMode(self):
+        self.assertIs(getPollScheduler("fixed"), PollScheduler)
+        self.assertRaises(Exception, getPollScheduler, "burst")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from queue import Queue
+from time import monotonic, sleep
+from sotp.packet import Packet, PacketView
+from sotp.core import Sync, Flags, Sizes
+from sotp.router import Router
+from sotp.serverworker import ServerWorker
+from utils.messaging import Message, MessageType, SignalType
+
+
+class FakeOverlay(object):
+    name = "io"
+    id = 2
+    STREAMING = False
+
+    def __init__(self):
+        self.inbox = Queue()
+
+    def addWorker(self, worker):
+        pass
+
+
+class FakeWrapper(object):
+    long_poll = 10
+
+
+class LongPollTest(unittest.TestCase):
+
+    SID = 5
+    HOLD = 1
+
+    def setUp(self):
+        lastpkt = Packet()
+        lastpkt.session_id = self.SID
+        lastpkt.seq_number = 1
+        lastpkt.ack = 1
+        self.outbox = Queue()
+        self.worker = ServerWorker(FakeOverlay(), 1, self.outbox, 5, 100, None, "secret", self.SID, lastpkt, 4, self.HOLD)
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.inbox.put(Message("router", 0, "serverworker", 1, MessageType.SIGNAL, SignalType.TERMINATE))
+
+    def poll(self, seq):
+        p = Packet()
+        p.session_id = self.SID
+        p.seq_number = seq
+        p.ack = 1
+        p.flags = Flags.SYNC
+        p.optional_headers = True
+        p.sync_type = Sync.POLLING_REQUEST
+        self.worker.inbox.put(Message("router", 1, "serverworker", 1, MessageType.STREAM, p.toBytes(), Queue()))
+
+    def testIdlePollIsHeld(self):
+        start = monotonic()
+        self.poll(2)
+        reply = PacketView(self.outbox.get(True, 3 * self.HOLD).content)
+        self.assertGreaterEqual(monotonic() - start, self.HOLD * 0.9)
+        self.assertEqual(reply.ack, 2)
+        self.assertFalse(reply.anyContentAvailable())
+
+    def testDataAnswersHeldPoll(self):
+        start = monotonic()
+        self.poll(2)
+        sleep(0.1)
+        self.worker.datainbox.put(Message("io", 2, "datathread", 1, MessageType.STREAM, b"hello"))
+        reply = PacketView(self.outbox.get(True, 3 * self.HOLD).content)
+        self.assertLess(monotonic() - start, self.HOLD)
+        self.assertEqual(reply.ack, 2)
+        self.assertEqual(reply.data_len, 5)
+
+    def testHoldOnlyInWindowMode(self):
+        router = Router("secret", None)
+        self.assertEqual(router.negotiateHold(None, FakeWrapper()), 0)
+        self.assertEqual(router.negotiateHold(1, FakeWrapper()), 0)
+        self.assertEqual(router.negotiateHold(4, FakeWrapper()), min(FakeWrapper.long_poll, Sizes.MAX_HOLD))
+
+
+
+class BackpressureTest(unittest.TestCase):
+
+    def testOverlayPausedAndResumed(self):
+        lastpkt = Packet()
+        lastpkt.session_id = 5
+        lastpkt.seq_number = 1
+        lastpkt.ack = 1
+        overlay = FakeOverlay()
+        worker = ServerWorker(overlay, 1, Queue(), 5, 100, None, "secret", 5, lastpkt)
+        worker.bufOverlay.HIGH_WATERMARK = 1000
+        worker.bufOverlay.LOW_WATERMARK = 300
+        for _ in range(3):
+            worker.storeData(Message("io", 2, "datathread", 1, MessageType.STREAM, bytes(500)))
+        self.assertTrue(overlay.inbox.get_nowait().isPauseMessage())
+        self.assertTrue(overlay.inbox.empty())
+        while worker.bufOverlay.size > 300:
+            worker.makeTransferPacket(lastpkt)
+        self.assertTrue(overlay.inbox.get_nowait().isResumeMessage())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from sotp.packet import Packet
+from sotp.window import RetransmitTimer, RetransmitQueue, ReorderBuffer, ReplyCache
+
+
+def packet(seq):
+    p = Packet()
+    p.seq_number = seq
+    return p
+
+
+class ReorderBufferTest(unittest.TestCase):
+
+    def testOutOfOrderPacketsWaitForTheGap(self):
+        buf = ReorderBuffer(1)
+        for seq in (3, 4):
+            buf.add(packet(seq))
+        self.assertEqual(list(buf.drain()), [])
+        self.assertEqual(buf.last, 1)
+        buf.add(packet(2))
+        self.assertEqual([p.seq_number for p in buf.drain()], [2, 3, 4])
+        self.assertEqual(buf.last, 4)
+
+    def testDuplicatesAndWindow(self):
+        buf = ReorderBuffer(5)
+        buf.add(packet(7))
+        self.assertTrue(buf.isDuplicate(5))
+        self.assertTrue(buf.isDuplicate(7))
+        self.assertFalse(buf.isDuplicate(6))
+        self.assertTrue(buf.inWindow(9, 4))
+        self.assertFalse(buf.inWindow(10, 4))
+        buf.reset(0)
+        self.assertFalse(buf.isDuplicate(7))
+
+
+class RetransmitQueueTest(unittest.TestCase):
+
+    def testConfirmTakesRTTSample(self):
+        queue = RetransmitQueue()
+        queue.add(packet(1))
+        queue.add(packet(2))
+        queue.add(packet(2))
+        self.assertEqual(len(queue), 2)
+        self.assertGreaterEqual(queue.confirm(1), 0)
+        # Sent twice: no sample (Karn's algorithm)
+        self.assertIsNone(queue.confirm(2))
+        self.assertIsNone(queue.confirm(3))
+        self.assertEqual(len(queue), 0)
+
+    def testHeldRequestsTimeOutLater(self):
+        queue = RetransmitQueue()
+        queue.add(packet(1))
+        queue.add(packet(2), hold=30)
+        self.assertEqual([p.seq_number for p in queue.expired(0)], [1])
+        self.assertIsNone(queue.confirm(2))
+
+
+class SackTest(unittest.TestCase):
+
+    def testBlockDescribesGaps(self):
+        buf = ReorderBuffer(2)
+        self.assertIsNone(buf.sack(4))
+        for seq in (4, 5, 7, 9, 10):
+            buf.add(packet(seq))
+        self.assertEqual(buf.sack(4), (2, [(4, 5), (7, 7), (9, 10)]))
+        self.assertEqual(buf.sack(2), (2, [(4, 5), (7, 7)]))
+
+    def testLostOnlyAboveThreshold(self):
+        queue = RetransmitQueue()
+        for seq in range(1, 7):
+            queue.add(packet(seq))
+        # 2 is missing with 3, 4 and 5 received above it; 6 has nothing above
+        self.assertEqual([p.seq_number for p in queue.lost((1, [(3, 5)]))], [2])
+        # Reported once, later losses are left to the timeout
+        self.assertEqual(queue.lost((1, [(3, 5)])), [])
+        self.assertEqual(queue.lost((1, [(3, 3)]), threshold=1), [])
+
+    def testSackedRepliesArePruned(self):
+        cache = ReplyCache()
+        for reqseq, seq in ((1, 10), (2, 11), (3, 12)):
+            cache.add(reqseq, packet(seq))
+        cache.prune(9, (9, [(11, 11)]))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+
+class ReplyCacheTest(unittest.TestCase):
+
+    def testRetransmittedRequestGetsSameReply(self):
+        cache = ReplyCache()
+        cache.add(4, packet(10))
+        cache.add(5, packet(11))
+        self.assertEqual(cache.get(4).seq_number, 10)
+        cache.prune(10)
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(cache.get(5).seq_number, 11)
+
+
+class RetransmitTimerTest(unittest.TestCase):
+
+    def testStartsAtInitialTimeout(self):
+        self.assertEqual(RetransmitTimer(3).timeout(), 3)
+
+    def testFollowsFastLinks(self):
+        timer = RetransmitTimer(3)
+        for _ in range(50):
+            timer.sample(0.01)
+        self.assertEqual(timer.timeout(), RetransmitTimer.MIN_TIMEOUT)
+
+    def testSteadyLinkKeepsMargin(self):
+        timer = RetransmitTimer(3)
+        for _ in range(100):
+            timer.sample(0.5)
+        self.assertGreaterEqual(timer.timeout(), 1)
+        self.assertLess(timer.timeout(), 3)
+
+    def testBackoffUntilNextSample(self):
+        timer = RetransmitTimer(1)
+        timer.expired()
+        timer.expired()
+        self.assertEqual(timer.timeout(), 4)
+        for _ in range(10):
+            timer.expired()
+        self.assertEqual(timer.timeout(), RetransmitTimer.MAX_TIMEOUT)
+        timer.sample(0.1)
+        self.assertEqual(timer.timeout(), timer.rto)
+        self.assertLess(timer.timeout(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
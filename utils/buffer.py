@@ -17,46 +17,237 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
-class Index(object):
-    def __init__(self):
-        self.chunks = []
-    
-    def add(self, chunk):
-        self.chunks.append(chunk)
+from collections import deque
+from threading import Lock
+from tempfile import TemporaryFile
+from mmap import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
 
 
 class OverlayBuffer(object):
-    def __init__(self):
-        self.data = []
-    
-    def addIndex(self, index):
-        self.data.append(index)
+    '''
+    Encrypted overlay messages waiting to be sent. They are kept whole and
+    cut into chunks of 'chunksize' bytes, as memoryview slices, only when
+    a chunk is requested. Messages are added by the data thread while the
+    worker takes chunks, so both go through a lock.
+
+    When the bytes waiting go above HIGH_WATERMARK the buffer is congested
+    and the overlay should stop reading, until they go down to
+    LOW_WATERMARK and the buffer is drained again.
+    '''
+    HIGH_WATERMARK = 1048576
+    LOW_WATERMARK = 262144
+
+    def __init__(self, chunksize):
+        self.chunksize = chunksize
+        self.data = deque()
+        # Bytes of the first message already taken
+        self.offset = 0
+        # Chunks left in all the messages
+        self.chunks = 0
+        # Bytes left in all the messages
+        self.size = 0
+        self.throttled = False
+        self.lock = Lock()
+
+    def addMessage(self, message):
+        if not message:
+            return
+        view = memoryview(message)
+        with self.lock:
+            self.data.append(view)
+            self.chunks += -(-len(view) // self.chunksize)
+            self.size += len(view)
 
     def getChunk(self):
-        if not self.data:
-            raise Exception("There is no Index in OverlayBuffer")
-        if not self.data[0].chunks:
-            raise Exception("There is no Chunk in OverlayBuffer")
-        chunk = self.data[0].chunks.pop(0)
-        if not self.data[0].chunks:
-            self.data.pop(0)
+        with self.lock:
+            if not self.data:
+                raise Exception("There is no Chunk in OverlayBuffer")
+            message = self.data[0]
+            chunk = message[self.offset:self.offset + self.chunksize]
+            self.offset += len(chunk)
+            self.chunks -= 1
+            self.size -= len(chunk)
+            if self.offset < len(message):
+                return chunk,False
+            self.release(self.data.popleft())
+            self.offset = 0
             return chunk,True
-        return chunk,False
 
-    def anyIndex(self):
+    # Called with the lock held when a message has been completely taken
+    def release(self, message):
+        pass
+
+    def anyMessage(self):
         return True if self.data else False
 
+    def pendingChunks(self):
+        return self.chunks
+
+    # True only once each time the buffer goes above the high watermark
+    def congested(self):
+        with self.lock:
+            if self.throttled or self.size <= self.HIGH_WATERMARK:
+                return False
+            self.throttled = True
+            return True
+
+    # True only once each time a congested buffer goes down to the low watermark
+    def drained(self):
+        with self.lock:
+            if not self.throttled or self.size > self.LOW_WATERMARK:
+                return False
+            self.throttled = False
+            return True
+
+
+class SpilledMessage(object):
+    '''
+    Message written to a SpillFile. Slicing it reads the bytes back.
+    '''
+    def __init__(self, spill, start, length):
+        self.spill = spill
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, part):
+        begin, end, _ = part.indices(self.length)
+        return self.spill.read(self.start + begin, self.start + end)
+
+
+class SpillFile(object):
+    '''
+    Temporary file where messages are appended and read back in order
+    through a memory map. Only a window of MAP_WINDOW bytes is mapped at a
+    time. The file is emptied each time every message in it is taken, and
+    compacted once the taken messages at its start are larger than both
+    MAP_WINDOW and the ones still waiting, so its size follows the bytes
+    waiting and not the bytes transferred.
+    '''
+    MAP_WINDOW = 4194304
+
+    def __init__(self):
+        self.file = None
+        self.map = None
+        # File offset of the mapped window
+        self.base = 0
+        # Bytes written, and bytes of the messages not taken yet
+        self.end = 0
+        self.used = 0
+        # Bytes removed from the start of the file by compact(). Messages keep
+        # their position in the whole stream, this is subtracted to read them.
+        self.shift = 0
+
+    def write(self, data):
+        if self.file is None:
+            self.file = TemporaryFile()
+        self.file.seek(self.end)
+        self.file.write(data)
+        start = self.shift + self.end
+        self.end += len(data)
+        self.used += len(data)
+        return SpilledMessage(self, start, len(data))
+
+    def read(self, start, end):
+        start -= self.shift
+        end -= self.shift
+        if self.map is None or start < self.base or end > self.base + len(self.map):
+            self.unmap()
+            self.file.flush()
+            self.base = start - start % ALLOCATIONGRANULARITY
+            length = max(end, min(self.base + self.MAP_WINDOW, self.end)) - self.base
+            self.map = mmap(self.file.fileno(), length, access=ACCESS_READ, offset=self.base)
+        return self.map[start - self.base:end - self.base]
+
+    def release(self, length):
+        self.used -= length
+        if not self.used:
+            self.unmap()
+            self.file.truncate(0)
+            self.shift += self.end
+            self.end = 0
+        elif self.end - self.used >= max(self.MAP_WINDOW, self.used):
+            self.compact()
+
+    # Moves the messages not taken yet to the start of the file. They are never
+    # larger than the taken ones they replace, so both ranges do not overlap.
+    def compact(self):
+        self.unmap()
+        head = self.end - self.used
+        moved = 0
+        while moved < self.used:
+            self.file.seek(head + moved)
+            block = self.file.read(min(self.MAP_WINDOW, self.used - moved))
+            self.file.seek(moved)
+            self.file.write(block)
+            moved += len(block)
+        self.file.truncate(self.used)
+        self.shift += head
+        self.end = self.used
+
+    def unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class SpillingOverlayBuffer(OverlayBuffer):
+    '''
+    OverlayBuffer that keeps up to 'memory' bytes of messages in memory and
+    writes the messages that do not fit to a SpillFile, so very large
+    transfers do not grow the process memory. As the data waits on disk,
+    the overlay is paused later: above DISK_RATIO times 'memory' and until
+    the bytes waiting go down to 'memory'.
+    '''
+    DISK_RATIO = 4
+
+    def __init__(self, chunksize, memory):
+        OverlayBuffer.__init__(self, chunksize)
+        self.memory = memory
+        self.HIGH_WATERMARK = max(OverlayBuffer.HIGH_WATERMARK, self.DISK_RATIO * memory)
+        self.LOW_WATERMARK = max(OverlayBuffer.LOW_WATERMARK, memory)
+        # Bytes of the messages kept in memory
+        self.resident = 0
+        self.spill = SpillFile()
+
+    def addMessage(self, message):
+        if not message:
+            return
+        with self.lock:
+            if self.resident + len(message) <= self.memory:
+                entry = memoryview(message)
+                self.resident += len(entry)
+            else:
+                entry = self.spill.write(message)
+            self.data.append(entry)
+            self.chunks += -(-len(entry) // self.chunksize)
+            self.size += len(entry)
+
+    def release(self, message):
+        if isinstance(message, SpilledMessage):
+            self.spill.release(len(message))
+        else:
+            self.resident -= len(message)
+
 
 class WrapperBuffer(object):
+    '''
+    Payload of the message being received. Only the bytes of each chunk
+    are kept, so packets are released as soon as they are added. The
+    bytearray grows as the chunks arrive, the sender does not tell how
+    big the whole message is.
+    '''
     def __init__(self):
-        self.data = Index()
-    
+        self.data = bytearray()
+
     def addChunk(self, chunk):
-        self.data.add(chunk)
+        self.data += chunk
 
-    def getChunks(self):
-        if not self.data.chunks:
+    def getData(self):
+        if not self.data:
             raise Exception("There is no Chunk in WrapperBuffer")
-        chunks = self.data.chunks
-        self.data = Index()
-        return chunks
\ No newline at end of file
+        data = self.data
+        self.data = bytearray()
+        return data
\ No newline at end of file
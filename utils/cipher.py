@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+from os import urandom
+from hashlib import sha256
+from utils.rc4 import RC4
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305, AESGCM
+except ImportError:
+    ChaCha20Poly1305 = AESGCM = None
+
+
+class Cipher(object):
+    '''
+    Encrypts each overlay message. Backends are selected by CODE in the
+    session negotiation and add OVERHEAD bytes to every message.
+    STREAMING backends can also decrypt a message in parts, as its chunks
+    arrive.
+    '''
+    NAME = None
+    CODE = None
+    OVERHEAD = 0
+    STREAMING = False
+
+    def __init__(self, key):
+        self.key = key
+
+    # OVERRIDE ME
+    def encrypt(self, data):
+        pass
+
+    # OVERRIDE ME
+    def decrypt(self, data):
+        pass
+
+    # OVERRIDE ME (STREAMING backends): object with a crypt() method for
+    # the successive parts of one message
+    def stream(self):
+        pass
+
+    @classmethod
+    def available(cls):
+        return True
+
+
+class RC4Cipher(Cipher):
+    NAME = "rc4"
+    CODE = 0
+    STREAMING = True
+
+    def __init__(self, key):
+        Cipher.__init__(self, key)
+        self.rc4 = RC4(key, False)
+
+    def encrypt(self, data):
+        return self.rc4.crypt(data)
+
+    def decrypt(self, data):
+        return self.rc4.crypt(data)
+
+    def stream(self):
+        return self.rc4.stream()
+
+
+class AEADCipher(Cipher):
+    '''
+    Authenticated encryption from the 'cryptography' package. The key is
+    the SHA-256 of the session key and every message carries a random
+    nonce before the ciphertext and its tag.
+    '''
+    NONCE = 12
+    TAG = 16
+    OVERHEAD = NONCE + TAG
+    ENGINE = None
+
+    def __init__(self, key):
+        Cipher.__init__(self, key)
+        self.aead = self.ENGINE(sha256(key).digest())
+
+    def encrypt(self, data):
+        nonce = urandom(self.NONCE)
+        return nonce + self.aead.encrypt(nonce, bytes(data), None)
+
+    def decrypt(self, data):
+        return self.aead.decrypt(bytes(data[:self.NONCE]), bytes(data[self.NONCE:]), None)
+
+    @classmethod
+    def available(cls):
+        return cls.ENGINE is not None
+
+
+class ChaCha20Cipher(AEADCipher):
+    NAME = "chacha20"
+    CODE = 1
+    ENGINE = ChaCha20Poly1305
+
+
+class AESGCMCipher(AEADCipher):
+    NAME = "aesgcm"
+    CODE = 2
+    ENGINE = AESGCM
+
+
+CIPHERS = [RC4Cipher, ChaCha20Cipher, AESGCMCipher]
+
+
+# Method that returns the backend class for a name or a negotiated code,
+# None if it is unknown or its dependencies are not installed
+def getCipher(selector):
+    for cipher in CIPHERS:
+        if selector in (cipher.NAME, cipher.CODE) and cipher.available():
+            return cipher
+    return None
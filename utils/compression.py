@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import zlib
+import lzma
+
+
+class Compressor(object):
+    '''
+    Compresses each overlay message before it is encrypted. Every message
+    starts with the method used for it, so messages that do not compress
+    well (already compressed data, tiny messages) are sent as they are.
+
+    The session negotiates one byte: method in the low nibble and level
+    in the high nibble.
+    '''
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    METHODS = {"none": NONE, "zlib": ZLIB, "lzma": LZMA}
+    # Messages whose compressed size is above this fraction are sent raw
+    MAX_RATIO = 0.9
+    # Messages shorter than this are always sent raw
+    MIN_SIZE = 16
+    # After a poor result compression is skipped for a number of messages,
+    # doubled on each poor result up to this value.
+    MAX_SKIP = 32
+
+    def __init__(self, code):
+        self.method = code & 0x0f
+        self.level = code >> 4
+        if self.method not in self.METHODS.values():
+            raise Exception(f"Invalid compression method {self.method}")
+        self.skip = 0
+        self.backoff = 0
+        self.saved = 0
+
+    @staticmethod
+    def toCode(name, level):
+        if Compressor.METHODS[name] == Compressor.NONE:
+            return 0
+        return Compressor.METHODS[name] | (level << 4)
+
+    # The code is valid if this end knows the method.
+    @staticmethod
+    def validCode(code):
+        return (code & 0x0f) in Compressor.METHODS.values() and (code >> 4) <= 9
+
+    def pack(self, data):
+        if self.method == self.ZLIB:
+            return zlib.compress(data, self.level)
+        return lzma.compress(data, preset=self.level)
+
+    def compress(self, data):
+        if self.method == self.NONE or len(data) < self.MIN_SIZE:
+            return bytes([self.NONE]) + data
+        if self.skip:
+            self.skip -= 1
+            return bytes([self.NONE]) + data
+        packed = self.pack(data)
+        if len(packed) > len(data) * self.MAX_RATIO:
+            self.backoff = min(max(1, self.backoff * 2), self.MAX_SKIP)
+            self.skip = self.backoff
+            return bytes([self.NONE]) + data
+        self.backoff = 0
+        self.saved += len(data) - len(packed)
+        return bytes([self.method]) + packed
+
+    def decompress(self, data):
+        if not data:
+            raise Exception("Compressed message without method")
+        method = data[0]
+        if method == self.NONE:
+            return data[1:]
+        if method == self.ZLIB:
+            return zlib.decompress(data[1:])
+        if method == self.LZMA:
+            return lzma.decompress(data[1:])
+        raise Exception(f"Invalid compression method {method}")
+
+    def decompressor(self):
+        return StreamDecompressor()
+
+
+class StreamDecompressor(object):
+    '''
+    Decompresses one message as its parts arrive. The first byte of the
+    message tells the method used.
+    '''
+    def __init__(self):
+        self.method = None
+        self.engine = None
+
+    def feed(self, data):
+        if not data:
+            return b''
+        if self.method is None:
+            self.method = data[0]
+            data = data[1:]
+            if self.method == Compressor.ZLIB:
+                self.engine = zlib.decompressobj()
+            elif self.method == Compressor.LZMA:
+                self.engine = lzma.LZMADecompressor()
+            elif self.method != Compressor.NONE:
+                raise Exception(f"Invalid compression method {self.method}")
+        if self.engine is None:
+            return bytes(data)
+        return self.engine.decompress(data)
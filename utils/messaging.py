@@ -36,6 +36,9 @@ class SignalType(Enum):
     COMMS_BROKEN = 5
     ERROR = 6
     BUFFER_READY = 7
+    PAUSE = 8
+    RESUME = 9
+    DECLINE = 10
 
 
 class Message():
@@ -58,6 +61,8 @@ class Message():
         self.msgtype = msgtype
         self.content = content
         self.wrapServerQ = wrapServerQ
+        # SOTP packet in content, decoded once by the first stage that reads it
+        self.packet = None
 
     def __eq__(self, other):
         return self.sender == other.sender and self.receiver == other.receiver and self.msgtype == other.msgtype and self.content == other.content
@@ -107,6 +112,34 @@ class Message():
             return True
         return False
 
+    def isErrorMessage(self):
+        if self.msgtype == MessageType.SIGNAL and self.content == SignalType.ERROR:
+            return True
+        return False
+
+    # A wrapper tells the wrap server that a request is not tunnel traffic
+    def isDeclineMessage(self):
+        if self.msgtype == MessageType.SIGNAL and self.content == SignalType.DECLINE:
+            return True
+        return False
+
+    def isPauseMessage(self):
+        if self.msgtype == MessageType.SIGNAL and self.content == SignalType.PAUSE:
+            return True
+        return False
+
+    def isResumeMessage(self):
+        if self.msgtype == MessageType.SIGNAL and self.content == SignalType.RESUME:
+            return True
+        return False
+
+    # Returns the SOTP packet carried by a stream message, shared by the Router,
+    # the worker and the debug output instead of parsing content at each stage.
+    def getPacket(self):
+        if self.packet is None:
+            self.packet = Core.transformToPacket(self.content)
+        return self.packet
+
     def isStreamMessage(self):
         return (self.msgtype == MessageType.STREAM)
 
@@ -120,14 +153,15 @@ class Message():
         if not self.isStreamMessage():
             return "Message is not a Stream Message"
         try:
-            p = Core.transformToPacket(self.content)
-            sid = p.session_id.uint
-            sq = p.seq_number.uint
-            ack = p.ack.uint
-            dl = p.data_len.uint
-            fl = p.flags.uint
+            p = self.getPacket()
+            sid = p.session_id
+            sq = p.seq_number
+            ack = p.ack
+            dl = p.data_len
+            fl = p.flags
             oh = p.optional_headers
-            st = p.sync_type.uint if fl == 1 else 0
-            return f"SID: {sid}, SQ: {sq}, ACK: {ack}, DL: {dl}, FL: {fl}, OH: {oh}, SYT: {st}"
+            st = p.sync_type if fl == 1 else 0
+            sack = f", SACK: {p.sack}" if p.sack else ""
+            return f"SID: {sid}, SQ: {sq}, ACK: {ack}, DL: {dl}, FL: {fl}, OH: {oh}, SYT: {st}{sack}"
         except Exception:
             return f"Message content is not a SOTP Packet {self.content}"
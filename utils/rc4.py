@@ -22,6 +22,17 @@
 # SOFTWARE.
 #
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from collections import OrderedDict
+from threading import Lock
+
+_STEPS = list(range(1, 0x100)) + [0]
+
+
 class RC4:
     """
     https://github.com/DavidBuchanan314/rc4
@@ -29,8 +40,15 @@ class RC4:
     This class implements the RC4 streaming cipher.
     
     Derived from http://cypherpunks.venona.com/archive/1994/09/msg00304.html
+
+    The keystream is generated in blocks into a bytearray and XORed with
+    the data as a whole, with NumPy when it is installed and with Python
+    big integers otherwise.
     """
 
+    # Keystream bytes generated at once in streaming mode
+    BLOCK = 4096
+
     def __init__(self, key, streaming=True):
         assert(isinstance(key, (bytes, bytearray)))
 
@@ -41,31 +59,187 @@ class RC4:
             j = (S[i] + key[i % len(key)] + j) & 0xff
             S[i], S[j] = S[j], S[i]
         self.S = S
+        self.key = bytes(key)
 
         # in streaming mode, we retain the keystream state between crypt()
-        # invocations
-        if streaming:
-            self.keystream = self._keystream_generator()
-        else:
-            self.keystream = None
+        # invocations, plus the generated bytes not used yet
+        self.streaming = streaming
+        self.state = [S.copy(), 0, 0]
+        self.pending = bytearray()
+        # Streaming position, and keystream offset reached by 'state'. The
+        # part of the stream that fits in the shared cache is taken from it.
+        self.position = 0
+        self.generated = 0
 
     def crypt(self, data):
         """
         Encrypts/decrypts data (It's the same thing!)
         """
         assert(isinstance(data, (bytes, bytearray)))
-        keystream = self.keystream or self._keystream_generator()
-        return bytes([a ^ b for a, b in zip(data, keystream)])
+        return self.xor(data, self.keystream(len(data)))
+
+    def keystream(self, length):
+        """
+        Returns the next 'length' bytes of keystream
+        """
+        if not self.streaming:
+            return keystreamCache.get(self.key, self.S, length)
+        start = self.position
+        self.position += length
+        if self.position <= keystreamCache.maxsize:
+            return keystreamCache.get(self.key, self.S, self.position)[start:self.position]
+        if self.generated < start:
+            self._generate(self.state, start - self.generated)
+            self.generated = start
+        if len(self.pending) < length:
+            missing = -(-(length - len(self.pending)) // self.BLOCK) * self.BLOCK
+            self.pending += self._generate(self.state, missing)
+            self.generated += missing
+        keystream = self.pending[:length]
+        del self.pending[:length]
+        return keystream
+
+    def stream(self):
+        """
+        Returns a streaming cipher with the same key, at the start of the keystream
+        """
+        stream = RC4.__new__(RC4)
+        stream.S = self.S
+        stream.key = self.key
+        stream.streaming = True
+        stream.state = [self.S.copy(), 0, 0]
+        stream.pending = bytearray()
+        stream.position = 0
+        stream.generated = 0
+        return stream
+
+    @staticmethod
+    def xor(data, keystream):
+        """
+        XOR of data with the first len(data) bytes of keystream
+        """
+        length = len(data)
+        if not length:
+            return b''
+        if numpy is not None:
+            return numpy.bitwise_xor(numpy.frombuffer(data, numpy.uint8),
+                                     numpy.frombuffer(keystream, numpy.uint8, length)).tobytes()
+        mixed = int.from_bytes(data, 'little') ^ int.from_bytes(keystream[:length], 'little')
+        return mixed.to_bytes(length, 'little')
 
-    def _keystream_generator(self):
+    @staticmethod
+    def _generate(state, length):
         """
-        Generator that returns the bytes of keystream
+        Generates 'length' bytes of keystream from 'state' ([S, x, y]) and
+        leaves it updated
         """
-        S = self.S.copy()
-        x = y = 0
-        while True:
-            x = (x + 1) & 0xff
-            y = (S[x] + y) & 0xff
-            S[x], S[y] = S[y], S[x]
-            i = (S[x] + S[y]) & 0xff
-            yield S[i]
\ No newline at end of file
+        S, x, y = state
+        out = bytearray(length)
+        if not length:
+            return out
+        # x just walks 1..255,0, so its values are laid out beforehand
+        xs = (_STEPS[x:] + _STEPS[:x]) * (-(-length // 0x100))
+        del xs[length:]
+        for n, x in enumerate(xs):
+            sx = S[x]
+            y = (sx + y) & 0xff
+            sy = S[y]
+            S[x] = sy
+            S[y] = sx
+            out[n] = S[(sx + sy) & 0xff]
+        state[1] = x
+        state[2] = y
+        return out
+
+
+class KeystreamCache(object):
+    """
+    Non-streaming ciphers restart the keystream on every crypt(), so its
+    prefix is the same for every message with the same key. It is kept
+    here, grown up to the longest message seen, for all the ciphers of
+    the process. Least recently used keys are dropped beyond 'maxsize'
+    bytes; a prefix larger than that is generated but not kept.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        # key -> (keystream, state to continue it)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, S, length):
+        with self.lock:
+            keystream, state = self.entries.get(key, (b'', None))
+            if keystream:
+                self.entries.move_to_end(key)
+        if len(keystream) >= length:
+            return keystream
+        # Generated without the lock, from a copy of the state so the cached
+        # one stays valid for its keystream
+        state = [S.copy(), 0, 0] if state is None else [state[0].copy(), state[1], state[2]]
+        missing = length - len(keystream)
+        # Prefixes are replaced, not extended, so callers can keep using the old ones
+        keystream = keystream + RC4._generate(state, -(-missing // RC4.BLOCK) * RC4.BLOCK)
+        if len(keystream) > self.maxsize:
+            return keystream
+        with self.lock:
+            cached, _ = self.entries.get(key, (b'', None))
+            # Another thread may have stored a longer prefix meanwhile
+            if len(cached) < len(keystream):
+                self.size += len(keystream) - len(cached)
+                self.entries[key] = (keystream, state)
+                self.entries.move_to_end(key)
+                while self.size > self.maxsize:
+                    _, (dropped, _) = self.entries.popitem(last=False)
+                    self.size -= len(dropped)
+        return keystream
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# Shared by every RC4 instance of the process, 16 MB by default
+keystreamCache = KeystreamCache(16 * 1024 * 1024)
+
+
+# Microbenchmark: python -m utils.rc4 [size in KB]
+if __name__ == "__main__":
+    from sys import argv
+    from os import urandom
+    from time import perf_counter
+
+    def reference(key, data):
+        S = RC4(key).S.copy()
+
+        def generator():
+            x = y = 0
+            while True:
+                x = (x + 1) & 0xff
+                y = (S[x] + y) & 0xff
+                S[x], S[y] = S[y], S[x]
+                yield S[(S[x] + S[y]) & 0xff]
+        return bytes([a ^ b for a, b in zip(data, generator())])
+
+    key = b"benchmark"
+    data = urandom(int(argv[1]) * 1024 if len(argv) > 1 else 1024 * 1024)
+    size = len(data) / (1024 * 1024)
+    start = perf_counter()
+    expected = reference(key, data)
+    before = perf_counter() - start
+    keystreamCache.maxsize = 0
+    start = perf_counter()
+    result = RC4(key, False).crypt(data)
+    after = perf_counter() - start
+    assert result == expected
+    keystreamCache.maxsize = 2 * len(data)
+    RC4(key, False).crypt(data)
+    start = perf_counter()
+    result = RC4(key, False).crypt(data)
+    cached = perf_counter() - start
+    assert result == expected
+    print(f"per byte:   {size / before:.2f} MB/s")
+    print(f"vectorised: {size / after:.2f} MB/s ({'numpy' if numpy is not None else 'int'} XOR)")
+    print(f"cached:     {size / cached:.2f} MB/s")
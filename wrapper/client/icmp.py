@@ -92,12 +92,56 @@ class icmp(ClientWrapper):
                             "default": [3],
                             "type":  int
                         },
+                        "--poll-mode": {
+                            "help": "Polling strategy when there is nothing to send: fixed polls every --poll-delay seconds, adaptive polls right away while data is flowing and backs off up to --max-poll-delay when idle. Default is adaptive",
+                            "nargs": 1,
+                            "default": ["adaptive"],
+                            "choices": ["fixed","adaptive"],
+                            "type": str
+                        },
+                        "--max-poll-delay": {
+                            "help": "Maximum time in seconds between pollings in adaptive mode. Default is 30",
+                            "nargs": 1,
+                            "default": [30],
+                            "type":  float
+                        },
                         "--response-timeout": {
-                            "help": "Waiting time in seconds for wrapper data.",
+                            "help": "Initial waiting time in seconds for wrapper data, then adapted to the measured round trip time.",
                             "nargs": 1,
                             "default": [2],
+                            "type":  float
+                        },
+                        "--window": {
+                            "help": "Number of SOTP packets that can be in flight at the same time. Session extensions are only negotiated above 1, with --extensions or with a compression or cipher, and 0 never negotiates them, for servers without session negotiation. Default is 1",
+                            "nargs": 1,
+                            "default": [1],
                             "type":  int
                         },
+                        "--extensions": {
+                            "help": "Negotiate the session extensions (pending chunk hints and SACK blocks) also with --window 1, so the client only polls right away while the server has data queued. Needs a server with session negotiation.",
+                            "action": "store_true"
+                        },
+                        "--compression": {
+                            "help": "Compression of the data before it is encrypted, only used if the server accepts it in the session negotiation (needs --window above 0). zlib suits interactive traffic, lzma bulk transfers. Default is none",
+                            "nargs": 1,
+                            "default": ["none"],
+                            "choices": ["none","zlib","lzma"],
+                            "type": str
+                        },
+                        "--compression-level": {
+                            "help": "Compression level, from 0 to 9. Default is 6",
+                            "nargs": 1,
+                            "default": [6],
+                            "choices": range(10),
+                            "type":  int
+                        },
+                        "--cipher": {
+                            "help": "Cipher for the data, only used if the server accepts it in the session negotiation (needs --window above 0). chacha20 (ChaCha20-Poly1305) and aesgcm (AES-GCM) need the cryptography package and add 28 bytes to every message. Default is rc4",
+                            "nargs": 1,
+                            "default": ["rc4"],
+                            "choices": ["rc4","chacha20","aesgcm"],
+                            "type": str
+                        },
                         "--max-retries": {
                             "help": "Maximum number of re-synchronization retries.",
                             "nargs": 1,
@@ -120,6 +164,8 @@ class icmp(ClientWrapper):
         # Base arguments
         self.max_size = None
         self.poll_delay = None
+        self.poll_mode = None
+        self.max_poll_delay = None
         self.response_timeout = None
         self.max_retries = None
         self.parseArguments(args)
@@ -146,8 +192,15 @@ class icmp(ClientWrapper):
         self.request_timeout = args.request_timeout[0]
         self.max_size = args.max_size[0]
         self.poll_delay = args.poll_delay[0]
+        self.poll_mode = args.poll_mode[0]
+        self.max_poll_delay = args.max_poll_delay[0]
         self.response_timeout = args.response_timeout[0]
         self.max_retries = args.max_retries[0]
+        self.window = args.window[0]
+        self.extensions = args.extensions
+        self.compression = args.compression[0]
+        self.compression_level = args.compression_level[0]
+        self.cipher = args.cipher[0]
         self.checkMaxProtoSize(self.max_size)
 
     def wrap(self,content):
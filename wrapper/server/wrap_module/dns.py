@@ -59,6 +59,12 @@ class dnswrapper(ServerWrapper):
                     "default": [37],
                     "type" :  int
                 },
+                "--max-window": {
+                    "help": "Maximum number of SOTP packets that a client can have in flight at the same time. Default is 16",
+                    "nargs": 1,
+                    "default": [16],
+                    "type":  int
+                },
                 "--max-retries": {
                     "help": "Maximum number of re-synchronization retries.",
                     "nargs": 1,
@@ -83,6 +89,7 @@ class dnswrapper(ServerWrapper):
         self.queries = parsed.queries
         self.max_size = parsed.max_size[0]
         self.max_retries = parsed.max_retries[0]
+        self.max_window = parsed.max_window[0]
         
 
     def extractFromSubdomain(self, qname):
@@ -117,6 +124,9 @@ class dnswrapper(ServerWrapper):
             self._LOGGING_ and self.logger.error(f"[{self.name}] parseQuestion() recieved a dns with invalid question type: {request.q.qtype}")
             return None
 
+    def matchKeys(self):
+        return [("domain", hostname) for hostname in self.domains]
+
     def inHostnameList(self, request):
         reqhostname = request.q.qname.idna()[:-1]
         for hostname in self.domains:
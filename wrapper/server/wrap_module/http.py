@@ -72,6 +72,18 @@ class httpwrapper(ServerWrapper):
                     "default": [10000],
                     "type":  int
                 },
+                "--max-window": {
+                    "help": "Maximum number of SOTP packets that a client can have in flight at the same time. Default is 16",
+                    "nargs": 1,
+                    "default": [16],
+                    "type":  int
+                },
+                "--long-poll": {
+                    "help": "Seconds that a polling request can be held until there is data to answer it (0 disables it). Only used with clients that negotiate a window above 1, it must be lower than the httpserver --timeout. Default is 0",
+                    "nargs": 1,
+                    "default": [0],
+                    "type":  int
+                },
                 "--max-retries": {
                     "help": "Maximum number of re-synchronization retries.",
                     "nargs": 1,
@@ -96,6 +108,8 @@ class httpwrapper(ServerWrapper):
         self.post_field = parsed.post_field[0] if parsed.post_field is not None else None
         self.max_size = parsed.max_size[0]
         self.max_retries = parsed.max_retries[0]
+        self.max_window = parsed.max_window[0]
+        self.long_poll = parsed.long_poll[0]
         self.success_code = parsed.success_code[0]
 
     def unpackSotp(self, data):
@@ -149,6 +163,15 @@ class httpwrapper(ServerWrapper):
             unwrapped = self.parsePOST(content)
         return unwrapped
 
+    # Same precedence as parsePOST: header, then POST field, then URI
+    def matchKeys(self):
+        if self.header:
+            return [("header", self.header)]
+        elif self.method == "POST" and self.post_field:
+            return [("field", self.post_field)]
+        else:
+            return [("uri", self.uri)]
+
     def generateResponse(self,content):
         return {
             "requestline" : "",
@@ -37,6 +37,12 @@ class icmpwrapper(ServerWrapper):
                             "default": [1024],
                             "type":  int
                         },
+                        "--max-window": {
+                            "help": "Maximum number of SOTP packets that a client can have in flight at the same time. Default is 16",
+                            "nargs": 1,
+                            "default": [16],
+                            "type":  int
+                        },
                         "--max-retries": {
                             "help": "Maximum number of re-synchronization retries.",
                             "nargs": 1,
@@ -63,6 +69,7 @@ class icmpwrapper(ServerWrapper):
         parsed = self.argparser.parse_args(args.split())
         self.max_size = parsed.max_size[0]
         self.max_retries = parsed.max_retries[0]
+        self.max_window = parsed.max_window[0]
 
     def unpackSotp(self, data):
         try:
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2020 Carlos Fernández Sánchez and Raúl Caro Teixidó.
+#
+# This file is part of Mística
+# (see https://github.com/IncideDigital/Mistica).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+from time import monotonic
+
+
+# Waits up to 'timeout' seconds for the reply of one of the 'receivers' wrappers
+# of a request. Returns None as soon as all of them have declined it, and raises
+# queue.Empty if the timeout expires.
+def waitForReply(q, receivers, timeout):
+    deadline = monotonic() + timeout
+    declined = 0
+    while declined < receivers:
+        reply = q.get(True, max(0, deadline - monotonic()))
+        if not reply.isDeclineMessage():
+            return reply
+        declined += 1
+    return None
+
+
+class WrapperIndex(object):
+    '''
+    Wrap modules of a wrap server by the (kind, value) match keys they
+    register with ServerWrapper.matchKeys(), so each request goes to the
+    one wrap module that reads it instead of to all of them. Wrap modules
+    without keys get the requests that no key matches.
+    '''
+    def __init__(self):
+        self.keys = {}
+        # Per kind, (value, wrap module) with the longest values first
+        self.prefixes = {}
+        self.catchall = []
+
+    def add(self, wrapper):
+        keys = wrapper.matchKeys()
+        if not keys:
+            self.catchall.append(wrapper)
+        for kind, value in keys:
+            self.keys[(kind, value)] = wrapper
+            entries = self.prefixes.setdefault(kind, [])
+            entries.append((value, wrapper))
+            entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+
+    def remove(self, wrapper):
+        if wrapper in self.catchall:
+            self.catchall.remove(wrapper)
+        for kind, value in wrapper.matchKeys():
+            self.keys.pop((kind, value), None)
+            self.prefixes[kind] = [entry for entry in self.prefixes.get(kind, []) if entry[1] is not wrapper]
+
+    # Wrap module registered with exactly this key, or None
+    def find(self, kind, value):
+        return self.keys.get((kind, value))
+
+    # Wrap module with the longest key of this kind that 'text' starts with, or None
+    def findPrefix(self, kind, text):
+        for value, wrapper in self.prefixes.get(kind, ()):
+            if text.startswith(value):
+                return wrapper
+        return None
+
+    # Receivers of a request: the wrap module found, if any, or else the ones without keys
+    def receivers(self, wrapper):
+        return [wrapper] if wrapper is not None else self.catchall
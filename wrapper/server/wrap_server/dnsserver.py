@@ -25,6 +25,8 @@ from argparse import ArgumentParser
 from utils.prompt import Prompt
 from socketserver import ThreadingUDPServer
 from socketserver import BaseRequestHandler
+from wrapper.server.wrap_server.dispatch import WrapperIndex, waitForReply
+import socket
 
 
 class CustomBaseRequestHandler(BaseRequestHandler):
@@ -38,30 +40,43 @@ class CustomBaseRequestHandler(BaseRequestHandler):
                 rdata=TXT("google-site-verification=qt5d8b2252742f0bcab14623d9714bee9ba7e82da3")))
         return reply
 
-    def waitForResponse(self,q, request):
+    # The default error is returned on timeout, or at once if every wrapper declined the request
+    def waitForResponse(self,q, request, receivers):
         response = None
         try:
-            r = q.get(True,self.server.timeout)
-            response = r.content
+            r = waitForReply(q, receivers, self.server.timeout)
+            response = r.content if r is not None else self.genDefaultError(request)
         except (Empty,Exception):
             response = self.genDefaultError(request)
             self.server._LOGGING_ and self.server.logger.error(f"[{self.server.sname}] expired timeout in waitForResponse()")
         finally:
             return response
 
-    def doMulticast(self,q,data):
-        for wrap in self.server.wrappers:
+    # Method that finds the wrapper registered for the queried name or for the
+    # closest of its parent domains.
+    def findWrapper(self, request):
+        labels = request.q.qname.idna()[:-1].split('.')
+        for i in range(len(labels)):
+            wrap = self.server.index.find("domain", '.'.join(labels[i:]))
+            if wrap is not None:
+                return wrap
+        return None
+
+    def doDispatch(self,q,data):
+        receivers = self.server.index.receivers(self.findWrapper(data))
+        for wrap in receivers:
             msg = Message(self.server.sname, self.server.sid, wrap.name, wrap.id,
                 MessageType.STREAM, data, q)
             wrap.inbox.put(msg)
+        return len(receivers)
 
     def returnResponse(self,reply):
         self.send_data(reply.pack())
 
     def processRequest(self,request):
         q = Queue()
-        self.doMulticast(q,request)
-        response = self.waitForResponse(q,request)
+        receivers = self.doDispatch(q,request)
+        response = self.waitForResponse(q,request,receivers)
         self.returnResponse(response)
 
     def get_data(self):
@@ -89,9 +104,10 @@ class UDPRequestHandler(CustomBaseRequestHandler):
 
 
 class WrapDNSServer(ThreadingUDPServer):
-    def __init__(self, server_address, RequestHandlerClass, wrappers, sname, sid, ttl, timeout, logger):
+    def __init__(self, server_address, RequestHandlerClass, index, sname, sid, ttl, timeout, logger, reuse_port=False):
+        self.reuse_port = reuse_port
         ThreadingUDPServer.__init__(self, server_address, RequestHandlerClass)
-        self.wrappers = wrappers
+        self.index = index
         self.sname = sname
         self.sid = sid
         self.ttl = ttl
@@ -100,6 +116,11 @@ class WrapDNSServer(ThreadingUDPServer):
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingUDPServer.server_bind(self)
+
 
 class dnsserver(Thread):
 
@@ -132,6 +153,10 @@ class dnsserver(Thread):
                     "nargs": 1,
                     "default": [3],
                     "type" :  int
+                },
+                "--reuse-port": {
+                    "help": "Lets several server processes listen on the same port (SO_REUSEPORT). Set by ms.py --processes",
+                    "action": "store_true"
                 }
             }
         ]
@@ -140,6 +165,7 @@ class dnsserver(Thread):
     def __init__(self, id, args, logger):
         Thread.__init__(self)
         self.wrappers = []
+        self.index = WrapperIndex()
         self.id = id
         self.server = None
         self.name = type(self).__name__
@@ -157,6 +183,7 @@ class dnsserver(Thread):
         self.port = parsed.port[0]
         self.ttl = parsed.ttl[0]
         self.timeout = parsed.timeout[0]
+        self.reuse_port = parsed.reuse_port
     
     def generateArgParser(self):
         config = self.CONFIG
@@ -179,21 +206,24 @@ class dnsserver(Thread):
 
     def addWrapModule(self, encWrapper):
         self.wrappers.append(encWrapper)
+        self.index.add(encWrapper)
 
     def removeWrapModule(self, encWrapper):
         self.wrappers.remove(encWrapper)
+        self.index.remove(encWrapper)
 
     def run(self):
         self._LOGGING_ and self.logger.info(f"[{self.name}] Server started. Passing messages...")
         self.server = WrapDNSServer(
             (self.hostname, self.port), 
             UDPRequestHandler,
-            self.wrappers,
+            self.index,
             self.name,
             self.id, 
             self.ttl,
             self.timeout, 
-            self.logger)
+            self.logger,
+            self.reuse_port)
         st = Thread(target=self.SignalThread)
         st.start()
         self.server.serve_forever()
@@ -25,12 +25,15 @@ from argparse import ArgumentParser
 from utils.prompt import Prompt
 from cgi import FieldStorage
 from ssl import wrap_socket
+from wrapper.server.wrap_server.dispatch import WrapperIndex, waitForReply
+import socket
 
 
 class WrapHTTPServer(ThreadingHTTPServer):
-    def __init__(self, server_address, RequestHandlerClass, wrappers, sname, sid, timeout, error_file, error_code, logger):
+    def __init__(self, server_address, RequestHandlerClass, index, sname, sid, timeout, error_file, error_code, logger, reuse_port=False):
+        self.reuse_port = reuse_port
         ThreadingHTTPServer.__init__(self, server_address, RequestHandlerClass)
-        self.wrappers = wrappers
+        self.index = index
         self.sname = sname
         self.sid = sid
         self.timeout = timeout
@@ -40,6 +43,11 @@ class WrapHTTPServer(ThreadingHTTPServer):
         self.logger = logger
         self._LOGGING_ = False if logger is None else True
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingHTTPServer.server_bind(self)
+
 
 class httpserverHandler(BaseHTTPRequestHandler):
 
@@ -65,18 +73,42 @@ class httpserverHandler(BaseHTTPRequestHandler):
         else:
             return self.getDefaultErrorView()
 
-    # Send the request message to all wrappers (just the right wrapper will process and make an answer).
-    def doMulticast(self, q, data):
-        for wrap in self.server.wrappers:
+    # Method that finds the wrapper registered for a header name, a POST field
+    # name or a URI prefix of the request, in the order the wrappers read them.
+    def findWrapper(self, data):
+        index = self.server.index
+        for name in data['headers'].keys():
+            wrap = index.find("header", name)
+            if wrap is not None:
+                return wrap
+        if data['content'] is not None and data['content'].list:
+            for field in data['content'].list:
+                wrap = index.find("field", field.name)
+                if wrap is not None:
+                    return wrap
+        _, uri, _ = data['requestline'].split(' ', 2)
+        return index.findPrefix("uri", uri)
+
+    # Send the request message to the wrapper that matches it or, when none
+    # does, to the wrappers without match keys. Returns how many got it.
+    def doDispatch(self, q, data):
+        try:
+            match = self.findWrapper(data)
+        except Exception:
+            match = None
+        receivers = self.server.index.receivers(match)
+        for wrap in receivers:
             msg = Message(self.server.sname, self.server.sid, wrap.name, wrap.id,
                           MessageType.STREAM, data, q)
             wrap.inbox.put(msg)
+        return len(receivers)
 
-    def waitForResponse(self, q):
+    # The error view is returned on timeout, or at once if every wrapper declined the request
+    def waitForResponse(self, q, receivers):
         response = None
         try:
-            r = q.get(True, self.server.timeout)
-            response = r.content
+            r = waitForReply(q, receivers, self.server.timeout)
+            response = r.content if r is not None else self.generateErrorView()
         except (Empty, Exception):
             response = self.generateErrorView()
         finally:
@@ -123,8 +155,8 @@ class httpserverHandler(BaseHTTPRequestHandler):
     def processRequest(self, request):
         try:
             q = Queue()
-            self.doMulticast(q, request)
-            response = self.waitForResponse(q)
+            receivers = self.doDispatch(q, request)
+            response = self.waitForResponse(q, receivers)
             self.returnResponse(response)
         except Exception as e:
             self.server.logger.exception(
@@ -189,6 +221,10 @@ class httpserver(Thread, BaseHTTPRequestHandler):
                     "help": "Path of the ssl certificate file. You can generate one with the following command: 'openssl req -new -x509 -keyout server.pem -out server.pem -days 365 -nodes'",
                     "nargs": 1,
                     "type": str
+                },
+                "--reuse-port": {
+                    "help": "Lets several server processes listen on the same port (SO_REUSEPORT). Set by ms.py --processes",
+                    "action": "store_true"
                 }
             }
         ]
@@ -197,6 +233,7 @@ class httpserver(Thread, BaseHTTPRequestHandler):
     def __init__(self, id, args, logger):
         Thread.__init__(self)
         self.wrappers = []
+        self.index = WrapperIndex()
         self.id = id
         self.server = None
         self.name = type(self).__name__
@@ -229,6 +266,7 @@ class httpserver(Thread, BaseHTTPRequestHandler):
         self.error_code = parsed.error_code[0] if parsed.error_code else None
         self.ssl = parsed.ssl
         self.ssl_cert = parsed.ssl_cert[0] if parsed.ssl_cert else None
+        self.reuse_port = parsed.reuse_port
 
     def SignalThread(self):
         while True:
@@ -239,16 +277,18 @@ class httpserver(Thread, BaseHTTPRequestHandler):
 
     def addWrapModule(self, encWrapper):
         self.wrappers.append(encWrapper)
+        self.index.add(encWrapper)
 
     def removeWrapModule(self, encWrapper):
         self.wrappers.remove(encWrapper)
+        self.index.remove(encWrapper)
 
     def run(self):
         self._LOGGING_ and self.logger.info(f"[{self.name}] Server started. Passing messages...")
         self.server = WrapHTTPServer((self.hostname, self.port),
-                httpserverHandler,self.wrappers,self.name,
+                httpserverHandler,self.index,self.name,
                 self.id, self.timeout, self.error_file, 
-                self.error_code, self.logger)
+                self.error_code, self.logger, self.reuse_port)
         
         # Checking if SSL should be used
         if self.ssl and self.ssl_cert:
@@ -26,6 +26,7 @@ from utils.prompt import Prompt
 
 import socket, select
 from utils.icmp import Packet
+from wrapper.server.wrap_server.dispatch import waitForReply
 
 class icmpserver(Thread):
     
@@ -115,12 +116,14 @@ class icmpserver(Thread):
             msg = Message(self.name, self.id, wrap.name, wrap.id,
                 MessageType.STREAM, data, q)
             wrap.inbox.put(msg)
+        return len(self.wrappers)
 
-    def waitForResponse(self, q, request):
+    # Echoes the request data on timeout, or at once if every wrapper declined it
+    def waitForResponse(self, q, request, receivers):
         response = None
         try:
-            r = q.get(True,self.timeout)
-            response = r.content
+            r = waitForReply(q, receivers, self.timeout)
+            response = r.content if r is not None else request.data
         except (Empty,Exception):
             response = request.data
             self._LOGGING_ and self.logger.error(f"[{self.name}] queue timeout expired answering: {response}")
@@ -141,8 +144,8 @@ class icmpserver(Thread):
             q = Queue()
             self._LOGGING_ and self.logger.debug_all(f"[{self.name}] icmp request data: {request.data}")
 
-            self.doMulticast(q,request.data)
-            response = self.waitForResponse(q, request)
+            receivers = self.doMulticast(q,request.data)
+            response = self.waitForResponse(q, request, receivers)
             self._LOGGING_ and self.logger.debug_all(f"[{self.name}] icmp response data: {response}")
 
             if not response: